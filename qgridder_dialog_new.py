@@ -105,7 +105,7 @@ class QGridderDialogNew(QGridderDialog, Ui_QGridderNew):
     #  ======= Choose output shape file
     def out_file(self):
         self.textOutFilename.clear()
-        ( self.OutFileName, self.encoding ) = ftools_utils.saveDialog( self )
+        ( self.OutFileName, self.encoding ) = ftools_utils.saveDialog( self, ftools_utils.GRID_FILTERS )
         #if self.OutFileName is None or self.encoding is None:
         #    QMessageBox.information(parent, "Gridder",
         #            str( 'encoding' + str(self.encoding) + 'file: ' + str(self.OutFileName) ))
@@ -239,21 +239,46 @@ class QGridderDialogNew(QGridderDialog, Ui_QGridderNew):
             idVar = 0
             rectFeat.setAttribute(0, idVar)
 
+            # Output format is set from file extension (shp, gpkg or fgb)
+            driverName = ftools_utils.getDriverName( self.OutFileName )
+
             # if the file exits, remove it
-            check = QFile(self.OutFileName)
             if QFile(self.OutFileName).exists():
-                if not QgsVectorFileWriter.deleteShapeFile(self.OutFileName):
+                if driverName == "ESRI Shapefile" :
+                    removed = QgsVectorFileWriter.deleteShapeFile(self.OutFileName)
+                else :
+                    removed = QFile(self.OutFileName).remove()
+                if not removed :
                     QMessageBox.information(self, self.tr("Generate Vector Grid"),
                     "Cannot delete file:\n" + unicode(self.OutFileName) + "\n")
                     return
 
-            # Load shape file writer
-            writer = QgsVectorFileWriter(unicode(self.textOutFilename.text()), 
-                    self.encoding, fields, QgsWkbTypes.Polygon, 
-                    crs, driverName="ESRI Shapefile")
+            # Load file writer
+            # GeoPackage features are written within a single transaction,
+            # committed when the writer is deleted.
+            options = QgsVectorFileWriter.SaveVectorOptions()
+            options.driverName = driverName
+            options.fileEncoding = self.encoding
+            if driverName in ('GPKG', 'FlatGeobuf') :
+                options.layerName = QFileInfo(self.OutFileName).completeBaseName()
+                options.layerOptions = ['SPATIAL_INDEX=YES']
+            if crs is None :
+                crs = QgsCoordinateReferenceSystem()
+            writer = QgsVectorFileWriter.create(unicode(self.textOutFilename.text()),
+                    fields, QgsWkbTypes.Polygon, crs,
+                    QgsProject.instance().transformContext(), options)
+
+            if writer.hasError() != QgsVectorFileWriter.NoError :
+                QMessageBox.information(self, self.tr("Generate Vector Grid"),
+                        writer.errorMessage() )
+                QApplication.restoreOverrideCursor()
+                self.buttonWriteGrid.setEnabled( True )
+                return
 
             # Call function to make grid
-            qgridder_utils.make_rgrid(rectFeat, n, m, writer, self.progressBarBuildGrid)
+            # cells are generated and flushed to the writer by chunks of rows
+            qgridder_utils.make_rgrid(rectFeat, n, m, writer, self.progressBarBuildGrid,
+                    chunk_size = qgridder_utils.BATCH_SIZE )
 
             # Delete writer
             del writer
@@ -263,10 +288,17 @@ class QGridderDialogNew(QGridderDialog, Ui_QGridderNew):
                 # list currently loaded layer. If the layer is loaded, unload it.
                 for (name,layer) in QgsProject.instance().mapLayers().items():
                     # Note : reload() doesn't work.
-                    if layer.source()==self.OutFileName:
+                    if layer.source().split('|')[0]==self.OutFileName:
                         QgsProject.instance().removeMapLayer( layer.id() )
                 # load layer
                 ftools_utils.addShapeToCanvas( self.OutFileName )
+                # persist the structured grid descriptor of the new grid,
+                # known from the grid parameters
+                for (name,layer) in QgsProject.instance().mapLayers().items():
+                    if layer.source().split('|')[0]==self.OutFileName:
+                        descriptor = qgridder_utils.make_rgrid_descriptor(rectFeat, n, m, layer)
+                        if descriptor is not None :
+                            qgridder_utils.write_rgrid_descriptor(layer, descriptor)
                 # update layer list in plugin
                 self.populate_layer_list(self.listSourceLayer)
 
@@ -3,5 +3,11 @@
 """
 from .base import *
 from .pproc import *
+from .structured import *
+from .quadtree import *
+from .adjacency import *
+from .nearest import *
+from .traversal import *
+from .overlay import *
 from .tseries import *
 
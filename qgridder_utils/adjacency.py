@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ qgridder_utils_adjacency.py
+                                 Qgridder - A QGIS plugin
+
+ This file gathers the face-adjacency graph of grid cells, used
+ for topology checks.
+
+ Qgridder builds 2D regular and unstructured grids and comes together with
+ pre- and post-processing capabilities for spatially distributed modeling.
+
+                              -------------------
+        begin                : 2013-04-08
+        copyright            : (C) 2013 by Pryet
+        email                : alexandre.pryet@ensegid.fr
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from qgis.core import *
+
+import numpy as np
+
+from .base import MAX_DECIMALS
+
+# ======================================================================================
+def face_pairs(xmin, ymin, xmax, ymax, decimals = MAX_DECIMALS):
+    """
+    Description
+    ----------
+    Face neighbors of rectangular cells, in one vectorized pass.
+    Cell bounds are snapped to decimals and replaced by their rank among the unique
+    snapped coordinates. Along each grid line, faces are matched by binary search
+    over the sorted (line, position) keys.
+
+    Parameters
+    ----------
+    xmin, ymin, xmax, ymax : arrays of cell bounds
+
+    Returns
+    -------
+    (src, dst, direction) : arrays of cell positions, dst is the neighbor of src in
+    direction (codes of find_neighbors : 1 above, 2 right, 3 below, 4 left).
+    Each face appears twice, once from each side.
+
+    Examples
+    --------
+    >>> src, dst, direction = face_pairs(xmin, ymin, xmax, ymax)
+    """
+    xmin, xmax = np.around(xmin, decimals), np.around(xmax, decimals)
+    ymin, ymax = np.around(ymin, decimals), np.around(ymax, decimals)
+
+    # ranks of snapped coordinates
+    x_values = np.unique( np.concatenate( (xmin, xmax) ) )
+    y_values = np.unique( np.concatenate( (ymin, ymax) ) )
+    ixmin, ixmax = np.searchsorted(x_values, xmin), np.searchsorted(x_values, xmax)
+    iymin, iymax = np.searchsorted(y_values, ymin), np.searchsorted(y_values, ymax)
+
+    # cells to the right (2) : xmax of src equals xmin of dst, y intervals overlap
+    src_r, dst_r = _match_faces(ixmax, iymin, iymax, ixmin, iymin, iymax, y_values.size)
+    # cells above (1) : ymax of src equals ymin of dst, x intervals overlap
+    src_a, dst_a = _match_faces(iymax, ixmin, ixmax, iymin, ixmin, ixmax, x_values.size)
+
+    src = np.concatenate( (src_a, src_r, dst_a, dst_r) )
+    dst = np.concatenate( (dst_a, dst_r, src_a, src_r) )
+    direction = np.concatenate( ( np.full(src_a.size, 1), np.full(src_r.size, 2),
+        np.full(src_a.size, 3), np.full(src_r.size, 4) ) )
+
+    return(src, dst, direction)
+
+
+def _match_faces(a_line, a_start, a_end, b_line, b_start, b_end, nranks):
+    """
+    Description
+    ----------
+    Pairs (a, b) with a_line == b_line and overlapping [start, end[ intervals.
+    Intervals of b along a given line must not overlap (grid cells).
+    Lines and interval bounds are integer ranks, nranks is the number of interval ranks.
+    """
+    # composite keys (line, position)
+    b_start_key = b_line.astype(np.int64) * nranks + b_start
+    b_end_key = b_line.astype(np.int64) * nranks + b_end
+    order = np.argsort(b_start_key, kind='stable')
+    b_start_key, b_end_key = b_start_key[order], b_end_key[order]
+
+    # along each line, b intervals overlapping [a_start, a_end[ are contiguous
+    a_key = a_line.astype(np.int64) * nranks
+    lo = np.searchsorted(b_end_key, a_key + a_start, side='right')
+    hi = np.searchsorted(b_start_key, a_key + a_end, side='left')
+    count = np.maximum(hi - lo, 0)
+
+    # expand ranges
+    src = np.repeat( np.arange(a_line.size), count )
+    offsets = np.arange( count.sum() ) - np.repeat( np.cumsum(count) - count, count )
+    dst = order[ np.repeat(lo, count) + offsets ]
+
+    return(src, dst)
+
+
+# ======================================================================================
+class GridAdjacency(object):
+    """
+    Face-adjacency graph of the cells of a grid, stored as CSR arrays :
+    neighbors of the cell at position i are indices[indptr[i]:indptr[i+1]],
+    with direction codes directions[indptr[i]:indptr[i+1]] (1 above, 2 right,
+    3 below, 4 left). Positions refer to the fids array.
+    The graph can be updated after splits, recomputing the faces around
+    the modified cells only.
+
+    Examples
+    --------
+    >>> adjacency = GridAdjacency.from_layer(grid_layer)
+    >>> neighbor_ids, directions = adjacency.neighbors(featId)
+    """
+
+    def __init__(self, fids, xmin, ymin, xmax, ymax):
+        self.fids = np.asarray(fids, dtype=np.int64)
+        self.xmin, self.ymin = np.asarray(xmin, dtype=np.float64), np.asarray(ymin, dtype=np.float64)
+        self.xmax, self.ymax = np.asarray(xmax, dtype=np.float64), np.asarray(ymax, dtype=np.float64)
+        src, dst, direction = face_pairs(self.xmin, self.ymin, self.xmax, self.ymax)
+        self._set_pairs(src, dst, direction)
+
+    @classmethod
+    def from_features(cls, features):
+        """ Adjacency graph from an iterable of grid features """
+        fids, bounds = [], []
+        for feat in features :
+            bbox = feat.geometry().boundingBox()
+            fids.append( feat.id() )
+            bounds.append( (bbox.xMinimum(), bbox.yMinimum(), bbox.xMaximum(), bbox.yMaximum()) )
+        xmin, ymin, xmax, ymax = np.array(bounds, dtype=np.float64).reshape(-1, 4).T
+        return cls(fids, xmin, ymin, xmax, ymax)
+
+    @classmethod
+    def from_layer(cls, grid_layer):
+        """ Adjacency graph of a grid layer """
+        return cls.from_features( grid_layer.getFeatures( QgsFeatureRequest().setNoAttributes() ) )
+
+    def _set_pairs(self, src, dst, direction):
+        # build CSR arrays from pairs of positions
+        order = np.lexsort( (dst, src) )
+        self.indices = dst[order]
+        self.directions = direction[order]
+        self.indptr = np.concatenate( ([0], np.cumsum( np.bincount(src, minlength=self.fids.size) )) )
+        self._positions = None
+
+    def _pairs(self):
+        src = np.repeat( np.arange(self.fids.size), np.diff(self.indptr) )
+        return(src, self.indices, self.directions)
+
+    def positions(self, fids):
+        """ Positions of features fids in the CSR arrays """
+        if self._positions is None :
+            self._positions = { fid:i for i, fid in enumerate(self.fids.tolist()) }
+        return np.array( [ self._positions[fid] for fid in fids ], dtype=np.int64 )
+
+    def neighbors(self, fid):
+        """
+        Description
+        ----------
+        Face neighbors of feature fid
+
+        Returns
+        -------
+        (neighbor ids, direction codes) arrays
+        """
+        i = self.positions([fid])[0]
+        sl = slice(self.indptr[i], self.indptr[i+1])
+        return( self.fids[self.indices[sl]], self.directions[sl] )
+
+    def update(self, removed_fids, added_fids, xmin, ymin, xmax, ymax):
+        """
+        Description
+        ----------
+        Updates the graph after cells removed_fids have been replaced by cells
+        added_fids, of bounds xmin, ymin, xmax, ymax, covering the same area
+        (e.g. split_cells). Faces are only recomputed between the new cells and
+        the former neighbors of the removed cells.
+        """
+        removed = np.zeros(self.fids.size, dtype=bool)
+        removed[ self.positions(removed_fids) ] = True
+        src, dst, direction = self._pairs()
+
+        # former neighbors of removed cells
+        around = np.unique( dst[ removed[src] & ~removed[dst] ] )
+
+        # kept pairs, renumbered
+        keep = ~removed[src] & ~removed[dst]
+        new_pos = np.cumsum(~removed) - 1
+        src, dst, direction = new_pos[ src[keep] ], new_pos[ dst[keep] ], direction[keep]
+
+        # new cells appended
+        nkept = int( (~removed).sum() )
+        added_fids = np.asarray(added_fids, dtype=np.int64)
+        self.fids = np.concatenate( (self.fids[~removed], added_fids) )
+        self.xmin = np.concatenate( (self.xmin[~removed], xmin) )
+        self.ymin = np.concatenate( (self.ymin[~removed], ymin) )
+        self.xmax = np.concatenate( (self.xmax[~removed], xmax) )
+        self.ymax = np.concatenate( (self.ymax[~removed], ymax) )
+
+        # faces between new cells and their neighbors
+        local = np.concatenate( ( new_pos[around], nkept + np.arange(added_fids.size) ) )
+        lsrc, ldst, ldirection = face_pairs( self.xmin[local], self.ymin[local],
+                self.xmax[local], self.ymax[local] )
+        lsrc, ldst = local[lsrc], local[ldst]
+        new = (lsrc >= nkept) | (ldst >= nkept)
+
+        self._set_pairs( np.concatenate( (src, lsrc[new]) ),
+                np.concatenate( (dst, ldst[new]) ),
+                np.concatenate( (direction, ldirection[new]) ) )
@@ -39,6 +39,8 @@ import numpy as np
 import multiprocessing as mp
 from . import ftools_utils
 import time
+import os
+import json
 
 # ======================================================================================
 
@@ -48,28 +50,154 @@ TOLERANCE = 1e-6  # absolute tolerance
 MAX_DECIMALS = 6  # used to limit the effects of numerical noise
 
 # ======================================================================================
-def make_rgrid(input_feat, n, m, vprovider, progress_bar = None ):
+# WKB encoding of rectangular cells :
+# byte order (little endian), geometry type (Polygon), number of rings (1),
+# number of points (5) and the 5 (x, y) vertices of the closed ring.
+WKB_POLYGON_DTYPE = np.dtype([ ('byteorder', 'u1'), ('type', '<u4'), ('nrings', '<u4'),
+    ('npoints', '<u4'), ('coords', '<f8', (5, 2)) ])
+WKB_POLYGON_SIZE = WKB_POLYGON_DTYPE.itemsize
+
+# Number of features passed at once to the vector provider or file writer
+BATCH_SIZE = 10000
+
+# Layer custom property holding the structured grid descriptor
+RGRID_DESCRIPTOR_PROPERTY = 'qgridder/rgrid_descriptor'
+
+# ======================================================================================
+def rect_wkb(xmin, ymin, xmax, ymax):
     """
     Description
     ----------
-    Builds regular grid of n lines and m columns, from QgsRectangle bbox.
-    Resulting features are appended to vprovider
+    Encodes rectangles as WKB polygons, in a single NumPy buffer.
+
+    Parameters
+    ----------
+    xmin, ymin, xmax, ymax : 1D arrays of rectangle bounds
+
+    Returns
+    -------
+
+    bytes of consecutive WKB polygons of WKB_POLYGON_SIZE bytes each,
+    in the order of the input arrays.
+
+    Examples
+    --------
+    >>> wkb = rect_wkb([0.], [0.], [1.], [1.])
+    """
+    xmin, xmax = np.asarray(xmin, dtype=np.float64), np.asarray(xmax, dtype=np.float64)
+    ymin, ymax = np.asarray(ymin, dtype=np.float64), np.asarray(ymax, dtype=np.float64)
+
+    buf = np.empty(xmin.size, dtype=WKB_POLYGON_DTYPE)
+    buf['byteorder'] = 1
+    buf['type'] = 3
+    buf['nrings'] = 1
+    buf['npoints'] = 5
+    # clock-wise point numbering (top-left, top-right, bottom-right, bottom-left, top-left)
+    coords = buf['coords']
+    coords[:, 0, 0], coords[:, 0, 1] = xmin, ymax
+    coords[:, 1, 0], coords[:, 1, 1] = xmax, ymax
+    coords[:, 2, 0], coords[:, 2, 1] = xmax, ymin
+    coords[:, 3, 0], coords[:, 3, 1] = xmin, ymin
+    coords[:, 4, :] = coords[:, 0, :]
+
+    return(buf.tobytes())
+
+
+# ======================================================================================
+def rgrid_wkb(x, y):
+    """
+    Description
+    ----------
+    Encodes all the cells of the regular grid defined by the edges x and y
+    as WKB polygons, in a single NumPy buffer.
+
+    Parameters
+    ----------
+    x : 1D array of the m+1 column edges, increasing
+    y : 1D array of the n+1 row edges, increasing
+
+    Returns
+    -------
+
+    bytes of n*m consecutive WKB polygons of WKB_POLYGON_SIZE bytes each.
+    Cells are ordered along y (outer) then along x (inner), as in make_rgrid.
+
+    Examples
+    --------
+    >>> wkb = rgrid_wkb(np.linspace(0, 10, 11), np.linspace(0, 5, 6))
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n, m = y.size - 1, x.size - 1
+
+    # cell edges, row-wise
+    return( rect_wkb( np.tile(x[:-1], n), np.repeat(y[:-1], m),
+        np.tile(x[1:], n), np.repeat(y[1:], m) ) )
+
+
+# ======================================================================================
+def wkb_to_features(wkb, attr):
+    """
+    Description
+    ----------
+    Builds QgsFeatures from a buffer of WKB polygons generated by rgrid_wkb.
+    Attributes are set once on a template feature, which is copied for each
+    polygon (attributes are implicitly shared), so that only the geometry
+    is built per feature.
+
+    Parameters
+    ----------
+    wkb : bytes, as returned by rgrid_wkb
+    attr : attribute list shared by all output features
+
+    Returns
+    -------
+
+    List of QgsFeature
+
+    Examples
+    --------
+    >>> feats = wkb_to_features(rgrid_wkb(x, y), input_feat.attributes())
+    """
+    template = QgsFeature()
+    template.setAttributes(attr)
+
+    # one WKB polygon per row of the buffer
+    polygons = np.frombuffer(wkb, dtype=np.uint8).reshape(-1, WKB_POLYGON_SIZE)
+
+    out_feat_list = [ QgsFeature(template) for i in range(polygons.shape[0]) ]
+    for out_feat, polygon in zip(out_feat_list, polygons) :
+        out_geom = QgsGeometry()
+        out_geom.fromWkb( polygon.tobytes() )
+        out_feat.setGeometry(out_geom)
+    return(out_feat_list)
+
+
+# ======================================================================================
+def iter_rgrid_features(input_feat, n, m, chunk_size = BATCH_SIZE):
+    """
+    Description
+    ----------
+    Generator over the cells of the regular grid of n lines and m columns built
+    from the bounding box of input_feat. Cells are produced row by row, by
+    chunks of about chunk_size features, so that memory does not depend
+    on the size of the grid.
 
     Parameters
     ----------
     input_feat : Qgis feature whose bounding box will be used to define the extents of the grid.
-                It can be generated by QgsRectangle()
     n, m      : number of rows and columns of output grid, respectively
-    vprovider : Qgis vector provider to which the output grid will be appended
+    chunk_size : approximate number of features per chunk (at least one row)
 
     Returns
     -------
 
-    List of feature ids in the grid
+    Generator of lists of QgsFeature
 
     Examples
     --------
-    >>>
+    >>> for feats in iter_rgrid_features(rectFeat, n, m) :
+    ...     writer.addFeatures(feats)
     """
 
     # Retrieve bbox and attributes from input feature
@@ -79,64 +207,72 @@ def make_rgrid(input_feat, n, m, vprovider, progress_bar = None ):
     # Compute grid coordinates
     x = np.linspace(bbox.xMinimum(), bbox.xMaximum(), m+1)
     y = np.linspace(bbox.yMinimum(), bbox.yMaximum(), n+1)
-    xx, yy = np.meshgrid(x, y)
+
+    # number of rows per chunk
+    nrows_chunk = max(1, chunk_size // m)
+
+    # row bands, i for lines (bottom to top), j for columns (left to right)
+    for i in range(0, n, nrows_chunk) :
+        yield( wkb_to_features(rgrid_wkb(x, y[i:i + nrows_chunk + 1]), attr) )
+
+
+# ======================================================================================
+def make_rgrid(input_feat, n, m, vprovider, progress_bar = None, chunk_size = BATCH_SIZE ):
+    """
+    Description
+    ----------
+    Builds regular grid of n lines and m columns, from QgsRectangle bbox.
+    Resulting features are appended to vprovider by chunks of about chunk_size
+    features, which are released once written (see iter_rgrid_features).
+
+    Parameters
+    ----------
+    input_feat : Qgis feature whose bounding box will be used to define the extents of the grid.
+                It can be generated by QgsRectangle()
+    n, m      : number of rows and columns of output grid, respectively
+    vprovider : Qgis vector provider to which the output grid will be appended
+    chunk_size : approximate number of features written at once
+
+    Returns
+    -------
+
+    List of feature ids in the grid
+
+    Examples
+    --------
+    >>>
+    """
 
     # Initialize progress bar
     if progress_bar is not None : 
         progress_bar.setRange(0,100)
         progress_bar.setValue(0)
+
+    # Check type of vector provider
+    # If vprovider is a layer provider
+    is_layer_provider = repr(QgsVectorDataProvider) == str(type(vprovider))
+
+    # Write features chunk by chunk
     count = 0
     countMax = n*m
-    countUpdate = countMax * 0.05 # update each 5%
-
-    # Initialize feature output list
-    out_feat_list = []
-
-    # iterate over grid lines
-    for i in range(len(y)-1):
-        # iterate over grid columns
-        for j in range(len(x)-1):
-            # compute feature coordinate
-            # clock-wise point numbering (top-left, top-right, bottom-right, bottom-left)
-            # i for lines (top to bottom), j for columns (left to right)
-            x1, x2, x3, x4 = xx[i+1,j],  xx[i+1,j+1],  xx[i,j+1],  xx[i,j]
-            y1, y2, y3, y4 = yy[i+1,j],  yy[i+1,j+1],  yy[i,j+1],  yy[i,j]
-            # define feature points
-            pt1, pt2, pt3, pt4 =  QgsPointXY(x1, y1), QgsPointXY(x2, y2), QgsPointXY(x3, y3), QgsPointXY(x4, y4)
-            pt5 = pt1
-            # define polygon from points
-            polygon = [[pt1, pt2, pt3, pt4, pt5]]
-            # initialize new feature
-            out_feat = QgsFeature()
-            out_feat.setAttributes(attr)
-            out_geom = QgsGeometry()
-            out_feat.setGeometry(out_geom.fromPolygonXY(polygon))
-            # save features
-            out_feat_list.append(out_feat)
-            # update counter
-            count += 1
-            # update ID (TO DO : check numbering)
-            #idvar = count
-            # each 5%, update progress bar
-            if int( np.fmod( count, countUpdate ) ) == 0:
-                    prog = int( count / countMax * 100 )
-                    if progress_bar is not None : 
-                        progress_bar.setValue(prog)
-                    QApplication.processEvents()
+    newFeatIds = []
+    for out_feat_list in iter_rgrid_features(input_feat, n, m, chunk_size):
+        if is_layer_provider :
+            isFeatureAddSuccessful, newFeatures = vprovider.addFeatures(out_feat_list)
+            newFeatIds.extend([feat.id() for feat in newFeatures])
+        # Else, if provider is a writer, write chunk to disk
+        else :
+            vprovider.addFeatures(out_feat_list)
+            vprovider.flushBuffer()
+        count += len(out_feat_list)
+        if progress_bar is not None : 
+            progress_bar.setValue( int( count / countMax * 100 ) )
+            QApplication.processEvents()
 
     if progress_bar is not None : 
         progress_bar.setValue(100)
-    # Check type of vector provider
-    # If vprovider is a layer provider
-    if repr(QgsVectorDataProvider) == str(type(vprovider)):
-        isFeatureAddSuccessful, newFeatures = vprovider.addFeatures(out_feat_list)
-        return([feat.id() for feat in newFeatures])
 
-    # Else, if provider is a writer
-    else :
-        for out_feat in out_feat_list:
-            vprovider.addFeature(out_feat)
-        return([])
+    return(newFeatIds)
 
 
 # ======================================================================================
@@ -151,13 +287,14 @@ def make_rgrid(input_feat, n, m, vprovider, progress_bar = None ):
 
 
 # ======================================================================================
-def rect_size(input_feature):
+def rect_size(input_feature, grid_cache = None):
     """
     Description
 
     Parameters
     ----------
     input_feature : Qgis vector feature
+    grid_cache (optional) : GridCache of the grid layer of input_feature
 
     Returns
     -------
@@ -169,13 +306,14 @@ def rect_size(input_feature):
     >>>
     """
 
-    # Extract the four corners of input_feature
-    # Note : rectangle points are numbered from top-left to bottom-left, clockwise
-    p0, p1, p2, p3 = ftools_utils.extractPoints(input_feature.geometry())[:4]
-    # Compute size
-    dx = abs(p1.x() - p0.x())
-    dy = abs(p3.y() - p0.y())
-    return( {'dx':dx,'dy':dy} )
+    # Read size from the cell geometry cache
+    if grid_cache is not None and grid_cache.contains( input_feature.id() ) :
+        i = grid_cache.positions( input_feature.id() )
+        return( {'dx':grid_cache.dx[i],'dy':grid_cache.dy[i]} )
+
+    # Compute size from the bounding box of the (rectangular) feature
+    bbox = input_feature.geometry().boundingBox()
+    return( {'dx':bbox.width(),'dy':bbox.height()} )
 
 # ======================================================================================
 def build_vect(p1, p2):
@@ -225,44 +363,110 @@ def is_colinear(v1, v2):
         return False
 
 
+# ======================================================================================
+class FixSet(object):
+    """
+    Set of features to split, keyed by feature id : { id : (n, m) }
+    n and m correspond to the number of splits to perform along rows and columns, respectively.
+    When a feature is added several times, the maximum of n and m is kept.
+    For compatibility with the former fix_dict = { 'id':[] , 'n':[], 'm':[] },
+    fix_set['id'], fix_set['n'] and fix_set['m'] return aligned lists.
+
+    Examples
+    --------
+    >>> fix_set = FixSet([12, 13], 2, 2)
+    >>> fix_set.add(12, 4, 4)
+    >>> fix_set.update(ids, n_array, m_array)
+    """
+
+    def __init__(self, ids = [], n = 1, m = 1):
+        self.fix = {}
+        self.update(ids, n, m)
+
+    def add(self, fId, n, m):
+        """ Adds a single record """
+        old = self.fix.get(fId)
+        if old is None :
+            self.fix[fId] = (n, m)
+        else :
+            self.fix[fId] = ( max(n, old[0]), max(m, old[1]) )
+        return(self)
+
+    def update(self, ids, n, m):
+        """
+        Adds records ids, n and m (arrays, n and m may be scalars).
+        Duplicates are merged with NumPy before updating the set.
+        """
+        ids = np.asarray(ids, dtype=np.int64).ravel()
+        if ids.size == 0 :
+            return(self)
+        n = np.broadcast_to( np.asarray(n, dtype=np.int64), ids.shape )
+        m = np.broadcast_to( np.asarray(m, dtype=np.int64), ids.shape )
+        # max-merge of duplicated ids
+        uids, inv = np.unique(ids, return_inverse=True)
+        un, um = np.zeros(uids.size, dtype=np.int64), np.zeros(uids.size, dtype=np.int64)
+        np.maximum.at(un, inv, n)
+        np.maximum.at(um, inv, m)
+        # merge with current records
+        fix = self.fix
+        for fId, n, m in zip( uids.tolist(), un.tolist(), um.tolist() ):
+            old = fix.get(fId)
+            fix[fId] = (n, m) if old is None else ( max(n, old[0]), max(m, old[1]) )
+        return(self)
+
+    def merge(self, other):
+        """ Merges FixSet (or fix_dict) other into this set """
+        if isinstance(other, FixSet) :
+            for fId, (n, m) in other.fix.items():
+                self.add(fId, n, m)
+            return(self)
+        return( self.update(other['id'], other['n'], other['m']) )
+
+    def __len__(self):
+        return len(self.fix)
+
+    def __contains__(self, fId):
+        return fId in self.fix
+
+    def __getitem__(self, key):
+        if key == 'id' :
+            return list(self.fix.keys())
+        if key == 'n' :
+            return [ nm[0] for nm in self.fix.values() ]
+        if key == 'm' :
+            return [ nm[1] for nm in self.fix.values() ]
+        raise KeyError(key)
+
+
 # ======================================================================================
 def update_fix_dict(fix_dict, this_fix_dict):
     """
     Description
     ----------
     Appends records of this_fix_dict to fix_dict
-    this_fix_dict and fix_dict should have the same structure : fix_dict = { 'id':[] , 'n':[], 'm':[] }
+    this_fix_dict and fix_dict are FixSet or have the structure : fix_dict = { 'id':[] , 'n':[], 'm':[] }
     n and m correponds to the number split to perform along rows and columns, respectively.
     If a record of this_fix_dict is already in fix_dict, updates the corresponding record
     If not, simply appends the record to fix_dict
     Parameters
     ----------
-    fix_dict : The feature dictionary to be extended, { 'id':[] , 'n':[], 'm':[] }
+    fix_dict : The feature dictionary to be extended, FixSet or { 'id':[] , 'n':[], 'm':[] }
     this_fix_dict : The feature dictionary to append to fix_dict
 
     Returns
     -------
 
-    fix_dict with features from this_fix_dict appended.
+    FixSet with features from fix_dict and this_fix_dict.
 
     Examples
     --------
     >>>
     """
 
-    for fId, n, m in zip( this_fix_dict['id'], this_fix_dict['n'], this_fix_dict['m'] ):
-        # if the feature is already in fix_dict, update this record
-        if fId in fix_dict['id']:
-            i = fix_dict['id'].index(fId)
-            fix_dict['n'][i] = max( n, fix_dict['n'][i] )
-            fix_dict['m'][i] = max( m, fix_dict['m'][i] )
-         # if the feature is not in fix_dict, append it
-        else :
-            fix_dict['id'].append(fId)
-            fix_dict['n'].append(n)
-            fix_dict['m'].append(m)
+    if not isinstance(fix_dict, FixSet) :
+        fix_dict = FixSet(fix_dict['id'], fix_dict['n'], fix_dict['m'])
 
-    return fix_dict
+    return fix_dict.merge(this_fix_dict)
 
 
 # ======================================================================================
@@ -318,7 +522,7 @@ def is_over(geomA,geomB,relativeError=TOLERANCE):
             )
 
 # ======================================================================================
-def refine_by_split(featIds, n, m, topo_rules, grid_layer, progress_bar = None, labelIter = None ) :
+def refine_by_split(featIds, n, m, topo_rules, grid_layer, progress_bar = None, labelIter = None, grid_index = None ) :
     """
     Description
     ----------
@@ -333,10 +537,11 @@ def refine_by_split(featIds, n, m, topo_rules, grid_layer, progress_bar = None,
     grid_layer : grid layer to be refined
     progress_bar : progress bar in dialog
     labelIter : iteration label in dialog
+    grid_index (optional) : GridIndex of grid_layer, kept up to date with the refined grid
 
     Returns
     -------
-    Nothing, just grid_layer is updated
+    Nothing, just grid_layer is updated (False if the new cells could not be written)
 
     Examples
     --------
@@ -345,86 +550,68 @@ def refine_by_split(featIds, n, m, topo_rules, grid_layer, progress_bar = None,
     start_time = time.time()
 
     # --  Procedure for regular structured grids (MODFLOW , n_max = 1)
+    # rows and columns are refined through delr, delc (see structured.py)
     if topo_rules['nmax'] == 1 :
-        # build feature dictionary
-        all_features = {feature.id(): feature for feature in grid_layer.getFeatures()}
-
-        # init fix dictionary
-        rowFixDict = { 'id': [] , 'n':[], 'm':[] }
-        colFixDict = { 'id': [] , 'n':[], 'm':[] }
-
-        # Initialize spatial index
-        grid_layerIndex = QgsSpatialIndex(grid_layer.getFeatures())
-
-        # get bbox of grid layer
-        grid_bbox = grid_layer.extent()
-
-        # iterate over initial feature set
-        # -- cells that have to be split horizontally
-        if n > 1 :
-            for featId in featIds :
-                # only consider featId if current row has not been considered before
-                if featId not in rowFixDict['id'] :
-                    # build bounding box over row
-                    bbox = all_features[featId].geometry().boundingBox()
-                    bbox.setXMinimum( grid_bbox.xMinimum() )
-                    bbox.setXMaximum( grid_bbox.xMaximum()  )
-                    bbox.setYMinimum( bbox.yMinimum() + TOLERANCE )
-                    bbox.setYMaximum( bbox.yMaximum() - TOLERANCE )
-                    # get features in current row
-                    rowFeatIds = grid_layerIndex.intersects( bbox )
-                    # update fix_dict with features in current row
-                    this_fix_dict = { 'id':rowFeatIds , 'n':[n]*len(rowFeatIds), 'm':[1]*len(rowFeatIds) }
-                    rowFixtDict = update_fix_dict(rowFixDict,this_fix_dict)
-
-        # --  cells that have to be split along columns
-        if m > 1 :
-            for featId in featIds :
-                # only consider featId if current row has not been considered before
-                if featId not in colFixDict['id'] :
-                    # build bounding box over column
-                    bbox = all_features[featId].geometry().boundingBox()
-                    bbox.setXMinimum( bbox.xMinimum() + TOLERANCE )
-                    bbox.setXMaximum( bbox.xMaximum() - TOLERANCE )
-                    bbox.setYMinimum( grid_bbox.yMinimum() )
-                    bbox.setYMaximum( grid_bbox.yMaximum() )
-                    # get features in current column
-                    colFeatIds = grid_layerIndex.intersects( bbox )
-                    # update fix_dict with features in current column
-                    this_fix_dict = { 'id':colFeatIds , 'n':[1]*len(colFeatIds), 'm':[m]*len(colFeatIds) }
-                    colFixtDict = update_fix_dict(colFixDict,this_fix_dict)
-
-        fix_dict = rowFixDict.copy()
-        fix_dict = update_fix_dict(fix_dict,colFixDict)
-        newFeatIds = split_cells(fix_dict, grid_layer)
+        from .structured import refine_structured
+        newFeatIds = refine_structured(featIds, n, m, grid_layer, grid_index)
         #print("OPTIM OVER %s sec" % (time.time() - start_time))
         return()
 
     # -- Refinement procedure for nested grids
+    # Cells are split by 2 or 4 : refine and balance a quadtree model of the grid,
+    # then write the new cells at once.
+    if n == m and n in (2, 4) :
+        from .quadtree import QuadTree
+        qtree = QuadTree.from_layer(grid_layer)
+        if qtree is not None :
+            # largest level difference whose size ratio 2**max_diff does not exceed nmax
+            max_diff = None if topo_rules['nmax'] is None else int( np.floor( np.log2(topo_rules['nmax']) ) )
+            qtree.refine(featIds, nlevels = int( round( np.log2(n) ) ), max_diff = max_diff)
+            split_fids = list(qtree.split_fids)
+            newFeatIds = qtree.write(grid_layer)
+            if newFeatIds is False :
+                return(False)
+            if grid_index is not None :
+                grid_index.remove(split_fids)
+                grid_index.add(newFeatIds)
+            if progress_bar is not None :
+                progress_bar.setValue(100)
+            return()
+
+    # Otherwise, iterate over split and topology checks
 
     # init iteration counter
     itCount = 0
 
-    # init fix dict
-    fix_dict = { 'id': featIds , 'n':[n]*len(featIds), 'm':[m]*len(featIds) }
+    # init fix set
+    fix_dict = FixSet(featIds, n, m)
+
+    # Initialize spatial index and face-adjacency graph, updated at each split
+    from .adjacency import GridAdjacency
+    if grid_index is None :
+        grid_index = GridIndex(grid_layer)
+    all_features = grid_index.features
+    grid_layerIndex = grid_index.index
+    adjacency = GridAdjacency.from_features( all_features.values() )
 
     # Continue until input_features is empty
-    while len(fix_dict['id']) > 0:
+    while len(fix_dict) > 0:
 
         # Split input_features
-        newFeatIds = split_cells(fix_dict, grid_layer)
+        splitFeatIds = fix_dict['id']
+        newFeatIds = split_cells(fix_dict, grid_layer, grid_index)
 
-        # Get all the features
-        all_features = {feature.id(): feature for feature in grid_layer.getFeatures()}
+        # Update face-adjacency graph around new features
+        bboxes = [ all_features[newFeatId].geometry().boundingBox() for newFeatId in newFeatIds ]
+        adjacency.update( splitFeatIds, newFeatIds,
+                np.array([bbox.xMinimum() for bbox in bboxes]), np.array([bbox.yMinimum() for bbox in bboxes]),
+                np.array([bbox.xMaximum() for bbox in bboxes]), np.array([bbox.yMaximum() for bbox in bboxes]) )
 
-        # Initialize spatial index
-        grid_layerIndex = QgsSpatialIndex()
-        # Fill spatial Index
-        for feat in all_features.values():
-            grid_layerIndex.insertFeature(feat)
+        # re-initialize the set of features to be fixed
+        fix_dict = FixSet()
 
-        # re-initialize the list of features to be fixed
-        fix_dict = { 'id':[] , 'n':[], 'm':[] }
+        # cell sizes of the split grid, read once per iteration
+        grid_cache = get_grid_cache(grid_layer)
 
         # Initialize progress bar
         if progress_bar is not None :
@@ -438,9 +625,10 @@ def refine_by_split(featIds, n, m, topo_rules, grid_layer, progress_bar = None,
         # Iterate over newFeatures to check topology
         for newFeatId in newFeatIds:
             # Get the neighbors of newFeatId that must be fixed
-            this_fix_dict = check_topo( newFeatId, n, m, topo_rules, all_features, grid_layer, grid_layerIndex)
+            this_fix_dict = check_topo( newFeatId, n, m, topo_rules, all_features, grid_layer, grid_layerIndex,
+                    adjacency, grid_cache )
             # Update fix_dict with this_fix_dict
-            fix_dict = update_fix_dict(fix_dict,this_fix_dict)
+            fix_dict.merge(this_fix_dict)
             # update counter
             count += 1
            # update progress_bar
@@ -460,7 +648,7 @@ def refine_by_split(featIds, n, m, topo_rules, grid_layer, progress_bar = None,
 
 
 # ======================================================================================
-def split_cells(fix_dict, v_layer = QgsVectorLayer()):
+def split_cells(fix_dict, v_layer = QgsVectorLayer(), grid_index = None):
     """
     Description
     ----------
@@ -469,8 +657,9 @@ def split_cells(fix_dict, v_layer = QgsVectorLayer()):
 
     Parameters
     ----------
-    fix_dict :  { 'id':[] , 'n':[], 'm':[] }
-    n, m  : number of parts to split feature
+    fix_dict :  FixSet or { 'id':[] , 'n':[], 'm':[] }
+    v_layer : grid layer
+    grid_index (optional) : GridIndex of v_layer, updated with the deleted and new features
     Returns
     -------
 
@@ -483,8 +672,12 @@ def split_cells(fix_dict, v_layer = QgsVectorLayer()):
 
     # note that n and m parameters are obsolete.
 
-    # Get all the features from v_layer
-    all_features = {feature.id(): feature for (feature) in v_layer.getFeatures()}
+    # Get the features to split from v_layer
+    if grid_index is not None :
+        all_features = { featId:grid_index.features[featId] for featId in fix_dict['id'] }
+    else :
+        request = QgsFeatureRequest().setFilterFids( list(fix_dict['id']) )
+        all_features = {feature.id(): feature for (feature) in v_layer.getFeatures(request)}
 
     # remove features that must be split from v_layer
     # this operation must be done before any feature add
@@ -499,12 +692,20 @@ def split_cells(fix_dict, v_layer = QgsVectorLayer()):
         feat = all_features[featId]
         newFeatIds.extend( make_rgrid(feat, n, m, v_layer.dataProvider() ) )
 
+    # Grid geometry has been modified through the provider
+    invalidate_grid_cache(v_layer)
+
+    # Update grid index
+    if grid_index is not None :
+        grid_index.remove(fix_dict['id'])
+        grid_index.add(newFeatIds)
+
     # Return new features
     return(newFeatIds)
 
 # --------------------------------------------------------------------------------------------------------------
 # Check the coherence of a boundary between 2 grid elements
-def is_valid_boundary( feat1, feat2, direction, topo_rules ):
+def is_valid_boundary( feat1, feat2, direction, topo_rules, grid_cache = None ):
     """
     Description
 
@@ -534,11 +735,15 @@ def is_valid_boundary( feat1, feat2, direction, topo_rules ):
         # -- for Nested
         # topo_rules = {'model':'nested', 'nmax':2}
 
+    # grid_cache (GridCache, optional) : cell geometry cache of the grid layer
+
     # get feat1 geometry
-    dx1, dy1 = rect_size(feat1)['dx'], rect_size(feat1)['dy']
+    size1 = rect_size(feat1, grid_cache)
+    dx1, dy1 = size1['dx'], size1['dy']
 
     # get feat2 geometry
-    dx2, dy2 = rect_size(feat2)['dx'], rect_size(feat2)['dy']
+    size2 = rect_size(feat2, grid_cache)
+    dx2, dy2 = size2['dx'], size2['dy']
 
     # Check if the boundary satisfies topo_rules
     # Note: in the logic of this program, we only consider the case
@@ -563,18 +768,27 @@ def is_valid_boundary( feat1, feat2, direction, topo_rules ):
 # --------------------------------------------------------------------------------------------------------------
 # Check topology of feat's neighbors and
 # return the neighbors that don't satisfy topo_rules
-def check_topo(featId, n, m, topo_rules, all_features, v_layer, v_layerIndex):
+def check_topo(featId, n, m, topo_rules, all_features, v_layer, v_layerIndex, adjacency = None, grid_cache = None):
     """
     Description
+    ----------
+    Check topology of the neighbors of feature featId
 
     Parameters
     ----------
-    p1 : parameter 1
+    featId : id of the feature to check
+    n, m : number of splits along rows and columns
+    topo_rules : topological rules
+    all_features : dictionary of grid features { id : feature }
+    v_layer : grid layer
+    v_layerIndex : spatial index of v_layer
+    adjacency (optional) : GridAdjacency of v_layer, used instead of the spatial index
+    grid_cache (optional) : GridCache of v_layer, cell sizes are read from it
 
     Returns
     -------
 
-    out1 : output1
+    FixSet of the features that do not satisfy topo_rules
 
     Examples
     --------
@@ -584,11 +798,16 @@ def check_topo(featId, n, m, topo_rules, all_features, v_layer, v_layerIndex):
     # Get the feature
     feat = all_features[featId]
 
-    # Initialize list of features to be fixed
-    fix_dict = { 'id':[] , 'n':[], 'm':[] }
+    # Initialize set of features to be fixed
+    fix_dict = FixSet()
 
-    # Find neighbors
-    neighbors = find_neighbors(feat, all_features, v_layerIndex)
+    # Find neighbors, from the face-adjacency graph if available
+    if adjacency is not None :
+        neighborIds, directions = adjacency.neighbors(featId)
+        neighbors = { 'direction':directions.tolist(),
+                'feature':[ all_features[neighborId] for neighborId in neighborIds.tolist() ] }
+    else :
+        neighbors = find_neighbors(feat, all_features, v_layerIndex)
 
     # Check the compatibility of input_feature and neighbors with topo_rules
     for direction, neighbor in zip(neighbors['direction'], neighbors['feature']):
@@ -605,13 +824,13 @@ def check_topo(featId, n, m, topo_rules, all_features, v_layer, v_layerIndex):
                 elif direction in [1,3] : # vertically
                     N = 1
             # check feat, neighbor boundary
-            if not is_valid_boundary( feat, neighbor, direction, topo_rules ) :
+            if not is_valid_boundary( feat, neighbor, direction, topo_rules, grid_cache ) :
                 # update fix_dict : add neighbor
-                fix_dict = update_fix_dict( fix_dict, { 'id':[neighbor.id()] , 'n':[N], 'm':[M] } )
+                fix_dict.add( neighbor.id(), N, M )
             # check neighbor, feat boundary
-            if not is_valid_boundary( neighbor, feat, direction, topo_rules ) :
+            if not is_valid_boundary( neighbor, feat, direction, topo_rules, grid_cache ) :
                 # update fix_dict : add feat
-                fix_dict = update_fix_dict( fix_dict, { 'id':[feat.id()] , 'n':[N], 'm':[M] } )
+                fix_dict.add( feat.id(), N, M )
 
     # return features that do not satisfy topo_rules
     return fix_dict
@@ -711,6 +930,523 @@ def find_neighbors(input_feature, all_features, v_layerIndex):
 
 
 
+# ======================================================================================
+# Cell geometry caches, by layer id
+_GRID_CACHES = {}
+# Ids of the layers whose signals are connected to invalidate_grid_cache
+_GRID_CACHE_CONNECTED = set()
+
+class GridCache(object):
+    """
+    Columnar cache of the cell geometries of a grid layer : NumPy arrays of
+    feature ids (sorted) with the corresponding bounds and centroids, built
+    in a single pass over the layer. Cells being rectangles, centroids are
+    the centers of their bounding boxes.
+    Derived data (e.g. grid descriptor, nearest-cell index) may be stored
+    in the data dictionary, they are dropped together with the cache.
+
+    Examples
+    --------
+    >>> grid_cache = get_grid_cache(grid_layer)
+    >>> i = grid_cache.positions([featId])
+    >>> dx = grid_cache.dx[i]
+    """
+
+    def __init__(self, grid_layer):
+        fids, bounds = [], []
+        for feat in grid_layer.getFeatures( QgsFeatureRequest().setNoAttributes() ):
+            bbox = feat.geometry().boundingBox()
+            fids.append( feat.id() )
+            bounds.append( (bbox.xMinimum(), bbox.yMinimum(), bbox.xMaximum(), bbox.yMaximum()) )
+        fids = np.array(fids, dtype=np.int64)
+        bounds = np.array(bounds, dtype=np.float64).reshape(-1, 4)
+        order = np.argsort(fids)
+        self.fids = fids[order]
+        self.xmin, self.ymin, self.xmax, self.ymax = bounds[order].T
+        self.cx = 0.5*(self.xmin + self.xmax)
+        self.cy = 0.5*(self.ymin + self.ymax)
+        self.dx = self.xmax - self.xmin
+        self.dy = self.ymax - self.ymin
+        self.data = {}
+
+    def __len__(self):
+        return self.fids.size
+
+    def positions(self, fids):
+        """ Positions of features fids in the cache arrays """
+        return np.searchsorted( self.fids, np.asarray(fids, dtype=np.int64) )
+
+    def contains(self, fid):
+        """ Whether feature fid is in the cache """
+        i = np.searchsorted(self.fids, fid)
+        return bool( i < self.fids.size and self.fids[i] == fid )
+
+
+# ======================================================================================
+def get_grid_cache(grid_layer):
+    """
+    Description
+    ----------
+    Returns the GridCache of grid_layer, built on first call.
+    The cache is dropped when features are added, deleted or their geometry changed,
+    and when editing stops (layer signals). Functions modifying the grid through the
+    data provider, which does not emit these signals, call invalidate_grid_cache.
+
+    Parameters
+    ----------
+    grid_layer : Qgis grid layer
+
+    Returns
+    -------
+    GridCache
+
+    Examples
+    --------
+    >>> grid_cache = get_grid_cache(grid_layer)
+    """
+    layer_id = grid_layer.id()
+    grid_cache = _GRID_CACHES.get(layer_id)
+
+    # feature count is checked for changes not notified by signals
+    if grid_cache is None or len(grid_cache) != grid_layer.featureCount() :
+        if grid_cache is not None :
+            invalidate_grid_cache(layer_id)
+        grid_cache = GridCache(grid_layer)
+        _GRID_CACHES[layer_id] = grid_cache
+
+    _connect_grid_cache(grid_layer)
+
+    return(grid_cache)
+
+
+def _connect_grid_cache(grid_layer):
+    """ Connects the signals of grid_layer to invalidate_grid_cache, once """
+    layer_id = grid_layer.id()
+    if layer_id in _GRID_CACHE_CONNECTED :
+        return
+    invalidate = lambda *args : invalidate_grid_cache(layer_id)
+    grid_layer.featureAdded.connect(invalidate)
+    grid_layer.featureDeleted.connect(invalidate)
+    grid_layer.geometryChanged.connect(invalidate)
+    grid_layer.editingStopped.connect(invalidate)
+    grid_layer.willBeDeleted.connect( lambda : _GRID_CACHE_CONNECTED.discard(layer_id) )
+    grid_layer.willBeDeleted.connect(invalidate)
+    _GRID_CACHE_CONNECTED.add(layer_id)
+
+
+# ======================================================================================
+# Ids of the layers whose signals are connected to invalidate_dependent_data
+_DEPENDENT_CONNECTED = set()
+
+def invalidate_dependent_data(layer):
+    """
+    Description
+    ----------
+    Drops the derived data of all grid caches which depend on layer (layer or layer id),
+    i.e. entries of GridCache.data keyed by tuples (kind, layer id, ...),
+    e.g. coverage matrices of a polygon layer.
+
+    Examples
+    --------
+    >>> invalidate_dependent_data(polygon_layer)
+    """
+    layer_id = layer if isinstance(layer, str) else layer.id()
+    for grid_cache in _GRID_CACHES.values() :
+        for key in [ key for key in grid_cache.data if isinstance(key, tuple) and len(key) > 1 and key[1] == layer_id ] :
+            del grid_cache.data[key]
+
+
+def connect_dependent_data(layer):
+    """
+    Description
+    ----------
+    Connects the signals of layer to invalidate_dependent_data, once :
+    derived data are dropped when features are added, deleted, their geometry
+    or attributes changed, when editing stops and when the layer is deleted.
+
+    Examples
+    --------
+    >>> connect_dependent_data(polygon_layer)
+    """
+    layer_id = layer.id()
+    if layer_id in _DEPENDENT_CONNECTED :
+        return
+    invalidate = lambda *args : invalidate_dependent_data(layer_id)
+    layer.featureAdded.connect(invalidate)
+    layer.featureDeleted.connect(invalidate)
+    layer.geometryChanged.connect(invalidate)
+    layer.attributeValueChanged.connect(invalidate)
+    layer.editingStopped.connect(invalidate)
+    layer.willBeDeleted.connect( lambda : _DEPENDENT_CONNECTED.discard(layer_id) )
+    layer.willBeDeleted.connect(invalidate)
+    _DEPENDENT_CONNECTED.add(layer_id)
+
+
+# ======================================================================================
+def get_grid_spatial_index(grid_layer):
+    """
+    Description
+    ----------
+    QgsSpatialIndex of the cells of grid_layer, built from the bounds of its
+    GridCache without fetching features, and dropped with the cache.
+
+    Examples
+    --------
+    >>> fIds = get_grid_spatial_index(grid_layer).intersects(rect)
+    """
+    grid_cache = get_grid_cache(grid_layer)
+    index = grid_cache.data.get('spatial_index')
+    if index is None :
+        index = QgsSpatialIndex()
+        for fid, bounds in zip( grid_cache.fids.tolist(), zip(grid_cache.xmin.tolist(),
+                grid_cache.ymin.tolist(), grid_cache.xmax.tolist(), grid_cache.ymax.tolist()) ) :
+            index.addFeature( fid, QgsRectangle(*bounds) )
+        grid_cache.data['spatial_index'] = index
+    return(index)
+
+
+# ======================================================================================
+def invalidate_grid_cache(grid_layer):
+    """
+    Description
+    ----------
+    Drops the GridCache of grid_layer (layer or layer id), together with
+    the derived data of other grids depending on it (see invalidate_dependent_data)
+
+    Examples
+    --------
+    >>> invalidate_grid_cache(grid_layer)
+    """
+    layer_id = grid_layer if isinstance(grid_layer, str) else grid_layer.id()
+    _GRID_CACHES.pop(layer_id, None)
+    _RGRID_DESCRIPTORS.pop(layer_id, None)
+    invalidate_dependent_data(layer_id)
+
+
+# ======================================================================================
+# Structured grid descriptors, by layer id
+_RGRID_DESCRIPTORS = {}
+
+def get_rgrid_descriptor(grid_layer):
+    """
+    Description
+    ----------
+    Descriptor of a structured (modflow-like) grid layer, computed in a single
+    vectorized pass over the cell bounds : unique x and y edges give the columns
+    and rows, cell centers are located by binary search over the edges.
+    The descriptor is kept in memory until the grid changes. Nothing is
+    written : a descriptor persisted with write_rgrid_descriptor is reused
+    without reading the cells if it matches the grid signature (see
+    grid_signature and check_rgrid_descriptor).
+
+    Parameters
+    ----------
+    grid_layer : the structured grid layer
+
+    Returns
+    -------
+    Dictionary with keys :
+    'nrow', 'ncol' : number of rows and columns
+    'xoff', 'yoff' : top-left corner of the grid
+    'delr', 'delc' : arrays of column widths and row heights
+    'fids' : array of feature ids in row-major order (row 0 is the top row)
+    'regular' : True if the layer is actually a structured grid (see check_rgrid_regularity)
+    'signature' : see grid_signature
+
+    Examples
+    --------
+    >>> descriptor = get_rgrid_descriptor(grid_layer)
+    >>> nrow, ncol = descriptor['nrow'], descriptor['ncol']
+    """
+    layer_id = grid_layer.id()
+
+    # in-memory descriptors are dropped with the grid cache
+    descriptor = _RGRID_DESCRIPTORS.get(layer_id)
+    if descriptor is None :
+        signature = grid_signature(grid_layer)
+        descriptor = read_rgrid_descriptor(grid_layer, signature)
+        if descriptor is None :
+            descriptor = compute_rgrid_descriptor( get_grid_cache(grid_layer) )
+            descriptor['signature'] = signature
+        _RGRID_DESCRIPTORS[layer_id] = descriptor
+        _connect_grid_cache(grid_layer)
+
+    return(descriptor)
+
+
+def compute_rgrid_descriptor(grid_cache, decimals = MAX_DECIMALS):
+    """
+    Description
+    ----------
+    Structured grid descriptor from a GridCache (see get_rgrid_descriptor),
+    without signature.
+    """
+    x_edges = np.unique( np.around( np.concatenate( (grid_cache.xmin, grid_cache.xmax) ), decimals) )
+    # y edges from top to bottom
+    y_edges = np.unique( np.around( np.concatenate( (grid_cache.ymin, grid_cache.ymax) ), decimals) )[::-1]
+
+    if grid_cache.fids.size == 0 :
+        return( { 'nrow':0, 'ncol':0, 'xoff':0., 'yoff':0., 'delr':np.array([]),
+            'delc':np.array([]), 'fids':grid_cache.fids, 'regular':False } )
+
+    # cell centers lie strictly between edges
+    col = np.searchsorted(x_edges, grid_cache.cx) - 1
+    row = np.searchsorted(-y_edges, -grid_cache.cy) - 1
+    order = np.lexsort( (col, row) )
+
+    return( { 'nrow':y_edges.size - 1, 'ncol':x_edges.size - 1,
+        'xoff':float(x_edges[0]), 'yoff':float(y_edges[0]),
+        'delr':np.diff(x_edges), 'delc':-np.diff(y_edges),
+        'fids':grid_cache.fids[order],
+        'regular':check_rgrid_regularity(grid_cache, x_edges, y_edges, row, col) } )
+
+
+def check_rgrid_regularity(grid_cache, x_edges, y_edges, row, col, tol = TOLERANCE):
+    """
+    Description
+    ----------
+    Checks that cells of grid_cache form a structured grid over x_edges
+    (increasing) and y_edges (decreasing) : the number of cells equals
+    nrow*ncol, each (row, col) is occupied by exactly one cell, and the
+    bounds of each cell match the band of its row and column.
+    Vectorized, O(n log n) with n the number of cells.
+
+    Parameters
+    ----------
+    grid_cache : GridCache of the grid layer
+    x_edges, y_edges : unique snapped edges
+    row, col : row and column of each cell of grid_cache, from its center
+    tol : absolute tolerance on cell bounds
+
+    Returns
+    -------
+    True if the grid is structured, False otherwise
+
+    Examples
+    --------
+    >>> regular = check_rgrid_regularity(grid_cache, x_edges, y_edges, row, col)
+    """
+    nrow, ncol = y_edges.size - 1, x_edges.size - 1
+
+    # number of cells
+    if nrow*ncol != grid_cache.fids.size :
+        return(False)
+
+    # one cell per (row, col)
+    if np.any( np.bincount( row*ncol + col, minlength = nrow*ncol ) != 1 ) :
+        return(False)
+
+    # cell bounds match their row and column bands
+    return( bool(
+        np.all( np.abs(grid_cache.xmin - x_edges[col]) <= tol ) and
+        np.all( np.abs(grid_cache.xmax - x_edges[col+1]) <= tol ) and
+        np.all( np.abs(grid_cache.ymax - y_edges[row]) <= tol ) and
+        np.all( np.abs(grid_cache.ymin - y_edges[row+1]) <= tol ) ) )
+
+
+def is_rgrid(grid_layer):
+    """
+    Description
+    ----------
+    Checks whether grid_layer is a structured (modflow-like) grid,
+    see check_rgrid_regularity. The check is run once and kept with
+    the grid descriptor until the grid changes.
+
+    Examples
+    --------
+    >>> if not is_rgrid(grid_layer) :
+    ...     print("The grid layer is not regular")
+    """
+    return( get_rgrid_descriptor(grid_layer)['regular'] )
+
+
+def grid_signature(grid_layer):
+    """
+    Description
+    ----------
+    Cheap signature of the grid, used to validate persisted descriptors
+    without reading the cells :
+    [feature count, xmin, ymin, xmax, ymax, source path, file mtime, file size]
+    The last three items are None for layers which are not file-based.
+    Edits which do not change this metadata are not detected, see
+    check_rgrid_descriptor for a full check.
+    """
+    extent = grid_layer.extent()
+    bounds = [ round(value, MAX_DECIMALS) + 0. for value in ( extent.xMinimum(), extent.yMinimum(),
+        extent.xMaximum(), extent.yMaximum() ) ] if grid_layer.featureCount() > 0 else [0., 0., 0., 0.]
+    path = _grid_source_path(grid_layer)
+    if path is not None :
+        stat = os.stat(path)
+        source = [ os.path.abspath(path), stat.st_mtime, stat.st_size ]
+    else :
+        source = [ None, None, None ]
+    return( [ int( grid_layer.featureCount() ) ] + bounds + source )
+
+
+def check_rgrid_descriptor(grid_layer, tol = TOLERANCE):
+    """
+    Description
+    ----------
+    Full check of the descriptor persisted by write_rgrid_descriptor against
+    the cells of grid_layer : the descriptor is computed again from the cell
+    bounds and compared. This reads all the geometries, so it is only run
+    on request. A stale descriptor is dropped from memory.
+
+    Returns
+    -------
+    True if the persisted descriptor matches the grid, False otherwise
+    (or if there is no persisted descriptor)
+
+    Examples
+    --------
+    >>> if not check_rgrid_descriptor(grid_layer) :
+    ...     write_rgrid_descriptor(grid_layer, get_rgrid_descriptor(grid_layer))
+    """
+    persisted = read_rgrid_descriptor(grid_layer)
+    if persisted is None :
+        return(False)
+
+    descriptor = compute_rgrid_descriptor( get_grid_cache(grid_layer) )
+    valid = descriptor['nrow'] == persisted['nrow'] and descriptor['ncol'] == persisted['ncol'] \
+            and descriptor['regular'] == persisted['regular'] \
+            and np.array_equal(descriptor['fids'], persisted['fids']) \
+            and np.allclose(descriptor['delr'], persisted['delr'], atol = tol) \
+            and np.allclose(descriptor['delc'], persisted['delc'], atol = tol) \
+            and abs(descriptor['xoff'] - persisted['xoff']) <= tol \
+            and abs(descriptor['yoff'] - persisted['yoff']) <= tol
+
+    if not valid :
+        _RGRID_DESCRIPTORS.pop(grid_layer.id(), None)
+    return(valid)
+
+
+def make_rgrid_descriptor(input_feat, n, m, grid_layer):
+    """
+    Description
+    ----------
+    Descriptor of a grid layer freshly written by make_rgrid (see
+    get_rgrid_descriptor), built from the parameters of make_rgrid instead
+    of the cell geometries : only feature ids are read.
+    Features are expected in the order they were written, with increasing
+    ids (as for Shapefile, GeoPackage or FlatGeobuf sources).
+
+    Parameters
+    ----------
+    input_feat, n, m : parameters passed to make_rgrid
+    grid_layer : the layer the grid was written to
+
+    Returns
+    -------
+    The descriptor, None if the number of features does not match n*m
+
+    Examples
+    --------
+    >>> write_rgrid_descriptor(grid_layer, make_rgrid_descriptor(rectFeat, n, m, grid_layer))
+    """
+    request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry).setNoAttributes()
+    fids = np.sort( np.array( [ feat.id() for feat in grid_layer.getFeatures(request) ], dtype=np.int64 ) )
+    if fids.size != n*m :
+        return(None)
+
+    # same edges as iter_rgrid_features, rows are written from bottom to top
+    bbox = input_feat.geometry().boundingBox()
+    x_edges = np.around( np.linspace(bbox.xMinimum(), bbox.xMaximum(), m+1), MAX_DECIMALS )
+    y_edges = np.around( np.linspace(bbox.yMinimum(), bbox.yMaximum(), n+1), MAX_DECIMALS )[::-1]
+
+    return( { 'nrow':n, 'ncol':m, 'xoff':float(x_edges[0]), 'yoff':float(y_edges[0]),
+        'delr':np.diff(x_edges), 'delc':-np.diff(y_edges),
+        'fids':fids.reshape(n, m)[::-1].ravel(), 'regular':True,
+        'signature':grid_signature(grid_layer) } )
+
+
+def _grid_source_path(grid_layer):
+    """ Path of the source file of grid_layer, None if not file-based """
+    path = grid_layer.source().split('|')[0]
+    return( path if os.path.isfile(path) else None )
+
+
+def _grid_sidecar_path(grid_layer):
+    """ Path of the sidecar file holding the cell permutation, None if not file-based """
+    path = _grid_source_path(grid_layer)
+    if path is None :
+        return(None)
+    # layers of multi-layer sources (e.g. GeoPackage) get their own sidecar
+    suffix = ''
+    for option in grid_layer.source().split('|')[1:] :
+        if option.startswith('layername=') :
+            suffix = '_' + option[len('layername='):]
+    return( os.path.splitext(path)[0] + suffix + '.qgridder.npz' )
+
+
+def write_rgrid_descriptor(grid_layer, descriptor):
+    """
+    Description
+    ----------
+    Persists descriptor : dimensions, edges and signature are stored in a layer
+    custom property (saved with the project), the permutation of feature ids
+    in a .qgridder.npz sidecar file next to the layer source.
+    Nothing is persisted for layers which are not file-based.
+    Only called on request (e.g. when a new grid is loaded), since the custom
+    property modifies the project.
+
+    Examples
+    --------
+    >>> write_rgrid_descriptor(grid_layer, get_rgrid_descriptor(grid_layer))
+    """
+    sidecar = _grid_sidecar_path(grid_layer)
+    if sidecar is None :
+        return(False)
+
+    signature = json.dumps( descriptor['signature'] )
+    try :
+        np.savez(sidecar, fids = descriptor['fids'], signature = np.array(signature) )
+    except (IOError, OSError) :
+        print('Could not write grid descriptor to ' + sidecar)
+        return(False)
+
+    grid_layer.setCustomProperty( RGRID_DESCRIPTOR_PROPERTY, json.dumps( {
+        'nrow':int(descriptor['nrow']), 'ncol':int(descriptor['ncol']),
+        'xoff':descriptor['xoff'], 'yoff':descriptor['yoff'],
+        'delr':descriptor['delr'].tolist(), 'delc':descriptor['delc'].tolist(),
+        'regular':bool(descriptor['regular']), 'signature':descriptor['signature'] } ) )
+
+    return(True)
+
+
+def read_rgrid_descriptor(grid_layer, signature = None):
+    """
+    Description
+    ----------
+    Reads the descriptor persisted by write_rgrid_descriptor.
+    Returns None if there is none or if it does not match the current grid signature.
+    """
+    value = grid_layer.customProperty(RGRID_DESCRIPTOR_PROPERTY)
+    sidecar = _grid_sidecar_path(grid_layer)
+    if not value or sidecar is None or not os.path.isfile(sidecar) :
+        return(None)
+
+    if signature is None :
+        signature = grid_signature(grid_layer)
+
+    try :
+        descriptor = json.loads(value)
+        with np.load(sidecar) as data :
+            fids = data['fids']
+            sidecar_signature = json.loads( str(data['signature']) )
+    except (IOError, OSError, ValueError, KeyError) :
+        return(None)
+
+    if descriptor.get('signature') != signature or sidecar_signature != signature \
+            or 'regular' not in descriptor :
+        return(None)
+
+    descriptor['delr'] = np.array(descriptor['delr'], dtype=np.float64)
+    descriptor['delc'] = np.array(descriptor['delc'], dtype=np.float64)
+    descriptor['fids'] = fids
+
+    return(descriptor)
+
+
 # -----------------------------------------------------
 # get centroids of a grid layer
 def get_centroid_layer(grid_layer) :
@@ -775,42 +1511,10 @@ def get_rgrid_nrow_ncol(grid_layer):
     >>> nrow, ncol = get_rgrid_nrow_ncol(layer)
     """
 
-    # TODO : check if the grid is actually regular
-
-    # Init variables
-    all_features = {feat.id():feat for feat in grid_layer.getFeatures()}
-    allCentroids = [feat.geometry().centroid().asPoint() \
-                        for feat in all_features.values()]
-    centroids_ids = list(all_features.keys())
-    centroids_x = [centroid.x() for centroid in allCentroids]
-    centroids_y = [centroid.y() for centroid in allCentroids]
-    centroids = np.array( [centroids_ids , centroids_x, centroids_y] )
-    centroids = centroids.T
-
-    # get ncol :
-    # sort by decreasing y and increasing x
-    idx_row = np.lexsort([centroids[:,1],-centroids[:,2]])
-    yy = centroids[idx_row,2]
-    # iterate along first row and count number of items with same y
-    i=0
-    #return yy
-    while is_equal(yy[i],yy[i+1]):
-        i+=1
-        if i >= (yy.size - 1):
-            break # for one-row grids
-    ncol = i+1
-
-    # get nrow :
-    # sort by increasing x and decreasing y
-    idx_col = np.lexsort([-centroids[:,2],centroids[:,1]])
-    xx=centroids[idx_col,1]
-    # iterate over first col and count number of items with same x
-    i=0
-    while is_equal(xx[i],xx[i+1]) :
-        i+=1
-        if i >= (xx.size-1):
-            break # for one-column grids
-    nrow = i+1
+    descriptor = get_rgrid_descriptor(grid_layer)
+    if not descriptor['regular'] :
+        print("Grid layer " + grid_layer.name() + " is not a structured grid.")
+    nrow, ncol = descriptor['nrow'], descriptor['ncol']
 
     # return nrow, ncol
     return(nrow, ncol)
@@ -839,51 +1543,14 @@ def get_rgrid_delr_delc(grid_layer):
     """
 
 
-    # TODO : check if the grid is actually regular
-
-    # Load layer
-    #allAttrs = grid_layer.pendingAllAttributesList()
-    #grid_layer.select(allAttrs)
-    #grid_layer.dataProvider().select(allAttrs)
-
-    # Init variables
-    all_features = {feat.id():feat for feat in grid_layer.getFeatures()}
-    allCentroids = [feat.geometry().centroid().asPoint() \
-                        for feat in all_features.values()]
-    centroids_ids = list(all_features.keys())
-    centroids_x = [centroid.x() for centroid in allCentroids]
-    centroids_y = [centroid.y() for centroid in allCentroids]
-    centroids = np.array( [centroids_ids , centroids_x, centroids_y] )
-    centroids = centroids.T
-
-    # get nrow, ncol
-    nrow, ncol =  get_rgrid_nrow_ncol(grid_layer)
-
-    # init list
-    delr = []
-    delc = []
-
-    # sort by decreasing y and increasing x
-    idx_row = np.lexsort([centroids[:,1],-centroids[:,2]])
-    # iterate along first row
-    for featId in centroids[idx_row,0][:ncol]:
-        # Extract the four corners of feat
-        # Note : rectangle points are numbered from top-left to bottom-left, clockwise
-        p0, p1, p2, p3 = ftools_utils.extractPoints(all_features[featId].geometry())[:4]
-        delr.append( p1.x() - p0.x() )
-
-    # sort by increasing x and decreasing y
-    idx_col = np.lexsort([-centroids[:,2],centroids[:,1]])
-    # iterate along first col
-    for featId in centroids[idx_col,0][:nrow]:
-        # Extract the four corners of feat
-        # Note : rectangle points are numbered from top-left to bottom-left, clockwise
-        p0, p1, p2, p3 = ftools_utils.extractPoints(all_features[featId].geometry())[:4]
-        delc.append( p0.y() - p3.y() )
+    descriptor = get_rgrid_descriptor(grid_layer)
+    if not descriptor['regular'] :
+        print("Grid layer " + grid_layer.name() + " is not a structured grid.")
+    delr, delc = descriptor['delr'], descriptor['delc']
 
     # round
-    delr = [round(val, MAX_DECIMALS) for val in delr]
-    delc = [round(val, MAX_DECIMALS) for val in delc]
+    delr = [round(float(val), MAX_DECIMALS) for val in delr]
+    delc = [round(float(val), MAX_DECIMALS) for val in delc]
 
     # If all values are identical, return scalar
     if delr.count(delr[0]) == len(delr):
@@ -899,105 +1566,293 @@ def rgrid_numbering(grid_layer):
     """
     Description
     ----------
-    Adds attributes NROW, NCOL to a regular (modflow) grid layer
+    Adds attributes ROW, COL (0-based, row 0 at the top) and cell centers CX, CY
+    to a regular (modflow) grid layer.
+    Numbering is computed from the grid descriptor and compared with the
+    stored values : only cells with missing or outdated values are written,
+    by chunks, through the data provider. Nothing is written if the stored
+    numbering is up to date.
 
     Parameters
     ----------
-    p1 : parameter 1
+    grid_layer : the structured grid layer
 
     Returns
     -------
-
-    out1 : output1
+    True if successful, False otherwise
 
     Examples
     --------
-    >>>
+    >>> res = rgrid_numbering(grid_layer)
     """
 
-    # TODO : check if the grid is actually regular
-
-    caps = grid_layer.dataProvider().capabilities()
+    # check that the grid is actually regular
+    if not is_rgrid(grid_layer) :
+        print("Grid layer " + grid_layer.name() + " is not a structured grid.")
+        return(False)
 
-    # Init variables
-    res = 1
-    all_features = {feat.id():feat for feat in grid_layer.getFeatures()}
-    allCentroids = [feat.geometry().centroid().asPoint() \
-                        for feat in all_features.values()]
-    centroids_ids = list(all_features.keys())
-    centroids_x = np.around(np.array([centroid.x() for centroid in allCentroids]), MAX_DECIMALS)
-    centroids_y = np.around(np.array([centroid.y() for centroid in allCentroids]), MAX_DECIMALS)
-    centroids = np.array( [centroids_ids , centroids_x, centroids_y] )
-    centroids = centroids.T
+    provider = grid_layer.dataProvider()
+    caps = provider.capabilities()
 
-    # Fetch field name index of ROW and COL
+    # Fetch field name index of ROW, COL, CX and CY
     # If columns don't exist, add them
-    row_field_idx = grid_layer.dataProvider().fieldNameIndex('ROW')
-    col_field_idx = grid_layer.dataProvider().fieldNameIndex('COL')
-    cx_field_idx = grid_layer.dataProvider().fieldNameIndex('CX')
-    cy_field_idx = grid_layer.dataProvider().fieldNameIndex('CY')
-
-    if row_field_idx == -1:
-        if caps & QgsVectorDataProvider.AddAttributes:
-          res = grid_layer.dataProvider().addAttributes(  [QgsField("ROW", QVariant.Int)] )
-
-    if col_field_idx == -1:
-        if caps & QgsVectorDataProvider.AddAttributes:
-          res = res*grid_layer.dataProvider().addAttributes( [QgsField("COL", QVariant.Int)] )
-
-    if cx_field_idx == -1:
-        if caps & QgsVectorDataProvider.AddAttributes:
-          res = grid_layer.dataProvider().addAttributes(  [QgsField("CX", QVariant.Double)] )
-
-    if cy_field_idx == -1:
-        if caps & QgsVectorDataProvider.AddAttributes:
-          res = res*grid_layer.dataProvider().addAttributes( [QgsField("CY", QVariant.Double)] )
-
-    row_field_idx = grid_layer.dataProvider().fieldNameIndex('ROW')
-    col_field_idx = grid_layer.dataProvider().fieldNameIndex('COL')
-    cx_field_idx = grid_layer.dataProvider().fieldNameIndex('CX')
-    cy_field_idx = grid_layer.dataProvider().fieldNameIndex('CY')
-
-    # update fields
-    grid_layer.updateFields()
-
-    # get nrow, ncol
-    nrow, ncol =  get_rgrid_nrow_ncol(grid_layer)
-
-    # Iterate over grid row-wise and column wise
-    # sort by decreasing y and increasing x
-    idx = np.lexsort( [centroids_x,-1*centroids_y] )
-    centroids = centroids[idx,:]
-    row = 0 # 0-based
-    col = 0 # 0-based
-
-    # start editing
-    grid_layer.startEditing()
-
-    attrValues = {}
-
-    for i in range(centroids.shape[0]):
-        if col > ncol - 1:
-            col = 0
-            row = row + 1
-        featId = centroids[i, 0]
-        cx = centroids[i, 1]
-        cy = centroids[i, 2]
-        attr = { row_field_idx : int(row), col_field_idx : int(col),\
-                cx_field_idx : float(cx), cy_field_idx : float(cy)}
-        attrValues[featId] = attr
-        col+=1
-
-    # write attributes to shapefile
-    res = grid_layer.dataProvider().changeAttributeValues(attrValues)
-
-    # commit
-    grid_layer.commitChanges()
+    new_fields = [ QgsField(name, field_type) for name, field_type in
+            [('ROW', QVariant.Int), ('COL', QVariant.Int), ('CX', QVariant.Double), ('CY', QVariant.Double)]
+            if provider.fieldNameIndex(name) == -1 ]
+
+    if len(new_fields) > 0 :
+        if not caps & QgsVectorDataProvider.AddAttributes :
+            print("Attributes cannot be added to layer " + grid_layer.name() + ".")
+            return(False)
+        if not provider.addAttributes(new_fields) :
+            return(False)
+        # update fields
+        grid_layer.updateFields()
+
+    field_idx = [ provider.fieldNameIndex(name) for name in ('ROW', 'COL', 'CX', 'CY') ]
+
+    # numbering from the descriptor, in row-major order
+    descriptor = get_rgrid_descriptor(grid_layer)
+    nrow, ncol = descriptor['nrow'], descriptor['ncol']
+    x_edges = descriptor['xoff'] + np.concatenate( ([0.], np.cumsum(descriptor['delr'])) )
+    y_edges = descriptor['yoff'] - np.concatenate( ([0.], np.cumsum(descriptor['delc'])) )
+    fids = descriptor['fids']
+    rows, cols = np.divmod( np.arange(nrow*ncol), ncol )
+    cx = np.around( 0.5*(x_edges[:-1] + x_edges[1:]), MAX_DECIMALS )[cols]
+    cy = np.around( 0.5*(y_edges[:-1] + y_edges[1:]), MAX_DECIMALS )[rows]
+
+    # stored numbering, in the same order (NULL values are read as nan)
+    request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry).setSubsetOfAttributes(field_idx)
+    stored = { feat.id():[ feat[idx] for idx in field_idx ] for feat in grid_layer.getFeatures(request) }
+    stored = np.array( [ [ np.nan if val is None or val == NULL else float(val)
+        for val in stored[fid] ] for fid in fids.tolist() ], dtype=np.float64 ).reshape(-1, 4)
+
+    # cells with missing or outdated numbering
+    outdated = ~( (stored[:,0] == rows) & (stored[:,1] == cols) &
+            (np.abs(stored[:,2] - cx) <= 10.**-MAX_DECIMALS) &
+            (np.abs(stored[:,3] - cy) <= 10.**-MAX_DECIMALS) )
+
+    if not np.any(outdated) :
+        return(True)
+
+    attr_map = { fid:{ field_idx[0]:row, field_idx[1]:col, field_idx[2]:x, field_idx[3]:y }
+            for fid, row, col, x, y in zip( fids[outdated].tolist(), rows[outdated].tolist(),
+                cols[outdated].tolist(), cx[outdated].tolist(), cy[outdated].tolist() ) }
+
+    # write attributes by batches
+    res = change_attribute_values(grid_layer, attr_map)
 
     # res should be True if the operation is successful
     return(res)
 
 
+# ======================================================================================
+def change_attribute_values(grid_layer, attr_map, chunk_size = BATCH_SIZE):
+    """
+    Description
+    ----------
+    Writes attribute values to grid_layer through its data provider, by chunks of
+    chunk_size features. With the OGR provider, each chunk is written within
+    a single transaction (GeoPackage), instead of one update per feature.
+
+    Parameters
+    ----------
+    grid_layer : Qgis vector layer
+    attr_map : dictionary { featId : { field_idx : value, ... }, ... }
+    chunk_size : number of features updated per provider call
+
+    Returns
+    -------
+
+    True if the operation is successful, False otherwise.
+
+    Examples
+    --------
+    >>> res = change_attribute_values(grid_layer, { 12 : { 0 : 1.5 } })
+    """
+    provider = grid_layer.dataProvider()
+
+    if not provider.capabilities() & QgsVectorDataProvider.ChangeAttributeValues :
+        print("Attribute values of layer " + grid_layer.name() + " cannot be changed.")
+        return(False)
+
+    res = True
+    fIds = list(attr_map.keys())
+    for i in range(0, len(fIds), chunk_size):
+        chunk = { int(fId) : attr_map[fId] for fId in fIds[i:i + chunk_size] }
+        res = provider.changeAttributeValues(chunk) and res
+
+    return(res)
+
+
+# ======================================================================================
+def get_field_arrays(v_layer, field_names, feature_ids = None):
+    """
+    Description
+    ----------
+    Columnar attribute reader : fetches the fields field_names of v_layer
+    in a single pass, without geometries, and returns typed NumPy arrays.
+    Integer and real fields are returned as int64 and float64 arrays,
+    NULL values being replaced by nan (integer fields with NULL values are then
+    returned as float64). Other fields are returned as object arrays, with None for NULL.
+    For OGR layers with numeric fields only, the Arrow stream of GDAL (>= 3.6)
+    is used when available.
+
+    Parameters
+    ----------
+    v_layer : Qgis vector layer
+    field_names : list of field names
+    feature_ids (optional) : ids of the features to read, all features if None
+
+    Returns
+    -------
+    (fids, values) where fids is the array of feature ids and values a
+    dictionary { field_name : array aligned with fids }, False if a field is missing
+
+    Examples
+    --------
+    >>> fids, values = get_field_arrays(grid_layer, ['ROW', 'COL', 'IBOUND'])
+    """
+    fields = v_layer.fields()
+    field_idx = [ fields.indexFromName(name) for name in field_names ]
+    for name, idx in zip(field_names, field_idx):
+        if idx == -1 :
+            print("Field " + name + " not found in layer " + v_layer.name() + ".")
+            return(False)
+    dtypes = [ _field_dtype( fields.field(idx) ) for idx in field_idx ]
+
+    # OGR Arrow stream, for whole, unedited layers and numeric fields
+    if feature_ids is None and object not in dtypes :
+        res = _get_field_arrays_ogr(v_layer, field_names, dtypes)
+        if res is not None :
+            return(res)
+
+    request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry).setSubsetOfAttributes(field_idx)
+    if feature_ids is not None :
+        request.setFilterFids( [ int(fid) for fid in feature_ids ] )
+
+    fids = []
+    columns = [ [] for idx in field_idx ]
+    for feat in v_layer.getFeatures(request):
+        fids.append( feat.id() )
+        attrs = feat.attributes()
+        for column, idx in zip(columns, field_idx):
+            column.append( attrs[idx] )
+
+    values = {}
+    for name, column, dtype in zip(field_names, columns, dtypes):
+        if dtype is object :
+            values[name] = np.array( [ None if val == NULL else val for val in column ], dtype=object )
+            continue
+        is_null = np.array( [ val is None or val == NULL for val in column ], dtype=bool )
+        if np.any(is_null) :
+            values[name] = np.array( [ np.nan if null else val for val, null in zip(column, is_null) ],
+                    dtype=np.float64 )
+        else :
+            values[name] = np.array(column, dtype=dtype)
+
+    return( np.array(fids, dtype=np.int64), values )
+
+
+def _field_dtype(field):
+    """ NumPy dtype of a QgsField """
+    if field.type() in (QVariant.Int, QVariant.UInt, QVariant.LongLong, QVariant.ULongLong) :
+        return(np.int64)
+    if field.type() == QVariant.Double :
+        return(np.float64)
+    return(object)
+
+
+def _get_field_arrays_ogr(v_layer, field_names, dtypes):
+    """
+    Description
+    ----------
+    Reads fields field_names of an OGR layer with ogr.Layer.GetArrowStreamAsNumPy.
+    Arrow types (e.g. int32, float32) are converted to dtypes (see _field_dtype),
+    as returned by get_field_arrays.
+    Returns None if GDAL or the Arrow interface is not available, or if the layer
+    is not a plain OGR source (edit buffer, subset string), so that the caller
+    falls back to QgsFeatureRequest.
+    """
+    if v_layer.providerType() != 'ogr' or v_layer.isEditable() or v_layer.subsetString() != '' :
+        return(None)
+    try :
+        from osgeo import ogr
+    except ImportError :
+        return(None)
+
+    parts = v_layer.source().split('|')
+    ds = ogr.Open(parts[0])
+    if ds is None :
+        return(None)
+    lyr = None
+    for option in parts[1:] :
+        if option.startswith('layername=') :
+            lyr = ds.GetLayerByName( option[len('layername='):] )
+        elif option.startswith('layerid=') :
+            lyr = ds.GetLayer( int(option[len('layerid='):]) )
+    if lyr is None :
+        lyr = ds.GetLayer(0)
+    if lyr is None or not hasattr(lyr, 'GetArrowStreamAsNumPy') :
+        return(None)
+
+    # skip geometry and other fields
+    layer_defn = lyr.GetLayerDefn()
+    ignored = [ layer_defn.GetFieldDefn(i).GetName() for i in range(layer_defn.GetFieldCount())
+            if layer_defn.GetFieldDefn(i).GetName() not in field_names ]
+    lyr.SetIgnoredFields( ignored + ['OGR_GEOMETRY'] )
+    fid_name = lyr.GetFIDColumn() or 'OGC_FID'
+
+    try :
+        stream = lyr.GetArrowStreamAsNumPy( options = ['INCLUDE_FID=YES'], use_masked_arrays = True )
+        batches = list(stream)
+    except Exception :
+        return(None)
+
+    fids = np.concatenate( [ np.asarray(batch[fid_name], dtype=np.int64) for batch in batches ] ) \
+            if len(batches) > 0 else np.array([], dtype=np.int64)
+    values = {}
+    for name, dtype in zip(field_names, dtypes) :
+        column = np.ma.concatenate( [ batch[name] for batch in batches ] ) \
+                if len(batches) > 0 else np.ma.array([], dtype=dtype)
+        if np.ma.is_masked(column) :
+            values[name] = np.ma.filled( column.astype(np.float64), np.nan )
+        else :
+            values[name] = np.ma.getdata(column).astype(dtype)
+
+    return(fids, values)
+
+
+# ======================================================================================
+def rgrid_array(grid_layer, fids, values):
+    """
+    Description
+    ----------
+    Reshapes values, aligned with feature ids fids, to a (nrow, ncol) array
+    following the row-major permutation of the grid descriptor.
+
+    Parameters
+    ----------
+    grid_layer : the structured grid layer
+    fids : array of feature ids
+    values : array of values, aligned with fids
+
+    Returns
+    -------
+    (nrow, ncol) array
+
+    Examples
+    --------
+    >>> fids, values = get_field_arrays(grid_layer, ['IBOUND'])
+    >>> ibound = rgrid_array(grid_layer, fids, values['IBOUND'])
+    """
+    descriptor = get_rgrid_descriptor(grid_layer)
+    fids = np.asarray(fids, dtype=np.int64)
+    sorter = np.argsort(fids)
+    idx = sorter[ np.searchsorted(fids, descriptor['fids'], sorter=sorter) ]
+    return( np.asarray(values)[idx].reshape(descriptor['nrow'], descriptor['ncol']) )
+
+
 # ======================================================================================
 def get_overlapping_features_areas(feat, spatialIndex, grid_layerFeatures) :
     """
@@ -1042,6 +1897,48 @@ def get_overlapping_features_areas(feat, spatialIndex, grid_layerFeatures) :
 
 
 
+# ======================================================================================
+class GridIndex(object):
+    """
+    Spatial index and feature dictionary of a grid layer, built once
+    and updated incrementally when cells are deleted or added, so that
+    the cost of an update depends on the number of changed cells only.
+
+    Examples
+    --------
+    >>> grid_index = GridIndex(grid_layer)
+    >>> newFeatIds = split_cells(fix_dict, grid_layer, grid_index)
+    >>> neighborsId = grid_index.index.intersects(bbox)
+    """
+
+    def __init__(self, grid_layer):
+        self.grid_layer = grid_layer
+        # { id : feature }
+        self.features = {feat.id():feat for feat in grid_layer.getFeatures()}
+        # QgsSpatialIndex
+        self.index = QgsSpatialIndex()
+        for feat in self.features.values() :
+            self.index.addFeature(feat)
+
+    def remove(self, fIds):
+        """ Removes features fIds from the index """
+        for fId in fIds :
+            feat = self.features.pop(fId, None)
+            if feat is not None :
+                self.index.deleteFeature(feat)
+
+    def add(self, fIds):
+        """ Fetches features fIds from grid_layer and adds them to the index """
+        request = QgsFeatureRequest().setFilterFids( list(fIds) )
+        for feat in self.grid_layer.getFeatures(request) :
+            self.features[feat.id()] = feat
+            self.index.addFeature(feat)
+
+    def intersects(self, rect):
+        """ Ids of features whose bounding box intersects rect """
+        return( self.index.intersects(rect) )
+
+
 # ======================================================================================
 def get_spatial_indexes(all_layers) :
     """
@@ -1091,17 +1988,15 @@ def correct_pseudo3D_grid(all_layers, topo_rules, nproc=1) :
     """
 
     nLayers = len(all_layers)
+    # spatial indexes and feature dictionaries, updated after each refinement
+    grid_indexes = [ GridIndex(grid_layer) for grid_layer in all_layers ]
+    all_layers_all_features = [ grid_index.features for grid_index in grid_indexes ]
+    spatial_indexes = [ grid_index.index for grid_index in grid_indexes ]
     nfix = 1
     while nfix > 0 :
         nfix = 0
         # iterate over each layers of the pseudo-3D mesh
         for layer_num in range(nLayers) :
-            # build list of dictionaries of all features for each layer
-            all_layers_all_features = []
-            for grid_layer in all_layers :
-                all_layers_all_features.append ( {feat.id():feat for feat in grid_layer.getFeatures() } )
-            # update spatial indexes
-            spatial_indexes = get_spatial_indexes(all_layers)
             # iterate over each cells of layer layer_num
             if nproc <= 1 :
                 fix_dict = check3D_features(all_layers_all_features[layer_num].values(),
@@ -1134,18 +2029,19 @@ def correct_pseudo3D_grid(all_layers, topo_rules, nproc=1) :
                 # Get process results from the output queue
                 fix_dicts = [output.get() for p in processes]
 
-                # Build single FixDict
-                fix_dict = { 'id':[NULL] , 'n':[NULL], 'm':[NULL] }
+                # Build single FixSet
+                fix_dict = FixSet()
                 for fix_dict_partial in fix_dicts :
-                    update_fix_dict( fix_dict_main, fix_dict_partial )
+                    fix_dict.merge( fix_dict_partial )
 
 
             # split cells
-            if len(fix_dict['id']) > 0 :
+            if len(fix_dict) > 0 :
                 refine_by_split(fix_dict['id'], 2, 2,
                         topo_rules, all_layers[layer_num],
+                        grid_index = grid_indexes[layer_num]
                         )
-            nfix += len(fix_dict['id'])
+            nfix += len(fix_dict)
 
 
 
@@ -1170,13 +2066,13 @@ def check3D_features(features, layer_num, all_layers_all_features, spatial_index
     topo_rules : dictionary describing the rules : {'model':'modflow','nmax':1, 'pmax':4}
     Returns
     -------
-    Result is in fix_dict
+    Result is in fix_dict (FixSet)
     Examples
     --------
     >>> fix_dict = check3D_features(features, layer_num, all_layers, spatial_indexes, topo_rules)
     """
-    # initialize fix_dict, dictionary of features to fix
-    fix_dict = { 'id':[] , 'n':[], 'm':[] }
+    # initialize fix_dict, set of features to fix
+    fix_dict = FixSet()
     nLayers = len(all_layers_all_features)
     # iterate over features
     for feat in features :
@@ -1197,7 +2093,7 @@ def check3D_features(features, layer_num, all_layers_all_features, spatial_index
             if p > 0 :
                 neighbors_tot_areas = np.sum( overlapping_cells_areas )
                 if p > topo_rules['pmax'] or neighbors_tot_areas < feat_area - TOLERANCE :
-                    fix_dict = update_fix_dict( fix_dict, { 'id':[feat.id()] , 'n':[2], 'm':[2] } )
+                    fix_dict.add( feat.id(), 2, 2 )
                 break # exit this while loop as features have been found below
             # go to layer below
             l = l + 1
@@ -1212,7 +2108,7 @@ def check3D_features(features, layer_num, all_layers_all_features, spatial_index
             if p > 0 :
                 neighbors_tot_areas = np.sum( overlapping_cells_areas )
                 if p > topo_rules['pmax'] or neighbors_tot_areas < feat_area - TOLERANCE :
-                    fix_dict = update_fix_dict( fix_dict, { 'id':[feat.id()] , 'n':[2], 'm':[2] } )
+                    fix_dict.add( feat.id(), 2, 2 )
                 break # exit this while loop as features have been found above
             # go to layer above
             l = l - 1
@@ -52,6 +52,7 @@
 # addShapeToCanvas( QString *file path )
 # getUniqueValues( QgsVectorDataProvider, int *field id )
 # saveDialog( QWidget *parent )
+# getFilterSuffix( QString *name filter )
 # getFieldType( QgsVectorLayer, QgsField.name() )
 # getUniqueValuesCount( QgsVectorLayer, int fieldIndex, bool useSelection ):
 #
@@ -64,6 +65,7 @@ from qgis.core import *
 from qgis.gui import *
 
 import locale
+import re
 
 # For use with memory provider/layer, converts full field type to simple string
 def convertFieldNameType( inName ):
@@ -285,7 +287,9 @@ def saveDialog( parent, filtering="Shapefiles (*.shp *.SHP)"):
     dirName = settings.value( "/UI/lastShapefileDir" )
     encode = settings.value( "/UI/encoding" )
     fileDialog = QgsEncodingFileDialog( parent, "Save output shapefile", dirName, filtering, encode )
-    fileDialog.setDefaultSuffix( "shp" )
+    # default suffix follows the selected filter (e.g. .gpkg for GeoPackage)
+    fileDialog.setDefaultSuffix( getFilterSuffix( fileDialog.selectedNameFilter() ) )
+    fileDialog.filterSelected.connect( lambda nameFilter : fileDialog.setDefaultSuffix( getFilterSuffix( nameFilter ) ) )
     fileDialog.setFileMode( QFileDialog.AnyFile )
     fileDialog.setAcceptMode( QFileDialog.AcceptSave )
     fileDialog.setOption(QFileDialog.DontConfirmOverwrite, False)
@@ -296,6 +300,13 @@ def saveDialog( parent, filtering="Shapefiles (*.shp *.SHP)"):
     else :
        return None, None
 
+# Return the extension of the first pattern of a file dialog name filter, without the dot
+def getFilterSuffix( nameFilter ):
+    match = re.search( r"\*\.(\w+)", nameFilter )
+    if match is None:
+        return "shp"
+    return match.group(1).lower()
+
 # Generate a save file dialog with a dropdown box for choosing encoding style
 # with mode="SingleFile" will allow to select only one file, in other cases - several files
 def openDialog( parent, filtering="Shapefiles (*.shp *.SHP)", dialogMode="SingleFile"):
@@ -387,6 +398,16 @@ def getShapesByGeometryType( baseDir, inShapes, geomType ):
 
   return outShapes
 
+# OGR drivers available for grid output, by file extension
+GRID_DRIVERS = { '.shp':'ESRI Shapefile', '.gpkg':'GPKG', '.fgb':'FlatGeobuf' }
+GRID_FILTERS = "Shapefiles (*.shp *.SHP);;GeoPackage (*.gpkg);;FlatGeobuf (*.fgb)"
+
+# Return the OGR driver name corresponding to the extension of outPath
+def getDriverName( outPath ):
+    import os.path
+    extension = os.path.splitext( outPath )[1].lower()
+    return GRID_DRIVERS.get( extension, 'ESRI Shapefile' )
+
 def getShapefileName( outPath, extension='.shp' ):
     import os.path
     outName=os.path.basename(outPath)
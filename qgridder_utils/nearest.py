@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ qgridder_utils_nearest.py
+                                 Qgridder - A QGIS plugin
+
+ This file gathers the nearest-cell index of grids, used to map points
+ (observations, pilot points) to grid cells.
+
+ Qgridder builds 2D regular and unstructured grids and comes together with
+ pre- and post-processing capabilities for spatially distributed modeling.
+
+                              -------------------
+        begin                : 2013-04-08
+        copyright            : (C) 2013 by Pryet
+        email                : alexandre.pryet@ensegid.fr
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from qgis.core import *
+
+import numpy as np
+
+from .base import get_grid_cache
+
+try :
+    from scipy.spatial import cKDTree
+except ImportError :
+    cKDTree = None
+
+# maximum number of point-cell distances computed at once without scipy
+MAX_DISTANCES = 10**7
+
+# ======================================================================================
+class CellLocator(object):
+    """
+    Nearest-cell index built once from cell centers, answering batched
+    k-nearest and radius queries. Relies on scipy.spatial.cKDTree when
+    available, and falls back to chunked NumPy distance computations otherwise.
+
+    Examples
+    --------
+    >>> locator = get_cell_locator(grid_layer)
+    >>> fids, dist = locator.query(x, y, k = 3)
+    """
+
+    def __init__(self, fids, x, y):
+        self.fids = np.asarray(fids, dtype=np.int64)
+        self.xy = np.column_stack( (np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)) )
+        self.tree = cKDTree(self.xy) if cKDTree is not None else None
+
+    @classmethod
+    def from_layer(cls, grid_layer):
+        """ Nearest-cell index from the cell centers of a grid layer """
+        grid_cache = get_grid_cache(grid_layer)
+        return cls(grid_cache.fids, grid_cache.cx, grid_cache.cy)
+
+    def _points(self, x, y):
+        return np.column_stack( (np.atleast_1d( np.asarray(x, dtype=np.float64) ),
+            np.atleast_1d( np.asarray(y, dtype=np.float64) )) )
+
+    def _chunks(self, npoints):
+        # chunks of points for the NumPy fallback
+        step = max( 1, MAX_DISTANCES // max(self.fids.size, 1) )
+        for start in range(0, npoints, step):
+            yield slice(start, start + step)
+
+    def query(self, x, y, k = 1):
+        """
+        Description
+        ----------
+        k nearest cells of points (x, y)
+
+        Returns
+        -------
+        (fids, dist) arrays of shape (npoints, k), sorted by increasing distance
+
+        Examples
+        --------
+        >>> fids, dist = locator.query(x, y, k = 3)
+        """
+        points = self._points(x, y)
+        k = min( int(k), self.fids.size )
+
+        if self.tree is not None :
+            dist, idx = self.tree.query(points, k = k)
+            return( self.fids[ idx.reshape(-1, k) ], dist.reshape(-1, k) )
+
+        idx = np.zeros( (points.shape[0], k), dtype=np.int64 )
+        dist = np.zeros( (points.shape[0], k) )
+        for sl in self._chunks(points.shape[0]):
+            d = np.hypot( self.xy[None, :, 0] - points[sl, 0, None], self.xy[None, :, 1] - points[sl, 1, None] )
+            part = np.argpartition(d, k - 1, axis=1)[:, :k] if k < self.fids.size else \
+                    np.tile( np.arange(self.fids.size), (d.shape[0], 1) )
+            dpart = np.take_along_axis(d, part, axis=1)
+            order = np.argsort(dpart, axis=1, kind='stable')
+            idx[sl] = np.take_along_axis(part, order, axis=1)
+            dist[sl] = np.take_along_axis(dpart, order, axis=1)
+
+        return( self.fids[idx], dist )
+
+    def query_radius(self, x, y, radius):
+        """
+        Description
+        ----------
+        Cells within distance radius of points (x, y)
+
+        Returns
+        -------
+        (point_idx, fids, dist) flat arrays, sorted by point and increasing distance.
+        point_idx refers to the position of the point in x and y.
+
+        Examples
+        --------
+        >>> point_idx, fids, dist = locator.query_radius(x, y, 100.)
+        """
+        points = self._points(x, y)
+
+        if self.tree is not None :
+            neighbors = self.tree.query_ball_point(points, radius)
+            counts = np.array( [ len(n) for n in neighbors ], dtype=np.int64 )
+            point_idx = np.repeat( np.arange(points.shape[0]), counts )
+            idx = np.concatenate( [ np.asarray(n, dtype=np.int64) for n in neighbors ] ) \
+                    if counts.sum() > 0 else np.array([], dtype=np.int64)
+            dist = np.hypot( self.xy[idx, 0] - points[point_idx, 0], self.xy[idx, 1] - points[point_idx, 1] )
+        else :
+            point_idx, idx, dist = [], [], []
+            for sl in self._chunks(points.shape[0]):
+                d = np.hypot( self.xy[None, :, 0] - points[sl, 0, None], self.xy[None, :, 1] - points[sl, 1, None] )
+                p, i = np.nonzero(d <= radius)
+                point_idx.append(p + sl.start)
+                idx.append(i)
+                dist.append(d[p, i])
+            point_idx, idx, dist = np.concatenate(point_idx), np.concatenate(idx), np.concatenate(dist)
+
+        order = np.lexsort( (dist, point_idx) )
+        return( point_idx[order], self.fids[ idx[order] ], dist[order] )
+
+
+# ======================================================================================
+def get_cell_locator(grid_layer):
+    """
+    Description
+    ----------
+    CellLocator of grid_layer, built on first call and kept with the
+    GridCache of the layer : it is dropped when the grid changes.
+
+    Examples
+    --------
+    >>> fids, dist = get_cell_locator(grid_layer).query(x, y, k = 1)
+    """
+    grid_cache = get_grid_cache(grid_layer)
+    locator = grid_cache.data.get('cell_locator')
+    if locator is None :
+        locator = CellLocator(grid_cache.fids, grid_cache.cx, grid_cache.cy)
+        grid_cache.data['cell_locator'] = locator
+    return(locator)
@@ -0,0 +1,509 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ qgridder_utils_overlay.py
+                                 Qgridder - A QGIS plugin
+
+ This file gathers the overlay of polygons on grids : cells intersected
+ by polygons and areas covered by polygons.
+
+ Qgridder builds 2D regular and unstructured grids and comes together with
+ pre- and post-processing capabilities for spatially distributed modeling.
+
+                              -------------------
+        begin                : 2013-04-08
+        copyright            : (C) 2013 by Pryet
+        email                : alexandre.pryet@ensegid.fr
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from qgis.core import *
+
+import numpy as np
+
+from .base import get_grid_cache, get_grid_spatial_index, connect_dependent_data
+from .traversal import walk_segment
+
+# ======================================================================================
+def polygon_rings(geometry):
+    """
+    Description
+    ----------
+    Rings of a (multi)polygon geometry
+
+    Returns
+    -------
+    List of polygons, each polygon being a list of (nvertices, 2) arrays :
+    the exterior ring followed by the interior rings (holes).
+
+    Examples
+    --------
+    >>> polygons = polygon_rings(polygon.geometry())
+    """
+    if geometry.isMultipart() :
+        polygons = geometry.asMultiPolygon()
+    else :
+        polygons = [ geometry.asPolygon() ]
+    return( [ [ np.array( [ (point.x(), point.y()) for point in ring ], dtype=np.float64 ).reshape(-1, 2)
+        for ring in polygon ] for polygon in polygons ] )
+
+
+def _ring_segments(polygons):
+    """ (start, end) arrays of the segments of all rings """
+    rings = [ ring for polygon in polygons for ring in polygon if ring.shape[0] > 1 ]
+    if len(rings) == 0 :
+        return( np.zeros((0, 2)), np.zeros((0, 2)) )
+    return( np.concatenate( [ ring[:-1] for ring in rings ] ), np.concatenate( [ ring[1:] for ring in rings ] ) )
+
+
+def points_in_polygon(x, y, polygons, max_distances = 10**7):
+    """
+    Description
+    ----------
+    Vectorized point-in-polygon test (even-odd rule over all rings,
+    so that holes are excluded).
+
+    Parameters
+    ----------
+    x, y : arrays of point coordinates
+    polygons : see polygon_rings
+    max_distances : maximum number of point-segment tests computed at once
+
+    Returns
+    -------
+    Boolean array, True for points within the polygon
+
+    Examples
+    --------
+    >>> inside = points_in_polygon(cx, cy, polygon_rings(polygon.geometry()))
+    """
+    x = np.atleast_1d( np.asarray(x, dtype=np.float64) )
+    y = np.atleast_1d( np.asarray(y, dtype=np.float64) )
+    start, end = _ring_segments(polygons)
+    x1, y1, x2, y2 = start[:,0], start[:,1], end[:,0], end[:,1]
+    # horizontal segments never cross the ray
+    slope = np.divide(x2 - x1, y2 - y1, out=np.zeros_like(x1), where=y2 != y1)
+
+    inside = np.zeros(x.size, dtype=bool)
+    step = max( 1, max_distances // max(start.shape[0], 1) )
+    for i in range(0, x.size, step) :
+        px, py = x[i:i+step, None], y[i:i+step, None]
+        crosses = ( (y1 > py) != (y2 > py) ) & ( px < x1 + slope*(py - y1) )
+        inside[i:i+step] = np.count_nonzero(crosses, axis=1) % 2 == 1
+
+    return(inside)
+
+
+# ======================================================================================
+def classify_polygon_cells(polygon_geom, grid_layer):
+    """
+    Description
+    ----------
+    Classifies the cells of grid_layer with respect to polygon_geom without GEOS :
+    cells touched by the polygon boundary are flagged, other cells of the polygon
+    bounding box lie entirely inside or outside the polygon, and are
+    classified by a vectorized point-in-polygon test of their center.
+
+    Parameters
+    ----------
+    polygon_geom : QgsGeometry of the polygon
+    grid_layer : grid layer
+
+    Returns
+    -------
+    (candidates, is_boundary, inside, polygons) : ids of the cells in the polygon
+    bounding box, boolean arrays aligned with candidates, and the polygon rings
+    (see polygon_rings). inside is only meaningful for cells which are not on the boundary.
+
+    Examples
+    --------
+    >>> candidates, is_boundary, inside, polygons = classify_polygon_cells(polygon.geometry(), grid_layer)
+    """
+    grid_cache = get_grid_cache(grid_layer)
+    bbox = polygon_geom.boundingBox()
+    polygons = polygon_rings(polygon_geom)
+
+    # cells in the polygon bounding box
+    in_bbox = (grid_cache.xmin <= bbox.xMaximum()) & (grid_cache.xmax >= bbox.xMinimum()) & \
+            (grid_cache.ymin <= bbox.yMaximum()) & (grid_cache.ymax >= bbox.yMinimum())
+    candidates = grid_cache.fids[in_bbox]
+    if candidates.size == 0 :
+        empty = np.zeros(0, dtype=bool)
+        return(candidates, empty, empty, polygons)
+
+    # cells touched by the boundary, walking along ring segments (see walk_segment)
+    start, end = _ring_segments(polygons)
+    index = get_grid_spatial_index(grid_layer)
+    boundary = [ np.array([], dtype=np.int64) ]
+    for (x0, y0), (x1, y1) in zip(start, end) :
+        boundary.append( walk_segment(x0, y0, x1, y1, grid_cache, index)[0] )
+    is_boundary = np.isin( candidates, np.concatenate(boundary) )
+
+    # inner and outer cells : center in polygon
+    inside = np.zeros(candidates.size, dtype=bool)
+    pos = grid_cache.positions( candidates[~is_boundary] )
+    inside[~is_boundary] = points_in_polygon( grid_cache.cx[pos], grid_cache.cy[pos], polygons )
+
+    return(candidates, is_boundary, inside, polygons)
+
+
+def get_polygon_cells(polygon_geom, grid_layer):
+    """
+    Description
+    ----------
+    Cells of grid_layer intersecting polygon_geom.
+    Only cells around the polygon boundary are tested with GEOS, against the
+    polygon prepared once (QgsGeometryEngine.prepareGeometry). Other cells
+    are classified by classify_polygon_cells.
+
+    Parameters
+    ----------
+    polygon_geom : QgsGeometry of the polygon
+    grid_layer : grid layer
+
+    Returns
+    -------
+    Array of ids of intersected cells, sorted
+
+    Examples
+    --------
+    >>> fids = get_polygon_cells(polygon.geometry(), grid_layer)
+    """
+    grid_cache = get_grid_cache(grid_layer)
+    candidates, is_boundary, inside, polygons = classify_polygon_cells(polygon_geom, grid_layer)
+    if candidates.size == 0 :
+        return(candidates)
+
+    intersected = [ candidates[~is_boundary & inside] ]
+
+    # boundary cells : prepared geometry
+    engine = QgsGeometry.createGeometryEngine( polygon_geom.constGet() )
+    engine.prepareGeometry()
+    pos = grid_cache.positions( candidates[is_boundary] )
+    hits = []
+    for xmin, ymin, xmax, ymax in zip( grid_cache.xmin[pos].tolist(), grid_cache.ymin[pos].tolist(),
+            grid_cache.xmax[pos].tolist(), grid_cache.ymax[pos].tolist() ) :
+        # constGet() points into cell_geom, which must outlive the test
+        cell_geom = QgsGeometry.fromRect( QgsRectangle(xmin, ymin, xmax, ymax) )
+        hits.append( engine.intersects( cell_geom.constGet() ) )
+    intersected.append( candidates[is_boundary][ np.array(hits, dtype=bool) ] )
+
+    return( np.sort( np.concatenate(intersected) ) )
+
+
+# ======================================================================================
+def rect_polygon_areas(polygons, xmin, ymin, xmax, ymax, max_pairs = 10**7):
+    """
+    Description
+    ----------
+    Areas of intersection of axis-aligned rectangles with a polygon, computed
+    with the edge integral of Green's theorem :
+    area = - sum over ring edges of the integral, over the x-range of the rectangle,
+    of ( clamp(y(x), ymin, ymax) - ymin ) dx,
+    signed by the orientation of the ring. Exterior rings are added and holes
+    are subtracted. The clamped integrand is piecewise linear, so that the
+    trapezoidal rule between its breakpoints is exact.
+    Only (rectangle, edge) pairs overlapping along x are computed.
+
+    Parameters
+    ----------
+    polygons : see polygon_rings
+    xmin, ymin, xmax, ymax : arrays of rectangle bounds
+    max_pairs : maximum number of (rectangle, edge) pairs processed at once
+
+    Returns
+    -------
+    Array of areas
+
+    Examples
+    --------
+    >>> areas = rect_polygon_areas(polygon_rings(geom), xmin, ymin, xmax, ymax)
+    """
+    xmin, ymin = np.asarray(xmin, dtype=np.float64), np.asarray(ymin, dtype=np.float64)
+    xmax, ymax = np.asarray(xmax, dtype=np.float64), np.asarray(ymax, dtype=np.float64)
+    areas = np.zeros(xmin.size)
+
+    for polygon in polygons :
+        for k, ring in enumerate(polygon) :
+            if ring.shape[0] < 4 :
+                continue
+            x0, y0 = ring[:-1, 0], ring[:-1, 1]
+            x1, y1 = ring[1:, 0], ring[1:, 1]
+            # ring orientation, +1 for counter-clockwise rings
+            orientation = np.sign( np.sum(x0*y1 - x1*y0) )
+            # exterior ring added, holes subtracted
+            weight = -orientation * (1. if k == 0 else -1.)
+            # non-vertical edges
+            ok = x1 != x0
+            x0, y0, x1, y1 = x0[ok], y0[ok], x1[ok], y1[ok]
+            ex_lo, ex_hi = np.minimum(x0, x1), np.maximum(x0, x1)
+
+            step = max( 1, max_pairs // max(x0.size, 1) )
+            for i in range(0, xmin.size, step) :
+                sl = slice(i, i + step)
+                cell, edge = np.nonzero( (ex_lo[None, :] < xmax[sl, None]) & (ex_hi[None, :] > xmin[sl, None]) )
+                cell_idx = cell + i
+                areas[sl] += weight * np.bincount( cell, minlength = xmin[sl].size,
+                        weights = _clamped_edge_integral( x0[edge], y0[edge], x1[edge], y1[edge],
+                            xmin[cell_idx], ymin[cell_idx], xmax[cell_idx], ymax[cell_idx] ) )
+
+    return(areas)
+
+
+def _clamped_edge_integral(x0, y0, x1, y1, xa, ya, xb, yb):
+    """
+    Signed integral from x0 to x1, restricted to [xa, xb], of clamp(y(x), ya, yb) - ya
+    along the edges (x0, y0)-(x1, y1), vectorized over (edge, rectangle) pairs
+    """
+    lo = np.maximum( np.minimum(x0, x1), xa )
+    hi = np.minimum( np.maximum(x0, x1), xb )
+    slope = (y1 - y0) / (x1 - x0)
+
+    # abscissae where the edge crosses ya and yb, clipped to [lo, hi]
+    with np.errstate(divide='ignore', invalid='ignore') :
+        x_ya = np.where( slope != 0, x0 + (ya - y0) / slope, lo )
+        x_yb = np.where( slope != 0, x0 + (yb - y0) / slope, lo )
+    points = np.sort( np.column_stack( (lo, np.clip(x_ya, lo, hi), np.clip(x_yb, lo, hi), hi) ), axis=1 )
+
+    c = np.clip( y0[:, None] + (points - x0[:, None]) * slope[:, None], ya[:, None], yb[:, None] ) - ya[:, None]
+    integral = np.sum( np.diff(points, axis=1) * 0.5*(c[:, 1:] + c[:, :-1]), axis=1 )
+
+    return( np.sign(x1 - x0) * integral )
+
+
+# ======================================================================================
+def get_coverage_matrix(polygon_layer, grid_layer, id_field_name = None):
+    """
+    Description
+    ----------
+    Sparse (ncells, npolygons) matrix of the areas of grid cells covered by
+    each polygon of polygon_layer (e.g. land-use or geology zones).
+    Cells entirely inside a polygon get their full area, cells around the
+    boundary are clipped exactly (see rect_polygon_areas).
+    The matrix is kept with the GridCache of grid_layer. It is dropped when
+    the grid changes, and when polygons are edited (see connect_dependent_data).
+    Requires scipy.
+
+    Parameters
+    ----------
+    polygon_layer : polygon layer (vector)
+    grid_layer : grid layer (vector)
+    id_field_name (optional) : field of polygon_layer identifying polygons,
+    feature ids are used if None
+
+    Returns
+    -------
+    (matrix, fids, polygon_ids) : scipy.sparse CSR matrix, array of grid feature ids
+    (matrix rows) and list of polygon ids (matrix columns)
+
+    Examples
+    --------
+    >>> matrix, fids, zone_ids = get_coverage_matrix(zones, grid_layer, id_field_name = 'ID')
+    >>> kh = area_weighted_values(matrix, zone_kh)
+    """
+    try :
+        import scipy.sparse as sparse
+    except ImportError :
+        raise ImportError('scipy is required to compute coverage matrices')
+
+    grid_cache = get_grid_cache(grid_layer)
+    key = ( 'coverage', polygon_layer.id(), id_field_name )
+    if key in grid_cache.data :
+        return( grid_cache.data[key] )
+    connect_dependent_data(polygon_layer)
+
+    rows, cols, areas, polygon_ids = [], [], [], []
+    for polygon in polygon_layer.getFeatures() :
+        j = len(polygon_ids)
+        polygon_ids.append( polygon.id() if id_field_name is None else polygon[id_field_name] )
+
+        candidates, is_boundary, inside, polygons = classify_polygon_cells(polygon.geometry(), grid_layer)
+
+        # inner cells
+        pos = grid_cache.positions( candidates[~is_boundary & inside] )
+        rows.append(pos)
+        areas.append( grid_cache.dx[pos] * grid_cache.dy[pos] )
+
+        # boundary cells
+        pos = grid_cache.positions( candidates[is_boundary] )
+        boundary_areas = rect_polygon_areas( polygons, grid_cache.xmin[pos], grid_cache.ymin[pos],
+                grid_cache.xmax[pos], grid_cache.ymax[pos] )
+        covered = boundary_areas > 0
+        rows.append( pos[covered] )
+        areas.append( boundary_areas[covered] )
+
+        cols.append( np.full( rows[-2].size + rows[-1].size, j ) )
+
+    rows = np.concatenate(rows) if len(rows) > 0 else np.array([], dtype=np.int64)
+    cols = np.concatenate(cols) if len(cols) > 0 else np.array([], dtype=np.int64)
+    areas = np.concatenate(areas) if len(areas) > 0 else np.array([])
+    matrix = sparse.csr_matrix( (areas, (rows, cols)), shape = (len(grid_cache), len(polygon_ids)) )
+
+    grid_cache.data[key] = (matrix, grid_cache.fids, polygon_ids)
+    return( grid_cache.data[key] )
+
+
+def area_weighted_values(matrix, values, cell_areas = None):
+    """
+    Description
+    ----------
+    Area-weighted assignment of polygon values to cells, as a sparse
+    matrix-vector product : value of a cell = sum of polygon values weighted by
+    covered areas, divided by the covered area (or by cell_areas, if provided,
+    uncovered parts counting as zero). Cells not covered by any polygon get nan.
+
+    Parameters
+    ----------
+    matrix : coverage matrix, see get_coverage_matrix
+    values : array of polygon values, aligned with matrix columns
+    cell_areas (optional) : array of cell areas, aligned with matrix rows
+
+    Returns
+    -------
+    Array of cell values, aligned with matrix rows
+
+    Examples
+    --------
+    >>> matrix, fids, zone_ids = get_coverage_matrix(zones, grid_layer)
+    >>> recharge = area_weighted_values(matrix, zone_recharge)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    weighted = matrix.dot(values)
+    covered = np.asarray( matrix.sum(axis=1) ).ravel()
+    areas = covered if cell_areas is None else np.asarray(cell_areas, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore') :
+        out = np.where( covered > 0, weighted / areas, np.nan )
+    return(out)
+
+
+# ======================================================================================
+# modes of remap_values
+REMAP_MODES = ['mean', 'harmonic', 'geometric', 'sum']
+
+def get_overlap_matrix(src_layer, dst_layer):
+    """
+    Description
+    ----------
+    Sparse (ndst, nsrc) matrix of the overlap areas between the cells of two
+    grid layers (e.g. a grid and its refined or coarsened version).
+    Candidate pairs are fetched from the spatial index of src_layer and
+    overlap areas of axis-aligned cells are computed at once, so that the
+    cost scales with the number of overlapping pairs.
+    The matrix is kept with the GridCache of dst_layer, and dropped when either
+    grid changes (see invalidate_grid_cache). Requires scipy.
+
+    Parameters
+    ----------
+    src_layer : source grid layer
+    dst_layer : destination grid layer
+
+    Returns
+    -------
+    (matrix, dst_fids, src_fids) : scipy.sparse CSR matrix, arrays of feature ids
+    of dst_layer (matrix rows) and src_layer (matrix columns)
+
+    Examples
+    --------
+    >>> matrix, dst_fids, src_fids = get_overlap_matrix(old_grid, new_grid)
+    """
+    try :
+        import scipy.sparse as sparse
+    except ImportError :
+        raise ImportError('scipy is required to compute overlap matrices')
+
+    # the source cache is fetched first : if it is rebuilt, matrices depending on it are dropped
+    src_cache = get_grid_cache(src_layer)
+    dst_cache = get_grid_cache(dst_layer)
+    key = ( 'overlap', src_layer.id() )
+    if key in dst_cache.data :
+        return( dst_cache.data[key] )
+
+    src_index = get_grid_spatial_index(src_layer)
+
+    # candidate pairs
+    rows, cols = [], []
+    for i, (xmin, ymin, xmax, ymax) in enumerate( zip( dst_cache.xmin.tolist(), dst_cache.ymin.tolist(),
+            dst_cache.xmax.tolist(), dst_cache.ymax.tolist() ) ) :
+        candidates = src_index.intersects( QgsRectangle(xmin, ymin, xmax, ymax) )
+        rows.append( np.full(len(candidates), i, dtype=np.int64) )
+        cols.append( np.asarray(candidates, dtype=np.int64) )
+    rows = np.concatenate(rows) if len(rows) > 0 else np.array([], dtype=np.int64)
+    cols = src_cache.positions( np.concatenate(cols) ) if len(cols) > 0 else np.array([], dtype=np.int64)
+
+    # overlap areas, pairs only sharing an edge or a corner are dropped
+    width = np.minimum(dst_cache.xmax[rows], src_cache.xmax[cols]) - np.maximum(dst_cache.xmin[rows], src_cache.xmin[cols])
+    height = np.minimum(dst_cache.ymax[rows], src_cache.ymax[cols]) - np.maximum(dst_cache.ymin[rows], src_cache.ymin[cols])
+    overlap = (width > 0) & (height > 0)
+    matrix = sparse.csr_matrix( ( (width*height)[overlap], (rows[overlap], cols[overlap]) ),
+            shape = (len(dst_cache), len(src_cache)) )
+
+    dst_cache.data[key] = (matrix, dst_cache.fids, src_cache.fids)
+    return( dst_cache.data[key] )
+
+
+def remap_values(matrix, values, mode = 'mean', src_areas = None):
+    """
+    Description
+    ----------
+    Conservative remapping of source cell values with an overlap matrix,
+    as sparse matrix products. Source values which are nan are ignored.
+    Modes :
+    - 'mean' : area-weighted arithmetic mean (e.g. heads, porosity)
+    - 'harmonic' : area-weighted harmonic mean (e.g. hydraulic conductivity, positive values)
+    - 'geometric' : area-weighted geometric mean (e.g. hydraulic conductivity, positive values)
+    - 'sum' : source values are distributed over destination cells proportionally
+    to the overlap areas, so that totals are conserved (e.g. pumping rates).
+    Requires src_areas.
+
+    Parameters
+    ----------
+    matrix : overlap matrix, see get_overlap_matrix
+    values : array of source values (nsrc) or (nsrc, nfields), aligned with matrix columns
+    mode : one of REMAP_MODES
+    src_areas : array of source cell areas, for mode 'sum'
+
+    Returns
+    -------
+    Array of destination values (ndst) or (ndst, nfields), aligned with matrix rows.
+    nan for destination cells overlapping no (valid) source cell.
+
+    Examples
+    --------
+    >>> matrix, dst_fids, src_fids = get_overlap_matrix(old_grid, new_grid)
+    >>> kh = remap_values(matrix, old_kh, mode = 'harmonic')
+    """
+    if mode not in REMAP_MODES :
+        raise ValueError('mode should be one of ' + ', '.join(REMAP_MODES))
+
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    filled = np.where(valid, values, 0.)
+
+    with np.errstate(divide='ignore', invalid='ignore') :
+        if mode == 'sum' :
+            if src_areas is None :
+                raise ValueError('src_areas is required for mode sum')
+            src_areas = np.asarray(src_areas, dtype=np.float64)
+            fractions = filled / ( src_areas[:, None] if values.ndim == 2 else src_areas )
+            out = matrix.dot(fractions)
+            covered = matrix.dot( valid.astype(np.float64) )
+            return( np.where(covered > 0, out, np.nan) )
+
+        weights = matrix.dot( valid.astype(np.float64) )
+        if mode == 'mean' :
+            out = matrix.dot(filled) / weights
+        elif mode == 'harmonic' :
+            out = weights / matrix.dot( np.where(valid, 1. / filled, 0.) )
+        else :
+            out = np.exp( matrix.dot( np.where(valid, np.log(filled), 0.) ) / weights )
+
+    return( np.where(weights > 0, out, np.nan) )
@@ -37,6 +37,10 @@ import numpy as np
 from math import *
 
 from .base import *
+from .structured import StructuredGrid
+from .nearest import get_cell_locator
+from .traversal import get_pline_cells, polyline_parts, pline_ndist
+from .overlay import REMAP_MODES, get_polygon_cells, get_overlap_matrix, remap_values
 from . import ftools_utils
 
 # ---------------------------------
@@ -66,8 +70,6 @@ def get_param(grid_layer, output_type = 'array', layer = '', field_name = ''):
     >>> get_param(grid_layer, output_type = 'array', field_name = 'IBOUND')
 
     """
-    all_features = {feat.id():feat for feat in grid_layer.getFeatures()}
-
     # init error flags for field indexes
     row_field_idx = col_field_idx = attr_field_idx = -1
 
@@ -102,15 +104,24 @@ def get_param(grid_layer, output_type = 'array', layer = '', field_name = ''):
     # Get row and col field indexes
     row_field_idx = grid_layer.fields().indexFromName('ROW')
     col_field_idx = grid_layer.fields().indexFromName('COL')
+    numbering = row_field_idx == -1 or col_field_idx == -1
+
+    # Arrays and grid numbering require a structured grid,
+    # lists only read the ROW and COL fields
+    if (output_type == 'array' or numbering) and not is_rgrid(grid_layer) :
+        print("Grid layer " + grid_layer.name() + " is not a structured grid.")
+        if output_type == 'array':
+            return(np.array([]))
+        return(False)
 
     # If row and col fields are not found, call rgrid_numbering
-    if row_field_idx == -1 | col_field_idx == -1 :
+    if numbering :
         rgrid_numbering(grid_layer)
         row_field_idx = grid_layer.fields().indexFromName('ROW')
         col_field_idx = grid_layer.fields().indexFromName('COL')
 
     if output_type == 'list':
-        output = get_param_list(grid_layer, all_features, layer = layer, field_name = field_name)
+        output = get_param_list(grid_layer, layer = layer, field_name = field_name)
     elif output_type =='array' :
         output = get_param_array(grid_layer, field_name = field_name)
     else :
@@ -122,13 +133,14 @@ def get_param(grid_layer, output_type = 'array', layer = '', field_name = ''):
 
 # -----------------------------------------------------
 # return modflow-like list from selected features and field_name
-def get_param_list(grid_layer, all_features,  layer = '', field_name = ''):
+def get_param_list(grid_layer, all_features = None, layer = '', field_name = ''):
     """
     Description
 
     Parameters
     ----------
     grid_layer :  QgsVectorLayer, containing the (regular) grid
+    all_features (optional) : not used, kept for compatibility
     layer (optional) : Integer corresponding to the (modflow) grid layer number
     field_name : String, name of the attribute to get in grid_layer
 
@@ -139,49 +151,157 @@ def get_param_list(grid_layer, all_features,  layer = '', field_name = ''):
 
     Examples
     --------
-    >>> output = get_param_list(grid_layer, all_features, layer = layer, field_name = field_name)
+    >>> output = get_param_list(grid_layer, layer = layer, field_name = field_name)
     """
 
-    # Get selected features from input grid_layer
-    selected_feature_ids = grid_layer.selectedFeatureIds()
+    field_names = [field_name] if field_name != '' else []
+    records = get_param_records(grid_layer, field_names, layer = layer if layer != '' else 0)
 
-    # Get field_name attribute index
-    attr_field_idx = grid_layer.fields().indexFromName(field_name)
+    if records is False :
+        return([])
 
-    # Get ROW and COL fields attribute indexes
-    row_field_idx = grid_layer.fields().indexFromName('ROW')
-    col_field_idx = grid_layer.fields().indexFromName('COL')
+    # drop layer number if not provided
+    columns = list(records.dtype.names)
+    if layer == '':
+        columns.remove('lay')
 
-    # init output list
-    grid_list = []
+    return( [ list(rec) for rec in records[columns].tolist() ] )
 
-    # iterate over selected feature ids
-    for fId in selected_feature_ids:
-        feat = all_features[fId]
-        row = feat[row_field_idx]
-        col = feat[col_field_idx]
 
-        this_feat_list = []
+# -----------------------------------------------------
+# return modflow-like list as a structured array
+def get_param_records(grid_layer, field_names, layer = 0, expression = None):
+    """
+    Description
+    ----------
+    Vectorized export of a modflow-like list : (lay, row, col, values...)
+    for the selected features of grid_layer, or the features matching expression.
+    ROW and COL are read from the attribute table (0-based, see rgrid_numbering).
+    Records are sorted by row and col.
 
-        # add layer number
-        if layer != '':
-            this_feat_list.append(layer)
+    Parameters
+    ----------
+    grid_layer :  QgsVectorLayer, containing the (regular) grid
+    field_names : list of names of the attributes to export
+    layer (optional) : (modflow) grid layer number of all records, written as is
+    expression (optional) : QGIS expression string, used instead of the selection
 
-        # add row and col number
-        this_feat_list.append(row)
-        this_feat_list.append(col)
+    Returns
+    -------
+    NumPy structured array with fields 'lay', 'row', 'col' and field_names.
+    Numeric NULL values are nan, text fields are converted to strings.
+    Features with NULL ROW or COL are dropped.
+    False if no feature is selected.
 
-        # add attribute value
-        if field_name != '' :
-            field_value = feat[attr_field_idx]
-            if field_value.toFloat()[1] == True:
-                this_feat_list.append(field_value)
-            else :
-                this_feat_list.append(str(field_value.toString()))
+    Examples
+    --------
+    >>> wel = get_param_records(grid_layer, ['Q'], layer = 0, expression = '"Q" <> 0')
+    >>> write_param_records(wel, 'wel.txt')
+    """
+
+    # Get ROW and COL, number the grid if necessary
+    if grid_layer.fields().indexFromName('ROW') == -1 or grid_layer.fields().indexFromName('COL') == -1 :
+        if not rgrid_numbering(grid_layer) :
+            return(False)
+
+    # Fetch feature ids
+    if expression is not None :
+        request = QgsFeatureRequest().setFilterExpression(expression).setFlags(QgsFeatureRequest.NoGeometry)
+        feature_ids = [ feat.id() for feat in grid_layer.getFeatures(request) ]
+    else :
+        feature_ids = grid_layer.selectedFeatureIds()
+
+    if len(feature_ids) == 0 :
+        print("Empty selection, no feature to export.")
+        return(False)
+
+    # Fetch attributes in a single pass
+    res = get_field_arrays(grid_layer, ['ROW', 'COL'] + list(field_names), feature_ids)
+    if res is False :
+        return(False)
+    fids, values = res
+
+    # drop features without ROW or COL (NULL values are nan)
+    numbered = np.ones(fids.size, dtype=bool)
+    for name in ('ROW', 'COL') :
+        if values[name].dtype.kind == 'f' :
+            numbered &= ~np.isnan(values[name])
+    if not np.all(numbered) :
+        print( str( np.count_nonzero(~numbered) ) + " features without ROW or COL are not exported." )
+        if not np.any(numbered) :
+            return(False)
+        fids = fids[numbered]
+        values = { name:value[numbered] for name, value in values.items() }
+
+    # text fields as strings
+    for field_name in field_names :
+        if values[field_name].dtype == object :
+            values[field_name] = np.array( [ '' if val is None else str(val)
+                for val in values[field_name] ], dtype=str )
+
+    dtype = [ ('lay', np.int64), ('row', np.int64), ('col', np.int64) ] + \
+            [ (str(field_name), values[field_name].dtype) for field_name in field_names ]
+    records = np.empty(fids.size, dtype=dtype)
+    records['lay'] = layer
+    records['row'] = values['ROW']
+    records['col'] = values['COL']
+    for field_name in field_names :
+        records[field_name] = values[field_name]
+
+    return( records[ np.lexsort( (records['col'], records['row']) ) ] )
+
+
+# -----------------------------------------------------
+# write modflow-like list to text or npy file
+def write_param_records(records, filename, one_based = True, fmt = None):
+    """
+    Description
+    ----------
+    Writes records from get_param_records to filename.
+    If filename ends with .npy, records are saved with numpy.save.
+    Otherwise, they are written as a modflow free-format list, one record per line
+    (lay row col values...), without intermediate lists.
+
+    Parameters
+    ----------
+    records : structured array from get_param_records
+    filename : output file name
+    one_based (optional) : write 1-based row and column numbers (modflow input files).
+    Layer numbers are written as given to get_param_records.
+    fmt (optional) : numpy.savetxt format, defaults to integers for indices
+    and integer fields, %.6e for real fields.
+
+    Returns
+    -------
+    True if successful, False otherwise.
+
+    Examples
+    --------
+    >>> write_param_records(records, 'riv.txt')
+    """
+
+    if filename.endswith('.npy') :
+        np.save(filename, records)
+        return(True)
 
-        grid_list.append(this_feat_list)
+    if one_based :
+        records = records.copy()
+        for name in ('row', 'col'):
+            records[name] += 1
+
+    if fmt is None :
+        fmt = [ '%d' if records.dtype[name].kind in 'iu' else
+                '%.6e' if records.dtype[name].kind == 'f' else '%s'
+                for name in records.dtype.names ]
+
+    try :
+        np.savetxt(filename, records, fmt = fmt, delimiter = ' ')
+    except (IOError, OSError) :
+        print("Could not write file " + filename)
+        return(False)
+
+    return(True)
 
-    return grid_list
 
 # -----------------------------------------------------
 # return modflow-like list from selected features and field_name
@@ -203,29 +323,77 @@ def get_param_array(grid_layer, field_name = 'ID'):
     >>> get_param_array(grid_layer, field_name = field_name)
     """
 
-    # Get nrow, ncol
-    nrow, ncol =  get_rgrid_nrow_ncol(grid_layer)
+    # Check that the grid is structured
+    if not is_rgrid(grid_layer) :
+        print("Grid layer " + grid_layer.name() + " is not a structured grid.")
+        return(np.array([]))
 
-    # Get field_name attribute index
-    attr_field_idx = grid_layer.fields().indexFromName(field_name)
+    # Fetch field values in a single pass, NULL values of numeric fields are nan
+    res = get_field_arrays(grid_layer, [field_name])
+    if res is False :
+        return(np.array([]))
+    fids, values = res
 
-    # init lists
-    rows = [feat['ROW'] for feat in grid_layer.getFeatures()]
-    cols = [feat['COL'] for feat in grid_layer.getFeatures()]
-    field_values = [feat[field_name] for feat in grid_layer.getFeatures()]
+    # Reshape following the row-major order of the grid
+    val = rgrid_array(grid_layer, fids, values[field_name])
 
-    rowColVal = np.array ([ [feat['ROW'], feat['COL'], feat[field_name] ] for feat in grid_layer.getFeatures()] )
+    return(val)
 
-    idx = np.lexsort( [rowColVal[:,1], rowColVal[:,0]] )
+# -----------------------------------------------------
+# return parameter arrays of several fields for a stack of grid layers
+def get_param_stack(grid_layers, field_names):
+    """
+    Description
+    ----------
+    Returns parameter arrays of several fields for a stack of grid layers
+    (e.g. the layers of a pseudo-3D model), reading each layer once.
+    Dtypes follow field types, NULL values of numeric fields are nan.
 
-    val = rowColVal[idx,2]
-    val.shape = (nrow, ncol) 
+    Parameters
+    ----------
+    grid_layers : list of QgsVectorLayer, from top to bottom
+    field_names : list of field names, found in all grid layers
 
-    # Avoid issue with Qvariant None in the output array for real fields
-    if grid_layer.fields().field(attr_field_idx).typeName() == 'Real':
-        val[val==None] = np.nan
+    Returns
+    -------
+    Dictionary { field_name : array }
+    If all layers are structured grids of the same shape, arrays are of shape
+    (nlay, nrow, ncol). Otherwise, arrays are replaced by lists of nlay flat
+    vectors, with values ordered by feature id.
 
-    return(val)
+    Examples
+    --------
+    >>> params = get_param_stack([layer1, layer2], ['K', 'IBOUND'])
+    >>> kh = params['K'][0, :, :]
+    """
+
+    # check fields
+    for grid_layer in grid_layers :
+        for field_name in field_names :
+            if grid_layer.fields().indexFromName(field_name) == -1 :
+                print("Field " + field_name + " not found in layer " + grid_layer.name() + ".")
+                return(False)
+
+    # structured stack, or not
+    shapes = [ (get_rgrid_nrow_ncol(grid_layer) if is_rgrid(grid_layer) else None)
+            for grid_layer in grid_layers ]
+    structured = None not in shapes and len( set(shapes) ) == 1
+
+    stack = { field_name:[] for field_name in field_names }
+    for grid_layer in grid_layers :
+        fids, values = get_field_arrays(grid_layer, field_names)
+        if structured :
+            for field_name in field_names :
+                stack[field_name].append( rgrid_array(grid_layer, fids, values[field_name]) )
+        else :
+            order = np.argsort(fids)
+            for field_name in field_names :
+                stack[field_name].append( values[field_name][order] )
+
+    if structured :
+        stack = { field_name:np.stack(arrays) for field_name, arrays in stack.items() }
+
+    return(stack)
 
 # -----------------------------------------------------
 def get_ptset_xy(v_layer, id_field_name = 'ID'):
@@ -266,6 +434,40 @@ def get_ptset_xy(v_layer, id_field_name = 'ID'):
     return(dic_ptset)
 
 
+# -----------------------------------------------------
+def get_ptset_arrays(v_layer, id_field_name = 'ID'):
+    """
+    Description
+    ----------
+    Ids and coordinates of the selected points of v_layer (all points if
+    the selection is empty), as arrays.
+
+    Returns
+    -------
+    (ids, x, y) where ids is a list and x, y are arrays
+
+    Examples
+    --------
+    >>> ids, x, y = get_ptset_arrays(v_layer, id_field_name = 'ID')
+    """
+    selected_feature_ids = v_layer.selectedFeatureIds()
+    request = QgsFeatureRequest().setSubsetOfAttributes([id_field_name], v_layer.fields())
+    if len(selected_feature_ids) == 0:
+        print("Empty selection, all features considered")
+    else :
+        print("Only selected features will be considered")
+        request.setFilterFids(selected_feature_ids)
+
+    ids, xy = [], []
+    for feat in v_layer.getFeatures(request) :
+        point = feat.geometry().asPoint()
+        ids.append( feat[id_field_name] )
+        xy.append( (point.x(), point.y()) )
+    xy = np.array(xy, dtype=np.float64).reshape(-1, 2)
+
+    return(ids, xy[:,0], xy[:,1])
+
+
 # -----------------------------------------------------
 def get_ptset_centroids(v_layer, grid_layer, id_field_name = 'ID',nNeighbors = 3):
     """
@@ -287,7 +489,9 @@ def get_ptset_centroids(v_layer, grid_layer, id_field_name = 'ID',nNeighbors = 3
     Returns
     -------
 
-    {'ID1':(nrow1, ncol1), 'ID2':(nrow2, ncol2), ... }
+    {'ID1':[(row, col, dist), ...], 'ID2':[(row, col, dist), ...], ... }
+    Rows and columns of grids which are not structured (e.g. nested grids)
+    are read from their ROW and COL fields. False if there are none.
 
     Examples
     --------
@@ -299,65 +503,32 @@ def get_ptset_centroids(v_layer, grid_layer, id_field_name = 'ID',nNeighbors = 3
     # field_name : the attribute field of v_layer containing feature identificator
     # nNeighbors : number of neighboring cells to fetch for each point
 
-    # check that grid_layer is a grid
-    try :
-        res = rgrid_numbering(grid_layer)
-        if res == False:
-            print("The grid layer does not seem to be valid")
-            return(False)
-    except :
-        return(False)
-
-    # -- create temporary layer of cell centroids
-    # init layer type (point) and crs
-    cLayerCrs = grid_layer.crs().authid()
-    # create layer
-    cLayer = QgsVectorLayer("Point?crs=" + cLayerCrs, "temp_centroids", "memory")
-    cProvider = cLayer.dataProvider()
-    cProvider.addAttributes( grid_layer.dataProvider().fields().toList() )
-
-    # fill layer with centroids
-    feat_centroids = []
-    for cell in grid_layer.getFeatures():
-        feat = QgsFeature()
-        geom = cell.geometry().centroid()
-        feat.setAttributes( cell.attributes() )
-        feat.setGeometry( QgsGeometry(geom) )
-        feat_centroids.append(feat)
+    # structured grids : cells are found by index arithmetic
+    if is_rgrid(grid_layer) :
+        ids, x, y = get_ptset_arrays(v_layer, id_field_name)
+        rows, cols, dists = StructuredGrid.from_layer(grid_layer).nearest_cells(x, y, nNeighbors)
+        return( { pt_id:list( zip(row, col, dist) ) for pt_id, row, col, dist in
+            zip(ids, rows.tolist(), cols.tolist(), dists.tolist()) } )
 
-    cProvider.addFeatures( feat_centroids )
+    # other grids (e.g. nested grids) must already have ROW and COL fields
+    if grid_layer.fields().indexFromName('ROW') == -1 or grid_layer.fields().indexFromName('COL') == -1 :
+        print("Grid layer " + grid_layer.name() + " is not a structured grid and has no ROW and COL fields.")
+        return(False)
 
-    # -- Create and fill spatial Index
-    cLayerIndex = QgsSpatialIndex(cLayer.getFeatures())
+    # nearest-cell index of cell centers
+    ids, x, y = get_ptset_arrays(v_layer, id_field_name)
+    fids, dists = get_cell_locator(grid_layer).query(x, y, nNeighbors)
 
-    # init distance tool
-    d = QgsDistanceArea()
+    # cells are identified by ROW and COL
+    cell_fids, values = get_field_arrays(grid_layer, ['ROW', 'COL'], np.unique(fids))
+    sorter = np.argsort(cell_fids)
+    idx = sorter[ np.searchsorted(cell_fids, fids, sorter=sorter) ]
+    cells = [ list( zip(row, col) ) for row, col in
+            zip( values['ROW'][idx].tolist(), values['COL'][idx].tolist() ) ]
 
     # PtsetCentroids : { pointIDValue:[ (nrow, ncol, dist), ... ] }
-    PtsetCentroids = {}
-
-   # check that the selection in v_layer is not empty
-    selected_feature_ids = v_layer.selectedFeatureIds()
-    if len(selected_feature_ids) == 0:
-        print("Empty selection, all features considered")
-        features = v_layer.getFeatures()
-    else :
-        print("Only selected features will be considered")
-        features = v_layer.selectedFeatures()
-
-    # iterate over selected points, find neighbors, fill pointCentroids dictionary
-    for selectedPoint in features:
-        neighborsIds = cLayerIndex.nearestNeighbor(selectedPoint.geometry().asPoint(), nNeighbors)
-        neighborsData = []
-        # iterate over neighbors
-        for neighborId in neighborsIds:
-            neighborFeat = QgsFeature()
-            cProvider.getFeatures( QgsFeatureRequest().setFilterFid( neighborId ) ).nextFeature( neighborFeat )
-            row = neighborFeat['ROW']
-            col = neighborFeat['COL']
-            dist = d.measureLine( neighborFeat.geometry().asPoint(), selectedPoint.geometry().asPoint() )
-            neighborsData.append( (row, col, dist) )
-        PtsetCentroids[selectedPoint[id_field_name]] = neighborsData
+    PtsetCentroids = { pt_id:[ cell + (dist,) for cell, dist in zip(pt_cells, pt_dists) ]
+            for pt_id, pt_cells, pt_dists in zip(ids, cells, dists.tolist()) }
 
     return(PtsetCentroids)
 
@@ -370,129 +541,68 @@ def get_pline_data(pline, pline_layer) :
     """
     Description
     -----------
+    Deprecated, use polyline_parts and pline_ndist.
     Fetch necessary data to compute the curvilinear abscissa of the
     projection of a grid cell centroid over a polyline.
 
     Parameters
     ----------
     pline : the polyline
-    pline_layer : the vector layer
+    pline_layer : the vector layer (not used any more)
 
     Returns
     -------
-    A tuple :
-    pline_feat_dic, pline_point_layer_index, pline_cumdist_dic
+    A tuple, for get_dist_pline_centroid :
+    pline_parts (see polyline_parts), None, None
 
     Examples
     --------
     >>> pline_feat_dic, pline_point_layer_index, pline_cumdist_dic = get_pline_data(pline, pline_layer)
     """
+    return( polyline_parts(pline.geometry()), None, None )
 
-    # get points from polyline
-    #pline_point_list = pline.geometry().asPolyline()
-    pline_point_list = pline.geometry().asMultiPolyline()[0]
-
-    # build list of features constituting the polyline
-    pline_feat_list = []
-
-    for point in pline_point_list :
-        feat = QgsFeature()
-        geom = QgsGeometry.fromPointXY(point)
-        feat.setGeometry(geom)
-        pline_feat_list.append(feat)
-
-    # init and populate memory layer with polyline features
-    pline_point_layer = QgsVectorLayer("Point?crs=" + pline_layer.crs().authid(), 'pline_point_layer', providerLib =  'memory')
-    pline_point_layer.dataProvider().addFeatures(pline_feat_list)
-
-    # build spatial index from pline features
-    pline_point_layer_index = get_spatial_indexes([pline_point_layer])[0]
-
-    # build dic of keys
-    pline_feat_dic = {feat.id():feat for feat in pline_point_layer.getFeatures()}
-
-    # build list of distances of polyline segments
-    pline_dist_list = []
-
-    for i in range(len(pline_point_list) - 1) :
-        dist = pline_feat_list[i].geometry().distance( pline_feat_list[i+1].geometry() )
-        pline_dist_list.append(dist)
-
-    # build list of cumulated distances along polyline
-    pline_cumdist_list = list(np.cumsum(pline_dist_list))
-    pline_cumdist_list = [0] + pline_cumdist_list
 
-    # build dictionary of cumulated distances for each layer id
-
-    pline_cumdist_dic = {}
-
-    for i, key in zip( range(len(pline_cumdist_list)), sorted(pline_feat_dic.keys()) ):
-        pline_cumdist_dic[key] = pline_cumdist_list[i]
-
-
-    # return variables of interest for get_dist_pline_centroid
-    return(pline_feat_dic, pline_point_layer_index, pline_cumdist_dic)
-
-
-def get_dist_pline_centroid(centroid, pline, pline_feat_dic, pline_point_layer_index, pline_cumdist_dic) :
+def get_dist_pline_centroid(centroid, pline, pline_feat_dic = None, pline_point_layer_index = None, pline_cumdist_dic = None) :
     """
     Description
     -----------
-    Returns the distance between the origin of a polyline (pline) and the projection
-    of a point (centroid) onto the polyline.
+    Deprecated, use pline_ndist, which processes all points at once.
+    Returns the normalized distance between the origin of a polyline (pline)
+    and the projection of a point (centroid) onto the polyline.
 
     Parameters
     ----------
+    centroid : QgsGeometry of the point
     pline : the polyline
-    pline_feat_dic : dictionary of polyline point features from QgsGeometry().asPolyline()
-    pline_point_layer_index : QgsSpatialIndex of polyline memory vector layer
+    pline_feat_dic (optional) : polyline parts from get_pline_data
+    pline_point_layer_index, pline_cumdist_dic : not used any more
 
     Returns
     -------
-    dist_centroid_origin (float)
+    norm_dist_centroid_origin (float)
 
     Examples
     --------
     >>> dist_centroid_origin = get_dist_pline_centroid(centroid, pline, pline_feat_dic, pline_point_layer_index, pline_cumdist_dic)
     """
+    parts = pline_feat_dic if isinstance(pline_feat_dic, list) else polyline_parts(pline.geometry())
+    point = centroid.asPoint()
+    return( float( pline_ndist(parts, point.x(), point.y())[0] ) )
 
-    # for a given centroid, find the two nearest neighbors in the polyline
-    neighbor_ids = pline_point_layer_index.nearestNeighbor(centroid.asPoint(),2)
-
-    # first neighbor along the polyline, this is not necessarily the closest to the centroid.
-    first_neighbor_id = sorted(neighbor_ids)[0]
-    first_neighbor_feat = pline_feat_dic[first_neighbor_id]
-
-    # get shortest distance to the polyline
-    dist_centroid_pline = centroid.distance( pline.geometry() )
-
-    # get distance of centroid to the first neighbor (along polyline)
-    dist_centroid_point = centroid.distance( first_neighbor_feat.geometry() )
-
-    # get projection of the centroid over the polyline segment (Pythagore theorem)
-    dist_centroid_projected = sqrt( dist_centroid_point**2 - dist_centroid_pline**2)
-
-    # compute cumulated distance from polyline origin
-    dist_centroid_origin = pline_cumdist_dic[first_neighbor_id] + dist_centroid_projected
-
-    # compute normalized distance ( curvilinear distance from pline origin / total pline length )
-    norm_dist_centroid_origin = dist_centroid_origin / np.max([v for v in pline_cumdist_dic.values()])
 
-    return(norm_dist_centroid_origin)
-
-
-def get_pline_centroids(pline_layer, grid_layer, id_field_name = 'ID', get_ndist = False) :
+def get_pline_centroids(pline_layer, grid_layer, id_field_name = 'ID', get_ndist = False, get_length = False) :
     """
     Description
     -----------
     Returns, for each (selected) polyline in pline_layer the row and column
-    of intersected grid cells from grid_layer.
+    of intersected grid cells from grid_layer, in the order of traversal.
     If get_ndsit is True, the normalized distance between each centroid
     of selected cells is added (see Returns).
     The normalized distance, ndist, is the distance from the polyline origin to
     the curvilinear abscissa of the cell centroid projected onto the polyline.
     When edited with Qgis, the polyline origin is the first point of the polyline
     at the time of polyline creation.
+    If get_length is True, the length of polyline within each cell is added.
 
     Parameters
     ----------
@@ -500,6 +610,7 @@ def get_pline_centroids(pline_layer, grid_layer, id_field_name = 'ID', get_ndist
     grid_layer : grid layer (vector)
     id_field_name : field name in polyline layer with unique feature id
     get_ndist : whether to add or not the normalized distance
+    get_length : whether to add or not the length of polyline within cells
 
     Returns
     -------
@@ -507,6 +618,9 @@ def get_pline_centroids(pline_layer, grid_layer, id_field_name = 'ID', get_ndist
         { pline_feat_id : [ (row, col), ... ] , ... }
     if get_ndist is True :
         { pline_feat_id : [ (row, col, ndist), ... ] , ... }
+    if get_length is True, length is appended :
+        { pline_feat_id : [ (row, col, ndist, length), ... ] , ... }
+    False for grids which are neither structured nor numbered (see get_cells_rowcol).
 
     Examples
     --------
@@ -526,43 +640,31 @@ def get_pline_centroids(pline_layer, grid_layer, id_field_name = 'ID', get_ndist
         print("Only selected features will be considered")
         plines = pline_layer.selectedFeatures()
 
-
-    print('QGRIDDER _UTILS.... Get spatial index')
-    # create and fill spatial Index
-    grid_layer_index = get_spatial_indexes([grid_layer])[0]
-    print('QGRIDDER _UTILS.... END Get spatial index')
-
-    # build grid feature dictionary
-    grid_feat_dic = { feat.id():feat for feat in grid_layer.getFeatures()}
+    grid_cache = get_grid_cache(grid_layer)
 
     # Iterate over plines in pline_layer
     for pline in plines:
 
-        # list of grid cells intersected by pline
-        intersected_cells_list = []
+        # grid cells crossed by the pline
+        fids, lengths = get_pline_cells(pline.geometry(), grid_layer)
+        cells = get_cells_rowcol(grid_layer, fids)
+        if cells is False :
+            return(False)
 
-        # get additional pline data
+        # normalized distance of cell centroids along the pline
         if get_ndist == True :
-            pline_feat_dic, pline_point_layer_index, pline_cumdist_dic = get_pline_data(pline, pline_layer)
-
-        # get grid cells in the bbox of the pline
-        pline_geom = QgsGeometry(pline.geometry())
-        grid_feat_intersect_ids = grid_layer_index.intersects(pline_geom.boundingBox())
-
-        # shorten selection to grid cells intersected by the pline
-        for id in grid_feat_intersect_ids:
-            grid_cell = grid_feat_dic[id]
-            grid_cell_geom = QgsGeometry(grid_cell.geometry())
-            # Within grid cells in the bbox of feat, select those intersecting feat
-            if pline_geom.intersects(grid_cell_geom):
-                if get_ndist == True :
-                    grid_cell_centroid = grid_cell_geom.centroid()
-                    ndist = get_dist_pline_centroid(grid_cell_centroid, pline, pline_feat_dic, pline_point_layer_index, pline_cumdist_dic)
-                    # add grid_cell ROW and COL and ndist attributes
-                    intersected_cells_list.append( [ grid_cell['ROW'], grid_cell['COL'], ndist ] )
-                else :
-                    # add grid_cell ROW and COL attributes
-                    intersected_cells_list.append( [ grid_cell['ROW'], grid_cell['COL'] ] )
+            pos = grid_cache.positions(fids)
+            ndists = pline_ndist( polyline_parts(pline.geometry()), grid_cache.cx[pos], grid_cache.cy[pos] )
+
+        # list of grid cells intersected by pline
+        intersected_cells_list = []
+        for i, (cell, length) in enumerate( zip(cells, lengths.tolist()) ) :
+            cell_data = list(cell)
+            if get_ndist == True :
+                cell_data.append( ndists[i] )
+            if get_length == True :
+                cell_data.append(length)
+            intersected_cells_list.append(cell_data)
 
         # add pline entry into output dictionary
         pline_cells_dic[ pline[id_field_name] ] =  intersected_cells_list
@@ -570,6 +672,43 @@ def get_pline_centroids(pline_layer, grid_layer, id_field_name = 'ID', get_ndist
     return(pline_cells_dic)
 
 
+# -----------------------------------------------------
+def get_cells_rowcol(grid_layer, fids):
+    """
+    Description
+    -----------
+    Row and column of cells fids of grid_layer. For structured grids,
+    they are computed from the grid descriptor. Otherwise (e.g. nested grids),
+    they are read from ROW and COL fields.
+
+    Returns
+    -------
+    List of tuples (row, col), aligned with fids.
+    False if grid_layer is not structured and has no ROW and COL fields.
+
+    Examples
+    --------
+    >>> cells = get_cells_rowcol(grid_layer, [12, 13])
+    """
+    fids = np.asarray(fids, dtype=np.int64)
+
+    if is_rgrid(grid_layer) :
+        descriptor = get_rgrid_descriptor(grid_layer)
+        sorter = np.argsort(descriptor['fids'])
+        pos = sorter[ np.searchsorted(descriptor['fids'], fids, sorter=sorter) ]
+        rows, cols = np.divmod(pos, descriptor['ncol'])
+        return( list( zip( rows.tolist(), cols.tolist() ) ) )
+
+    if grid_layer.fields().indexFromName('ROW') != -1 and grid_layer.fields().indexFromName('COL') != -1 :
+        cell_fids, values = get_field_arrays(grid_layer, ['ROW', 'COL'], np.unique(fids))
+        sorter = np.argsort(cell_fids)
+        idx = sorter[ np.searchsorted(cell_fids, fids, sorter=sorter) ]
+        return( list( zip( values['ROW'][idx].tolist(), values['COL'][idx].tolist() ) ) )
+
+    print("Grid layer " + grid_layer.name() + " is not a structured grid and has no ROW and COL fields.")
+    return(False)
+
+
 # -----------------------------------------------------
 def get_polygon_centroids(polygon_layer, grid_layer, pline_layer = None, id_field_name = 'ID') :
     """
@@ -598,6 +737,7 @@ def get_polygon_centroids(polygon_layer, grid_layer, pline_layer = None, id_fiel
         { polygon_feat_id : [ (row, col), ... ] , ... }
     if pline_layer not None :
         { polygon_feat_id : [ (row, col, ndist), ... ] , ... }
+    False for grids which are neither structured nor numbered (see get_cells_rowcol).
 
     Examples
     --------
@@ -618,11 +758,7 @@ def get_polygon_centroids(polygon_layer, grid_layer, pline_layer = None, id_fiel
         print("Only selected features will be considered")
         polygons = polygon_layer.selectedFeatures()
 
-    # create and fill spatial Index
-    grid_layer_index = get_spatial_indexes([grid_layer])[0]
-
-    # build grid feature dictionary
-    grid_feat_dic = { feat.id():feat for feat in grid_layer.getFeatures()}
+    grid_cache = get_grid_cache(grid_layer)
 
     # init pline dictionary
     if pline_layer is not None :
@@ -631,30 +767,26 @@ def get_polygon_centroids(polygon_layer, grid_layer, pline_layer = None, id_fiel
     # Iterate over polygons in polygon_layer
     for polygon in polygons :
 
-        # list of grid cells intersected by polygon
-        intersected_cells_list = []
-
-        # get grid cells in the bbox of the polygon
-        polygon_geom = QgsGeometry(polygon.geometry())
-        grid_feat_intersect_ids = grid_layer_index.intersects(polygon_geom.boundingBox())
+        # grid cells intersected by the polygon
+        fids = get_polygon_cells(polygon.geometry(), grid_layer)
+        cells = get_cells_rowcol(grid_layer, fids)
+        if cells is False :
+            return(False)
 
-        # fetch corresponding pline based on ID atribute
+        # normalized distance of cell centroids along the corresponding pline,
+        # fetched based on ID atribute
         if pline_layer is not None :
             pline = pline_dic[ polygon[id_field_name] ]
-            pline_feat_dic, pline_point_layer_index, pline_cumdist_dic = get_pline_data(pline, pline_layer)
-
-        # shorten selection to grid cells intersected by the polygon
-        for id in grid_feat_intersect_ids:
-            grid_cell = grid_feat_dic[id]
-            grid_cell_geom = QgsGeometry(grid_cell.geometry())
-            # Within grid cells in the bbox of feat, select those intersecting feat
-            if polygon_geom.intersects(grid_cell_geom):
-                if pline_layer is not None :
-                    grid_cell_centroid = grid_cell_geom.centroid()
-                    ndist = get_dist_pline_centroid(grid_cell_centroid, pline, pline_feat_dic, pline_point_layer_index, pline_cumdist_dic)
-                    intersected_cells_list.append( [ grid_cell['ROW'], grid_cell['COL'], ndist ] )
-                else :
-                    intersected_cells_list.append( [ grid_cell['ROW'], grid_cell['COL'] ] )
+            pos = grid_cache.positions(fids)
+            ndists = pline_ndist( polyline_parts(pline.geometry()), grid_cache.cx[pos], grid_cache.cy[pos] )
+
+        # list of grid cells intersected by polygon
+        intersected_cells_list = []
+        for i, cell in enumerate(cells) :
+            if pline_layer is not None :
+                intersected_cells_list.append( list(cell) + [ ndists[i] ] )
+            else :
+                intersected_cells_list.append( list(cell) )
 
         # add polygon entry into output dictionary
         polygon_cells_dic[ polygon[id_field_name] ] =  intersected_cells_list
@@ -706,64 +838,179 @@ def get_feat_param(v_layer, id_field_name = 'ID', field_name = 'PARAM',):
 
 # -----------------------------------------------------
 # From 2D array, fills shape file attribute table
-def data_to_grid(data, grid_layer, field_name = 'PARAM', fieldType = QVariant.Double ):
+def data_to_grid(data, grid_layer, field_name = 'PARAM', fieldType = QVariant.Double, delta = True, fids = None ):
     """
     Description
+    ----------
+    Writes array data to field field_name of grid_layer.
+    Values are attributed to cells sorted from top left to bottom right
+    (row-wise for structured grids).
+    For 3D arrays (nlay, nrow, ncol) and 2D arrays (nlay, ncell) with nlay > 1, layer k is written
+    to field field_name_k (k from 1 to nlay), e.g. K_1, ..., K_n.
+    Masked values of masked arrays are not written.
+    In delta mode, data is compared to the stored values and only
+    changed cells are written, by chunks, through the data provider.
 
     Parameters
     ----------
-    p1 : parameter 1
+    data : array (or masked array) with one value per cell, or 3D array
+    grid_layer : the grid layer
+    field_name : name of the field, or prefix of fields for 3D arrays
+    fieldType : QVariant type of the field, if it has to be created
+    delta (optional) : if True, only write values which differ from the stored ones
+    fids (optional) : feature ids the values refer to, instead of cells sorted from top left
 
     Returns
     -------
 
-    out1 : output1
+    True if successful, False otherwise
 
     Examples
     --------
-    >>>
+    >>> res = data_to_grid(kh, grid_layer, field_name = 'K')
     """
     # Note : to date, only fieldType Double is applicable
-    # TODO check that data has same number of elements of grid_layer
-    # Select all features along with their attributes
-    #allAttrs = grid_layer.pendingAllAttributesList()
-    #grid_layer.select(allAttrs)
+
+    data = np.ma.asarray(data)
+    grid_cache = get_grid_cache(grid_layer)
+    # 3D arrays (nlay, nrow, ncol) and 2D arrays (nlay, ncell)
+    if data.ndim == 3 or ( data.ndim == 2 and data.shape[0] > 1 and data.shape[1] == len(grid_cache) ) :
+        field_names = [ field_name + '_' + str(k + 1) for k in range(data.shape[0]) ]
+        data = data.reshape(data.shape[0], -1)
+    else :
+        field_names = [field_name]
+        # reshape array to a 1D vector
+        # elements are sorted from top left to bottom right
+        data = data.reshape(1, -1)
+
+    if data.shape[1] != len(grid_cache) :
+        print("Data size (" + str(data.shape[1]) + ") does not match the number of cells of " + \
+                grid_layer.name() + " (" + str(len(grid_cache)) + ").")
+        return(False)
+
+    # feature ids sorted from top left to bottom right
+    if fids is not None :
+        fids = np.asarray(fids, dtype=np.int64)
+    elif is_rgrid(grid_layer) :
+        fids = get_rgrid_descriptor(grid_layer)['fids']
+    else :
+        centroids_x = np.around(grid_cache.cx, MAX_DECIMALS)
+        centroids_y = np.around(grid_cache.cy, MAX_DECIMALS)
+        fids = grid_cache.fids[ np.lexsort( [centroids_x,-1*centroids_y] ) ]
+
+    return _write_field_values(grid_layer, field_names, fids, data, fieldType = fieldType, delta = delta)
+
+
+# ======================================================================================
+def _write_field_values(grid_layer, field_names, fids, data, fieldType = QVariant.Double, delta = True):
+    """
+    Description
+    ----------
+    Writes the rows of the masked array data (nfields, ncell) to fields field_names
+    of the features fids of grid_layer, in a single attribute map.
+    Missing fields are created, masked values are not written.
+
+    Returns
+    -------
+    True if successful, False otherwise
+    """
     # load dic of current layer attributes
     field_name_map = grid_layer.dataProvider().fieldNameMap()
 
-    # if field "field_name" does not exist in attribute map, add it
-    if field_name not in field_name_map.keys():
-        grid_layer.dataProvider().addAttributes(  [QgsField( field_name, fieldType)] )
+    # if fields do not exist in attribute map, add them
+    new_fields = [ QgsField(name, fieldType) for name in field_names if name not in field_name_map.keys() ]
+    if len(new_fields) > 0 :
+        grid_layer.dataProvider().addAttributes(new_fields)
         grid_layer.updateFields()
 
-    # reshape array to a 1D vector
-    # elements are sorted from top left to bottom right
-    data = np.reshape(data, -1)
-
-    # Init variables
-    all_features = {feat.id():feat for feat in grid_layer.getFeatures()}
-    all_centroids = [feat.geometry().centroid().asPoint() \
-                        for feat in all_features.values()]
-    centroids_ids = list(all_features.keys())
-    centroids_x = np.around(np.array([centroid.x() for centroid in all_centroids]), MAX_DECIMALS)
-    centroids_y = np.around(np.array([centroid.y() for centroid in all_centroids]), MAX_DECIMALS)
-    centroids = np.array( [centroids_ids , centroids_x, centroids_y] )
-    centroids = centroids.T
-
-    # sort by decreasing y and increasing x (from top left to bottom right)
-    # for regular grids, this corresponds to row-wise and column wise
-    idx = np.lexsort( [centroids_x,-1*centroids_y] )
-    centroids = centroids[idx,:]
+    # values to write
+    write = ~np.ma.getmaskarray(data)
+    values = np.ma.getdata(data)
+
+    # compare with stored values
+    if delta :
+        stored_fids, stored = get_field_arrays(grid_layer, field_names)
+        sorter = np.argsort(stored_fids)
+        idx = sorter[ np.searchsorted(stored_fids, fids, sorter=sorter) ]
+        for k, name in enumerate(field_names) :
+            if stored[name].dtype == object or values.dtype.kind not in 'iuf' :
+                continue
+            unchanged = np.isclose( stored[name][idx].astype(np.float64), values[k].astype(np.float64),
+                    rtol = 1e-12, atol = 0., equal_nan = True )
+            write[k] &= ~unchanged
 
     # populate change attribute map
-    field_idx = grid_layer.fields().indexFromName(field_name)
-    attr_map = { centroids[i,0] : { field_idx : float(data[i]) } for i in range( centroids.shape[0] ) }
+    field_idx = [ grid_layer.fields().indexFromName(name) for name in field_names ]
+    attr_map = {}
+    for k, idx in enumerate(field_idx) :
+        for fid, value in zip( fids[ write[k] ].tolist(), values[k][ write[k] ].tolist() ) :
+            attr_map.setdefault(fid, {})[idx] = value
+
+    if len(attr_map) == 0 :
+        return(True)
 
-    # write attributes
-    grid_layer.startEditing()
-    res = grid_layer.dataProvider().changeAttributeValues(attr_map)
-    grid_layer.commitChanges()
+    # write attributes by batches
+    res = change_attribute_values(grid_layer, attr_map)
 
     return res
 
 
+# ======================================================================================
+def remap_fields(src_layer, dst_layer, field_names, mode = 'mean', delta = True):
+    """
+    Description
+    ----------
+    Transfers fields from grid src_layer to grid dst_layer (e.g. from a grid
+    to its refined or coarsened version) by conservative remapping over
+    the overlap matrix of the grids (see get_overlap_matrix and remap_values).
+    All fields are validated, remapped and written at once. Destination cells
+    overlapping no source cell are left unchanged.
+
+    Parameters
+    ----------
+    src_layer : source grid layer
+    dst_layer : destination grid layer
+    field_names : list of field names, created in dst_layer if necessary
+    mode : remapping mode ('mean', 'harmonic', 'geometric' or 'sum'),
+    or dictionary of modes by field name
+    delta (optional) : if True, only write values which differ from the stored ones
+
+    Returns
+    -------
+    True if successful, False otherwise
+
+    Examples
+    --------
+    >>> res = remap_fields(old_grid, new_grid, ['K', 'QW'], mode = {'K':'harmonic', 'QW':'sum'})
+    """
+    modes = mode if isinstance(mode, dict) else { name:mode for name in field_names }
+    if any( modes.get(name) not in REMAP_MODES for name in field_names ) :
+        print("Remapping modes should be one of " + ', '.join(REMAP_MODES) + ".")
+        return(False)
+    missing = [ name for name in field_names if src_layer.fields().indexFromName(name) == -1 ]
+    if len(missing) > 0 :
+        print("Fields " + ', '.join(missing) + " not found in " + src_layer.name() + ".")
+        return(False)
+
+    fids, arrays = get_field_arrays(src_layer, field_names)
+    not_numeric = [ name for name in field_names if arrays[name].dtype.kind not in 'iuf' ]
+    if len(not_numeric) > 0 :
+        print("Fields " + ', '.join(not_numeric) + " are not numeric.")
+        return(False)
+
+    matrix, dst_fids, src_fids = get_overlap_matrix(src_layer, dst_layer)
+    src_cache = get_grid_cache(src_layer)
+    pos = src_cache.positions(fids)
+
+    # remapped values (nfields, ndst), nan where no source cell overlaps
+    out = np.full( (len(field_names), len(dst_fids)), np.nan )
+    for this_mode in sorted( set( modes[name] for name in field_names ) ) :
+        cols = [ k for k, name in enumerate(field_names) if modes[name] == this_mode ]
+        values = np.full( (len(src_cache), len(cols)), np.nan )
+        for j, k in enumerate(cols) :
+            values[pos, j] = arrays[field_names[k]]
+        out[cols] = remap_values(matrix, values, mode = this_mode, src_areas = src_cache.dx * src_cache.dy).T
+
+    # all fields written in a single attribute map
+    return _write_field_values(dst_layer, list(field_names), np.asarray(dst_fids, dtype=np.int64),
+            np.ma.masked_invalid(out), delta = delta)
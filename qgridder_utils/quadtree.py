@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ qgridder_utils_quadtree.py
+                                 Qgridder - A QGIS plugin
+
+ This file gathers the quadtree model of nested grids, used to refine
+ nested grids while keeping the 2:1 balance between neighbor cells.
+
+ Qgridder builds 2D regular and unstructured grids and comes together with
+ pre- and post-processing capabilities for spatially distributed modeling.
+
+                              -------------------
+        begin                : 2013-04-08
+        copyright            : (C) 2013 by Pryet
+        email                : alexandre.pryet@ensegid.fr
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from qgis.core import *
+
+import numpy as np
+from collections import deque
+
+from .base import BATCH_SIZE, TOLERANCE, rect_wkb, wkb_to_features, get_grid_cache, \
+        invalidate_grid_cache
+
+# face neighbors, with the direction codes of find_neighbors
+# | 8 | 1 | 5 |
+# | 4 | 0 | 2 |
+# | 7 | 3 | 6 |
+# i for columns (left to right), j for rows (bottom to top)
+QUADTREE_DIRECTIONS = { 1:(0, 1), 2:(1, 0), 3:(0, -1), 4:(-1, 0) }
+
+# ======================================================================================
+class QuadTree(object):
+    """
+    Nested grid held as the leaves of quadtrees rooted on the cells of a regular
+    base grid of origin (xoff, yoff) (bottom-left corner) and resolution (dx0, dy0).
+    A leaf is keyed by (level, i, j), where i and j are the column and row (from bottom)
+    indexes on the lattice of resolution (dx0 / 2**level, dy0 / 2**level).
+    Each leaf refers to the id of the grid_layer feature it stems from.
+
+    Examples
+    --------
+    >>> qtree = QuadTree.from_layer(grid_layer)
+    >>> qtree.refine(grid_layer.selectedFeatureIds(), nlevels = 1, max_diff = 1)
+    >>> newFeatIds = qtree.write(grid_layer)
+    """
+
+    def __init__(self, xoff, yoff, dx0, dy0):
+        self.xoff, self.yoff = float(xoff), float(yoff)
+        self.dx0, self.dy0 = float(dx0), float(dy0)
+        # { (level, i, j) : feature id of the original cell }
+        self.leaves = {}
+        # { feature id : (level, i, j) } for original cells still in the grid
+        self.fid_keys = {}
+        # ids of original cells which have been split
+        self.split_fids = set()
+
+    # ------ constructors
+    @classmethod
+    def from_bounds(cls, fIds, xmin, ymin, xmax, ymax, tol = TOLERANCE):
+        """
+        Description
+        ----------
+        Quadtree from feature ids and cell bounds (arrays).
+
+        Returns
+        -------
+        QuadTree, or None if the cells do not fit a quadtree
+        (cell sizes not in a power of 2 ratio, or misaligned cells).
+        """
+        xmin, ymin = np.asarray(xmin, dtype=np.float64), np.asarray(ymin, dtype=np.float64)
+        dx, dy = np.asarray(xmax) - xmin, np.asarray(ymax) - ymin
+        if xmin.size == 0 :
+            return(None)
+        qtree = cls( xmin.min(), ymin.min(), dx.max(), dy.max() )
+
+        # level of each cell
+        level = np.around( np.log2(qtree.dx0 / dx) ).astype(int)
+        if np.any( np.abs(dx * 2.**level - qtree.dx0) > tol ) or \
+                np.any( np.abs(dy * 2.**level - qtree.dy0) > tol ) :
+            return(None)
+
+        # position on the lattice of its level
+        fi, fj = (xmin - qtree.xoff) / dx, (ymin - qtree.yoff) / dy
+        i, j = np.around(fi).astype(np.int64), np.around(fj).astype(np.int64)
+        if np.any( np.abs(fi - i) * dx > tol ) or np.any( np.abs(fj - j) * dy > tol ) :
+            return(None)
+
+        for fId, key in zip( fIds, zip(level.tolist(), i.tolist(), j.tolist()) ):
+            qtree.leaves[key] = int(fId)
+            qtree.fid_keys[int(fId)] = key
+
+        return(qtree)
+
+    @classmethod
+    def from_layer(cls, grid_layer):
+        """
+        Description
+        ----------
+        Quadtree of a nested grid layer, None if the grid is not nested.
+        """
+        grid_cache = get_grid_cache(grid_layer)
+        return( cls.from_bounds(grid_cache.fids, grid_cache.xmin, grid_cache.ymin,
+            grid_cache.xmax, grid_cache.ymax) )
+
+    # ------ leaves
+    def find_leaf(self, level, i, j):
+        """
+        Description
+        ----------
+        Leaf containing the lattice cell (level, i, j), at this level or coarser.
+        Returns None if the lattice cell is out of the grid or covered by finer leaves.
+        """
+        for k in range(level, -1, -1):
+            shift = level - k
+            key = (k, i >> shift, j >> shift)
+            if key in self.leaves :
+                return(key)
+        return(None)
+
+    def split(self, key):
+        """
+        Description
+        ----------
+        Splits leaf key into its 4 children, returns the keys of the children.
+        """
+        fId = self.leaves.pop(key)
+        if self.fid_keys.get(fId) == key :
+            del self.fid_keys[fId]
+            self.split_fids.add(fId)
+        level, i, j = key
+        children = [ (level + 1, 2*i + di, 2*j + dj) for dj in (0, 1) for di in (0, 1) ]
+        for child in children :
+            self.leaves[child] = fId
+        return(children)
+
+    def refine(self, fIds, nlevels = 1, max_diff = 1):
+        """
+        Description
+        ----------
+        Splits the cells fIds nlevels times (n = m = 2**nlevels), then splits
+        neighbor leaves until the level difference between face neighbors
+        does not exceed max_diff (1 for the 2:1 balance of nested grids).
+        Balance is propagated with a worklist of new leaves.
+
+        Parameters
+        ----------
+        fIds : ids of the cells to refine
+        nlevels : number of levels of refinement
+        max_diff : maximum level difference between face neighbors, None for no check
+
+        Returns
+        -------
+        Number of leaves split
+        """
+        nsplit = 0
+        work = deque()
+
+        # refine selected cells
+        for fId in fIds :
+            key = self.fid_keys.get(fId)
+            if key is None :
+                continue
+            keys = [key]
+            for k in range(nlevels):
+                keys = [ child for key in keys for child in self.split(key) ]
+                nsplit += 4**k
+            work.extend(keys)
+
+        if max_diff is None :
+            return(nsplit)
+
+        # balance refinement
+        while len(work) > 0 :
+            key = work.popleft()
+            if key not in self.leaves :
+                continue
+            level, i, j = key
+            for di, dj in QUADTREE_DIRECTIONS.values():
+                neighbor = self.find_leaf(level, i + di, j + dj)
+                if neighbor is not None and neighbor[0] < level - max_diff :
+                    work.extend( self.split(neighbor) )
+                    nsplit += 1
+                    # check key again against the refined neighbor
+                    work.append(key)
+                    break
+
+        return(nsplit)
+
+    def bounds(self, keys):
+        """
+        Description
+        ----------
+        Bounds of leaves keys
+
+        Returns
+        -------
+        (xmin, ymin, xmax, ymax) arrays
+        """
+        level, i, j = np.array(keys, dtype=np.int64).reshape(-1, 3).T
+        dx, dy = self.dx0 / 2.**level, self.dy0 / 2.**level
+        xmin, ymin = self.xoff + i * dx, self.yoff + j * dy
+        return(xmin, ymin, xmin + dx, ymin + dy)
+
+    # ------ output
+    def write(self, grid_layer):
+        """
+        Description
+        ----------
+        Writes the leaves stemming from split cells to grid_layer : split cells are
+        deleted and replaced by their leaves, which inherit their attributes.
+        New features ids are not tracked : build a new QuadTree before
+        any further refinement.
+
+        Returns
+        -------
+        List of ids of new features, False if the leaves could not be written
+        (grid_layer is then left unchanged)
+        """
+        provider = grid_layer.dataProvider()
+        split_fids = sorted(self.split_fids)
+
+        # attributes of split cells
+        request = QgsFeatureRequest().setFilterFids(split_fids).setFlags(QgsFeatureRequest.NoGeometry)
+        attrs = { feat.id():feat.attributes() for feat in grid_layer.getFeatures(request) }
+
+        # new leaves, grouped by original cell
+        new_keys = {}
+        for key, fId in self.leaves.items():
+            if fId in self.split_fids :
+                new_keys.setdefault(fId, []).append(key)
+
+        # leaves are added before their parents are deleted, so that
+        # a failed write leaves the grid unchanged
+        newFeatIds = []
+        out_feat_list = []
+        for fId in split_fids :
+            keys = sorted( new_keys[fId] )
+            out_feat_list.extend( wkb_to_features( rect_wkb( *self.bounds(keys) ), attrs[fId] ) )
+            if len(out_feat_list) >= BATCH_SIZE or fId == split_fids[-1] :
+                success, newFeatures = provider.addFeatures(out_feat_list)
+                if not success :
+                    print("Error adding quadtree leaves to " + grid_layer.name())
+                    provider.deleteFeatures(newFeatIds)
+                    return(False)
+                newFeatIds.extend( [feat.id() for feat in newFeatures] )
+                out_feat_list = []
+
+        if not provider.deleteFeatures(split_fids) :
+            print("Error deleting split cells from " + grid_layer.name())
+            provider.deleteFeatures(newFeatIds)
+            return(False)
+
+        # split cells are now written
+        self.split_fids = set()
+        invalidate_grid_cache(grid_layer)
+
+        return(newFeatIds)
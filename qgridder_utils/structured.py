@@ -0,0 +1,456 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ qgridder_utils_structured.py
+                                 Qgridder - A QGIS plugin
+
+ This file gathers the implicit representation of structured (modflow-like)
+ grids, defined by their origin and cell dimensions delr and delc.
+
+ Qgridder builds 2D regular and unstructured grids and comes together with
+ pre- and post-processing capabilities for spatially distributed modeling.
+
+                              -------------------
+        begin                : 2013-04-08
+        copyright            : (C) 2013 by Pryet
+        email                : alexandre.pryet@ensegid.fr
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from qgis.PyQt.QtCore import QVariant
+from qgis.core import *
+
+import numpy as np
+
+from .base import BATCH_SIZE, MAX_DECIMALS, WKB_POLYGON_DTYPE, rgrid_wkb, wkb_to_features, \
+        FixSet, split_cells, change_attribute_values, get_grid_cache, get_rgrid_descriptor
+
+# ======================================================================================
+class StructuredGrid(object):
+    """
+    Structured (modflow-like) grid held by its top-left corner (xoff, yoff),
+    the column widths delr (along x) and the row heights delc (along y).
+    Following modflow conventions, row 0 is the top row and column 0 the left column.
+    Cell geometries are never stored : bounds, centroids and neighbors are computed
+    from delr and delc, and polygons are only built when a layer is requested.
+
+    Examples
+    --------
+    >>> sgrid = StructuredGrid(0., 100., delr = [10.]*10, delc = [10.]*10)
+    >>> row, col = sgrid.rowcol([15.], [42.])
+    """
+
+    def __init__(self, xoff, yoff, delr, delc):
+        self.xoff = float(xoff)
+        self.yoff = float(yoff)
+        self.delr = np.atleast_1d( np.asarray(delr, dtype=np.float64) )
+        self.delc = np.atleast_1d( np.asarray(delc, dtype=np.float64) )
+
+    # ------ constructors
+    @classmethod
+    def from_extent(cls, bbox, nrow, ncol):
+        """
+        Description
+        ----------
+        Regular grid of nrow rows and ncol columns over QgsRectangle bbox,
+        as built by make_rgrid.
+
+        Examples
+        --------
+        >>> sgrid = StructuredGrid.from_extent(grid_layer.extent(), 100, 200)
+        """
+        delr = np.diff( np.linspace(bbox.xMinimum(), bbox.xMaximum(), ncol + 1) )
+        delc = -np.diff( np.linspace(bbox.yMaximum(), bbox.yMinimum(), nrow + 1) )
+        return cls(bbox.xMinimum(), bbox.yMaximum(), delr, delc)
+
+    @classmethod
+    def from_bounds(cls, xmin, ymin, xmax, ymax, decimals = MAX_DECIMALS):
+        """
+        Description
+        ----------
+        Structured grid from the bounds of its cells (arrays, in any order).
+        Edges are the unique cell bounds rounded to decimals.
+
+        Examples
+        --------
+        >>> sgrid = StructuredGrid.from_bounds(xmin, ymin, xmax, ymax)
+        """
+        x_edges = np.unique( np.around( np.concatenate( (xmin, xmax) ), decimals) )
+        y_edges = np.unique( np.around( np.concatenate( (ymin, ymax) ), decimals) )[::-1]
+        return cls(x_edges[0], y_edges[0], np.diff(x_edges), -np.diff(y_edges))
+
+    @classmethod
+    def from_layer(cls, grid_layer):
+        """
+        Description
+        ----------
+        Structured grid from a (modflow-like) grid layer
+
+        Examples
+        --------
+        >>> sgrid = StructuredGrid.from_layer(grid_layer)
+        """
+        descriptor = get_rgrid_descriptor(grid_layer)
+        return cls(descriptor['xoff'], descriptor['yoff'], descriptor['delr'], descriptor['delc'])
+
+    # ------ dimensions
+    @property
+    def nrow(self):
+        return self.delc.size
+
+    @property
+    def ncol(self):
+        return self.delr.size
+
+    @property
+    def shape(self):
+        return (self.nrow, self.ncol)
+
+    @property
+    def x_edges(self):
+        """ Column edges, from left to right (ncol+1 values) """
+        return self.xoff + np.concatenate( ([0.], np.cumsum(self.delr)) )
+
+    @property
+    def y_edges(self):
+        """ Row edges, from top to bottom (nrow+1 values) """
+        return self.yoff - np.concatenate( ([0.], np.cumsum(self.delc)) )
+
+    def extent(self):
+        """ QgsRectangle of the grid """
+        x, y = self.x_edges, self.y_edges
+        return QgsRectangle(x[0], y[-1], x[-1], y[0])
+
+    # ------ cell queries
+    def cell_bounds(self, row, col):
+        """
+        Description
+        ----------
+        Bounds of cells (row, col), row and col may be arrays
+
+        Returns
+        -------
+        (xmin, ymin, xmax, ymax)
+        """
+        row, col = np.asarray(row), np.asarray(col)
+        x, y = self.x_edges, self.y_edges
+        return( x[col], y[row+1], x[col+1], y[row] )
+
+    def centroids(self, row = None, col = None):
+        """
+        Description
+        ----------
+        Cell centers (cx, cy) of cells (row, col).
+        If row and col are None, returns (nrow, ncol) arrays for the whole grid.
+        """
+        x, y = self.x_edges, self.y_edges
+        xc, yc = 0.5*(x[:-1] + x[1:]), 0.5*(y[:-1] + y[1:])
+        if row is None and col is None :
+            return( np.meshgrid(xc, yc) )
+        return( xc[np.asarray(col)], yc[np.asarray(row)] )
+
+    def rowcol(self, x, y):
+        """
+        Description
+        ----------
+        Row and column of the cells containing points (x, y).
+        Points outside the grid are given row = col = -1.
+
+        Returns
+        -------
+        (row, col) integer arrays
+        """
+        x = np.atleast_1d( np.asarray(x, dtype=np.float64) )
+        y = np.atleast_1d( np.asarray(y, dtype=np.float64) )
+        x_edges, y_edges = self.x_edges, self.y_edges
+        col = np.searchsorted(x_edges, x, side='right') - 1
+        # y edges are decreasing
+        row = np.searchsorted(-y_edges, -y, side='right') - 1
+        # points on the right and bottom boundaries belong to the last col and row
+        col[ x == x_edges[-1] ] = self.ncol - 1
+        row[ y == y_edges[-1] ] = self.nrow - 1
+        outside = (col < 0) | (col >= self.ncol) | (row < 0) | (row >= self.nrow)
+        row[outside] = -1
+        col[outside] = -1
+        return(row, col)
+
+    def neighbors(self, row, col):
+        """
+        Description
+        ----------
+        Face neighbors of cells (row, col), with the direction
+        codes of find_neighbors :
+        | 8 | 1 | 5 |
+        | 4 | 0 | 2 |
+        | 7 | 3 | 6 |
+        Missing neighbors (grid boundary) are given row = col = -1.
+
+        Returns
+        -------
+        { 1:(row, col), 2:(row, col), 3:(row, col), 4:(row, col) }
+        """
+        row, col = np.asarray(row), np.asarray(col)
+        out = {}
+        for direction, (drow, dcol) in zip( (1, 2, 3, 4), ((-1, 0), (0, 1), (1, 0), (0, -1)) ):
+            nrow, ncol = row + drow, col + dcol
+            valid = (nrow >= 0) & (nrow < self.nrow) & (ncol >= 0) & (ncol < self.ncol)
+            out[direction] = ( np.where(valid, nrow, -1), np.where(valid, ncol, -1) )
+        return(out)
+
+    def nearest_cells(self, x, y, k = 1):
+        """
+        Description
+        ----------
+        k nearest cell centers of points (x, y), by index arithmetic : candidates
+        are the cells of a window of rows and columns around the cell of each point
+        (or the closest cell, for points outside the grid). The window is expanded
+        until the k-th distance does not exceed the distance to any cell center
+        out of the window, so that results are exact.
+
+        Returns
+        -------
+        (row, col, dist) arrays of shape (npoints, k), sorted by increasing distance
+
+        Examples
+        --------
+        >>> row, col, dist = sgrid.nearest_cells(x, y, k = 3)
+        """
+        x = np.atleast_1d( np.asarray(x, dtype=np.float64) )
+        y = np.atleast_1d( np.asarray(y, dtype=np.float64) )
+        k = min( int(k), self.nrow*self.ncol )
+        xc, yc = self.centroids(row = np.arange(self.nrow), col = np.arange(self.ncol))
+
+        # closest row and column of each point (yc is decreasing)
+        col0 = np.clip( np.searchsorted(self.x_edges, x, side='right') - 1, 0, self.ncol - 1 )
+        row0 = np.clip( np.searchsorted(-self.y_edges, -y, side='right') - 1, 0, self.nrow - 1 )
+
+        out_row = np.zeros( (x.size, k), dtype=int )
+        out_col = np.zeros( (x.size, k), dtype=int )
+        out_dist = np.zeros( (x.size, k) )
+
+        todo = np.arange(x.size)
+        half = int( np.ceil( np.sqrt(k) / 2. ) )
+        while todo.size > 0 :
+            # window of rows and columns, clipped to the grid
+            r0 = np.clip(row0[todo] - half, 0, max(self.nrow - 2*half - 1, 0))
+            c0 = np.clip(col0[todo] - half, 0, max(self.ncol - 2*half - 1, 0))
+            wrow = np.minimum( r0[:, None] + np.arange(2*half + 1), self.nrow - 1 )
+            wcol = np.minimum( c0[:, None] + np.arange(2*half + 1), self.ncol - 1 )
+            crow = np.repeat(wrow, wcol.shape[1], axis=1)
+            ccol = np.tile(wcol, (1, wrow.shape[1]))
+            dist = np.hypot( xc[ccol] - x[todo, None], yc[crow] - y[todo, None] )
+            # duplicated candidates (window larger than the grid) are discarded
+            rdup = np.zeros(wrow.shape, dtype=bool)
+            rdup[:, 1:] = wrow[:, 1:] == wrow[:, :-1]
+            cdup = np.zeros(wcol.shape, dtype=bool)
+            cdup[:, 1:] = wcol[:, 1:] == wcol[:, :-1]
+            dist[ (rdup[:, :, None] | cdup[:, None, :]).reshape(dist.shape) ] = np.inf
+            order = np.argsort(dist, axis=1, kind='stable')[:, :k]
+            kdist = np.take_along_axis(dist, order, axis=1)
+
+            # smallest distance to cell centers out of the window
+            rmin, rmax, cmin, cmax = wrow[:, 0], wrow[:, -1], wcol[:, 0], wcol[:, -1]
+            bound = np.full(todo.size, np.inf)
+            bound = np.where( cmin > 0, np.minimum(bound, x[todo] - xc[cmin - 1]), bound )
+            bound = np.where( cmax < self.ncol - 1,
+                    np.minimum(bound, xc[np.minimum(cmax + 1, self.ncol - 1)] - x[todo]), bound )
+            bound = np.where( rmin > 0, np.minimum(bound, yc[rmin - 1] - y[todo]), bound )
+            bound = np.where( rmax < self.nrow - 1,
+                    np.minimum(bound, y[todo] - yc[np.minimum(rmax + 1, self.nrow - 1)]), bound )
+
+            done = kdist[:, -1] <= bound
+            pts = todo[done]
+            out_row[pts] = np.take_along_axis(crow[done], order[done], axis=1)
+            out_col[pts] = np.take_along_axis(ccol[done], order[done], axis=1)
+            out_dist[pts] = kdist[done]
+
+            todo = todo[~done]
+            half *= 2
+
+        return(out_row, out_col, out_dist)
+
+    # ------ refinement
+    def refine(self, rows = [], cols = [], n = 1, m = 1):
+        """
+        Description
+        ----------
+        Splits rows into n rows and columns into m columns of equal size.
+
+        Parameters
+        ----------
+        rows : rows to split (0-based)
+        cols : columns to split (0-based)
+        n, m : number of parts for each row and column, respectively
+
+        Returns
+        -------
+        (sgrid, row_start, col_start) : the refined StructuredGrid and, for each
+        row (resp. column) of the current grid, the index of its first
+        row (resp. column) in the refined grid.
+
+        Examples
+        --------
+        >>> new_sgrid, row_start, col_start = sgrid.refine(rows = [2, 3], n = 2)
+        """
+        nsplit_row = np.ones(self.nrow, dtype=int)
+        nsplit_row[ np.asarray(rows, dtype=int) ] = n
+        nsplit_col = np.ones(self.ncol, dtype=int)
+        nsplit_col[ np.asarray(cols, dtype=int) ] = m
+
+        delc = np.repeat(self.delc / nsplit_row, nsplit_row)
+        delr = np.repeat(self.delr / nsplit_col, nsplit_col)
+        row_start = np.concatenate( ([0], np.cumsum(nsplit_row)[:-1]) )
+        col_start = np.concatenate( ([0], np.cumsum(nsplit_col)[:-1]) )
+
+        return( StructuredGrid(self.xoff, self.yoff, delr, delc), row_start, col_start )
+
+    # ------ geometries
+    def iter_features(self, chunk_size = BATCH_SIZE):
+        """
+        Description
+        ----------
+        Generator over the cells of the grid, built by chunks of rows,
+        from top-left to bottom-right. Features hold the attributes
+        ROW, COL, CX, CY (see fields()), rows and columns are 0-based.
+
+        Returns
+        -------
+        Generator of lists of QgsFeature
+        """
+        x, y = self.x_edges, self.y_edges
+        ncol = self.ncol
+        nrows_chunk = max(1, chunk_size // ncol)
+        xc = 0.5*(x[:-1] + x[1:])
+        for i in range(0, self.nrow, nrows_chunk):
+            rows = np.arange(i, min(i + nrows_chunk, self.nrow))
+            # rgrid_wkb expects increasing y, reorder cells from top to bottom
+            y_band = y[rows[0]:rows[-1]+2][::-1]
+            wkb = np.frombuffer( rgrid_wkb(x, y_band), dtype=WKB_POLYGON_DTYPE
+                    ).reshape(rows.size, ncol)[::-1].tobytes()
+            feats = wkb_to_features(wkb, [])
+            yc = 0.5*(y[rows] + y[rows+1])
+            for k, feat in enumerate(feats):
+                row, col = rows[k // ncol], k % ncol
+                feat.setAttributes( [ int(row), int(col), float(xc[col]), float(yc[k // ncol]) ] )
+            yield(feats)
+
+    def fields(self):
+        """ QgsFields of the features generated by iter_features """
+        fields = QgsFields()
+        fields.append(QgsField("ROW", QVariant.Int))
+        fields.append(QgsField("COL", QVariant.Int))
+        fields.append(QgsField("CX", QVariant.Double))
+        fields.append(QgsField("CY", QVariant.Double))
+        return(fields)
+
+    def to_layer(self, crs = None, name = 'grid'):
+        """
+        Description
+        ----------
+        Builds a memory polygon layer with the cells of the grid
+
+        Examples
+        --------
+        >>> grid_layer = StructuredGrid.from_extent(bbox, 100, 100).to_layer(crs)
+        """
+        uri = "Polygon" if crs is None else "Polygon?crs=" + crs.authid()
+        grid_layer = QgsVectorLayer(uri, name, 'memory')
+        provider = grid_layer.dataProvider()
+        provider.addAttributes( self.fields().toList() )
+        grid_layer.updateFields()
+        for feats in self.iter_features():
+            provider.addFeatures(feats)
+        grid_layer.updateExtents()
+        return(grid_layer)
+
+
+
+# ======================================================================================
+def refine_structured(featIds, n, m, grid_layer, grid_index = None):
+    """
+    Description
+    ----------
+    Refinement of structured (modflow-like) grids : the rows and columns of
+    the features featIds are split into n rows and m columns, respectively.
+    Only the cells of these rows and columns are replaced in grid_layer,
+    other cells are kept and, if the layer has ROW and COL fields,
+    their numbering is updated.
+
+    Parameters
+    ----------
+    featIds : ids of features from grid_layer to be refined
+    n : number of split for the rows of selected cells
+    m : number of split for the columns of selected cells
+    grid_layer : structured grid layer to be refined
+    grid_index (optional) : GridIndex of grid_layer, updated with the new cells
+
+    Returns
+    -------
+    List of ids of new features
+
+    Examples
+    --------
+    >>> newFeatIds = refine_structured(grid_layer.selectedFeatureIds(), 2, 2, grid_layer)
+    """
+
+    # Fetch cell bounds
+    grid_cache = get_grid_cache(grid_layer)
+    fIds = grid_cache.fids
+    xmin, ymin, xmax, ymax = grid_cache.xmin, grid_cache.ymin, grid_cache.xmax, grid_cache.ymax
+
+    # current grid and cell numbering
+    sgrid = StructuredGrid.from_bounds(xmin, ymin, xmax, ymax)
+    row, col = sgrid.rowcol( 0.5*(xmin + xmax), 0.5*(ymin + ymax) )
+
+    # rows and columns to split
+    selected = np.isin(fIds, np.asarray(featIds, dtype=np.int64))
+    rows = np.unique(row[selected]) if n > 1 else np.array([], dtype=int)
+    cols = np.unique(col[selected]) if m > 1 else np.array([], dtype=int)
+
+    new_sgrid, row_start, col_start = sgrid.refine(rows, cols, n, m)
+
+    # split cells of the selected rows and columns
+    in_rows, in_cols = np.isin(row, rows), np.isin(col, cols)
+    affected = in_rows | in_cols
+    fix_dict = FixSet( fIds[affected], np.where(in_rows[affected], n, 1),
+            np.where(in_cols[affected], m, 1) )
+    newFeatIds = split_cells(fix_dict, grid_layer, grid_index)
+
+    # update numbering, if any
+    fields = grid_layer.fields()
+    row_field_idx, col_field_idx = fields.indexFromName('ROW'), fields.indexFromName('COL')
+    cx_field_idx, cy_field_idx = fields.indexFromName('CX'), fields.indexFromName('CY')
+    if row_field_idx == -1 or col_field_idx == -1 :
+        return(newFeatIds)
+
+    attr_map = {}
+    # cells kept, shifted by the inserted rows and columns
+    kept = ~affected
+    new_row, new_col = row_start[row[kept]], col_start[col[kept]]
+    shifted = (new_row != row[kept]) | (new_col != col[kept])
+    for fId, r, c in zip( fIds[kept][shifted], new_row[shifted], new_col[shifted] ):
+        attr_map[int(fId)] = { row_field_idx:int(r), col_field_idx:int(c) }
+
+    # new cells
+    request = QgsFeatureRequest().setFilterFids(newFeatIds).setNoAttributes()
+    for feat in grid_layer.getFeatures(request):
+        center = feat.geometry().boundingBox().center()
+        r, c = new_sgrid.rowcol( [center.x()], [center.y()] )
+        attr = { row_field_idx:int(r[0]), col_field_idx:int(c[0]) }
+        if cx_field_idx != -1 and cy_field_idx != -1 :
+            attr[cx_field_idx] = round(center.x(), MAX_DECIMALS)
+            attr[cy_field_idx] = round(center.y(), MAX_DECIMALS)
+        attr_map[feat.id()] = attr
+
+    change_attribute_values(grid_layer, attr_map)
+
+    return(newFeatIds)
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ qgridder_utils_traversal.py
+                                 Qgridder - A QGIS plugin
+
+ This file gathers the traversal of grid cells by polylines, with the
+ length of polyline within each cell (e.g. river or drain conductance).
+
+ Qgridder builds 2D regular and unstructured grids and comes together with
+ pre- and post-processing capabilities for spatially distributed modeling.
+
+                              -------------------
+        begin                : 2013-04-08
+        copyright            : (C) 2013 by Pryet
+        email                : alexandre.pryet@ensegid.fr
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from qgis.core import *
+
+import numpy as np
+
+from .base import TOLERANCE, get_grid_cache, get_grid_spatial_index, get_rgrid_descriptor, is_rgrid
+from .structured import StructuredGrid
+
+# ======================================================================================
+def polyline_parts(geometry):
+    """
+    Description
+    ----------
+    Vertices of the parts of a (multi)polyline geometry
+
+    Returns
+    -------
+    List of (nvertices, 2) arrays
+
+    Examples
+    --------
+    >>> parts = polyline_parts(pline.geometry())
+    """
+    if geometry.isMultipart() :
+        parts = geometry.asMultiPolyline()
+    else :
+        parts = [ geometry.asPolyline() ]
+    return( [ np.array( [ (point.x(), point.y()) for point in part ], dtype=np.float64 ).reshape(-1, 2)
+        for part in parts ] )
+
+
+def _aggregate(keys, lengths, t_order):
+    """
+    Sums lengths by cell key, cells being sorted by order of traversal (t_order)
+    """
+    order = np.argsort(t_order, kind='stable')
+    keys, lengths = keys[order], lengths[order]
+    unique_keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    total = np.bincount(inverse, weights=lengths, minlength=unique_keys.size)
+    visit = np.argsort(first, kind='stable')
+    return( unique_keys[visit], total[visit] )
+
+
+# ======================================================================================
+def traverse_structured(sgrid, parts):
+    """
+    Description
+    ----------
+    Cells of a StructuredGrid crossed by polyline parts, with the length
+    of polyline within each cell. For each segment, crossings with column
+    and row edges are found by binary search (Amanatides-Woo traversal, vectorized),
+    so that the cost is proportional to the number of cells crossed.
+
+    Parameters
+    ----------
+    sgrid : StructuredGrid
+    parts : list of (nvertices, 2) arrays, see polyline_parts
+
+    Returns
+    -------
+    (row, col, length) arrays, cells sorted by order of traversal
+
+    Examples
+    --------
+    >>> row, col, length = traverse_structured(sgrid, polyline_parts(pline.geometry()))
+    """
+    x_edges = sgrid.x_edges
+    # increasing y edges
+    y_edges = sgrid.y_edges[::-1]
+
+    keys, lengths, t_order = [], [], []
+    t_offset = 0.
+    for xy in parts :
+        for (x0, y0), (x1, y1) in zip(xy[:-1], xy[1:]) :
+            seg_length = np.hypot(x1 - x0, y1 - y0)
+            if seg_length == 0 :
+                continue
+            t = [ np.array([0., 1.]) ]
+            if x1 != x0 :
+                lo = np.searchsorted(x_edges, min(x0, x1), side='right')
+                hi = np.searchsorted(x_edges, max(x0, x1), side='left')
+                t.append( (x_edges[lo:hi] - x0) / (x1 - x0) )
+            if y1 != y0 :
+                lo = np.searchsorted(y_edges, min(y0, y1), side='right')
+                hi = np.searchsorted(y_edges, max(y0, y1), side='left')
+                t.append( (y_edges[lo:hi] - y0) / (y1 - y0) )
+            t = np.unique( np.concatenate(t) )
+
+            # cell of each piece, from its mid-point
+            tm = 0.5*(t[:-1] + t[1:])
+            row, col = sgrid.rowcol( x0 + tm*(x1 - x0), y0 + tm*(y1 - y0) )
+            inside = row >= 0
+            keys.append( row[inside]*sgrid.ncol + col[inside] )
+            lengths.append( np.diff(t)[inside]*seg_length )
+            t_order.append( t_offset + tm[inside] )
+            t_offset += 1.
+
+    if len(keys) == 0 :
+        return( np.array([], dtype=int), np.array([], dtype=int), np.array([]) )
+
+    keys, lengths = _aggregate( np.concatenate(keys), np.concatenate(lengths), np.concatenate(t_order) )
+    row, col = np.divmod(keys, sgrid.ncol)
+    return(row, col, lengths)
+
+
+# ======================================================================================
+def clip_segment(x0, y0, x1, y1, xmin, ymin, xmax, ymax):
+    """
+    Description
+    ----------
+    Liang-Barsky clipping of segment (x0, y0)-(x1, y1) by rectangles
+    of bounds xmin, ymin, xmax, ymax (arrays), vectorized over rectangles.
+
+    Returns
+    -------
+    (t_enter, t_exit) arrays, parameters of the clipped segment along (x0, y0)-(x1, y1).
+    The segment does not cross the rectangle if t_exit <= t_enter.
+    """
+    dx, dy = x1 - x0, y1 - y0
+    t_enter = np.zeros(xmin.shape)
+    t_exit = np.ones(xmin.shape)
+    for p, q in ( (-dx, x0 - xmin), (dx, xmax - x0), (-dy, y0 - ymin), (dy, ymax - y0) ) :
+        if p == 0 :
+            # parallel to this edge : outside if q < 0
+            t_exit = np.where(q < 0, -1., t_exit)
+            continue
+        t = q / p
+        if p < 0 :
+            t_enter = np.maximum(t_enter, t)
+        else :
+            t_exit = np.minimum(t_exit, t)
+    return(t_enter, t_exit)
+
+
+def walk_segment(x0, y0, x1, y1, grid_cache, index, tol = TOLERANCE):
+    """
+    Description
+    ----------
+    Cells of a grid touched by segment (x0, y0)-(x1, y1), walking from cell to cell :
+    the cells around the current point are fetched from the spatial index and
+    clipped with the Liang-Barsky algorithm, the walk then moves to the nearest exit.
+    The cost is proportional to the number of cells touched, whatever the
+    size of the smallest cells of the grid. Gaps (e.g. out of the grid) are
+    crossed by pieces of the size of the largest cells.
+
+    Parameters
+    ----------
+    x0, y0, x1, y1 : segment coordinates
+    grid_cache : GridCache of the grid
+    index : spatial index of the grid, see get_grid_spatial_index
+    tol : absolute tolerance used to find the cells around a point
+
+    Returns
+    -------
+    (fids, t_enter, t_exit) arrays, parameters of the clipped segment within each cell,
+    in order of traversal. Cells only touched at a point have t_exit == t_enter.
+
+    Examples
+    --------
+    >>> fids, t_enter, t_exit = walk_segment(x0, y0, x1, y1, grid_cache, get_grid_spatial_index(grid_layer))
+    """
+    seg_length = np.hypot(x1 - x0, y1 - y0)
+    if seg_length == 0 or len(grid_cache) == 0 :
+        return( np.array([], dtype=np.int64), np.array([]), np.array([]) )
+
+    # tolerance along the segment, step across gaps
+    t_tol = tol / seg_length
+    t_gap = max( np.max(grid_cache.dx), np.max(grid_cache.dy) ) / seg_length
+
+    def clip(candidates):
+        fids = np.array( sorted(candidates), dtype=np.int64 )
+        pos = grid_cache.positions(fids)
+        t_enter, t_exit = clip_segment(x0, y0, x1, y1, grid_cache.xmin[pos], grid_cache.ymin[pos],
+                grid_cache.xmax[pos], grid_cache.ymax[pos])
+        return(fids, t_enter, t_exit)
+
+    touched = {}
+    t = 0.
+    while t < 1. - t_tol :
+        # cells around the current point
+        px, py = x0 + t*(x1 - x0), y0 + t*(y1 - y0)
+        candidates = index.intersects( QgsRectangle(px - tol, py - tol, px + tol, py + tol) )
+        if len(candidates) > 0 :
+            fids, t_enter, t_exit = clip(candidates)
+            touch = (t_enter <= t + t_tol) & (t_exit >= t - t_tol)
+            for fid, te, tx in zip( fids[touch].tolist(), t_enter[touch].tolist(), t_exit[touch].tolist() ) :
+                touched.setdefault(fid, (te, tx))
+            forward = touch & (t_exit > t + t_tol)
+            if np.any(forward) :
+                t = np.min(t_exit[forward])
+                continue
+
+        # gap : next cell along the segment, by pieces of the size of the largest cells
+        t_next = None
+        while t_next is None and t < 1. - t_tol :
+            t_end = min(1., t + t_gap)
+            candidates = index.intersects( QgsRectangle( min(px, x0 + t_end*(x1 - x0)) - tol,
+                min(py, y0 + t_end*(y1 - y0)) - tol, max(px, x0 + t_end*(x1 - x0)) + tol,
+                max(py, y0 + t_end*(y1 - y0)) + tol ) )
+            if len(candidates) > 0 :
+                fids, t_enter, t_exit = clip(candidates)
+                ahead = (t_exit > t + t_tol) & (t_exit >= t_enter)
+                if np.any(ahead) :
+                    t_next = max( t + t_tol, np.min(t_enter[ahead]) )
+            if t_next is None :
+                t, px, py = t_end, x0 + t_end*(x1 - x0), y0 + t_end*(y1 - y0)
+        if t_next is None :
+            break
+        t = t_next
+
+    if len(touched) == 0 :
+        return( np.array([], dtype=np.int64), np.array([]), np.array([]) )
+
+    fids = np.array( list(touched.keys()), dtype=np.int64 )
+    t_enter, t_exit = np.array( list(touched.values()) ).T
+    order = np.argsort(t_enter, kind='stable')
+    return( fids[order], t_enter[order], t_exit[order] )
+
+
+def traverse_cells(grid_layer, parts):
+    """
+    Description
+    ----------
+    Cells of any grid layer (e.g. nested grid) crossed by polyline parts,
+    with the length of polyline within each cell.
+    Segments are walked from cell to cell (see walk_segment).
+
+    Parameters
+    ----------
+    grid_layer : grid layer
+    parts : list of (nvertices, 2) arrays, see polyline_parts
+
+    Returns
+    -------
+    (fids, length) arrays, cells sorted by order of traversal
+
+    Examples
+    --------
+    >>> fids, length = traverse_cells(grid_layer, polyline_parts(pline.geometry()))
+    """
+    grid_cache = get_grid_cache(grid_layer)
+    index = get_grid_spatial_index(grid_layer)
+
+    keys, lengths, t_order = [], [], []
+    t_offset = 0.
+    for xy in parts :
+        for (x0, y0), (x1, y1) in zip(xy[:-1], xy[1:]) :
+            fids, t_enter, t_exit = walk_segment(x0, y0, x1, y1, grid_cache, index)
+            crossed = t_exit > t_enter
+            keys.append( fids[crossed] )
+            lengths.append( (t_exit - t_enter)[crossed]*np.hypot(x1 - x0, y1 - y0) )
+            t_order.append( t_offset + t_enter[crossed] )
+            t_offset += 1.
+
+    if len(keys) == 0 :
+        return( np.array([], dtype=np.int64), np.array([]) )
+
+    return( _aggregate( np.concatenate(keys), np.concatenate(lengths), np.concatenate(t_order) ) )
+
+
+# ======================================================================================
+def pline_ndist(parts, x, y, max_distances = 10**7):
+    """
+    Description
+    ----------
+    Normalized curvilinear abscissa (ndist) of the projection of points (x, y)
+    onto a polyline : distance from the polyline origin to the projection,
+    divided by the polyline length. Points are projected onto all segments
+    at once and the closest projection is kept.
+    Parts of multi-polylines are chained in their order.
+
+    Parameters
+    ----------
+    parts : list of (nvertices, 2) arrays, see polyline_parts
+    x, y : arrays of point coordinates (e.g. cell centroids)
+    max_distances : maximum number of point-segment distances computed at once
+
+    Returns
+    -------
+    Array of ndist values in [0, 1], nan if the polyline has no segment
+
+    Examples
+    --------
+    >>> ndist = pline_ndist(polyline_parts(pline.geometry()), cx, cy)
+    """
+    x = np.atleast_1d( np.asarray(x, dtype=np.float64) )
+    y = np.atleast_1d( np.asarray(y, dtype=np.float64) )
+    # parts of less than 2 vertices have no segment
+    parts = [ xy for xy in parts if xy.shape[0] > 1 ]
+    if len(parts) == 0 :
+        return( np.full(x.size, np.nan) )
+    start = np.concatenate( [ xy[:-1] for xy in parts ] )
+    end = np.concatenate( [ xy[1:] for xy in parts ] )
+    dx, dy = end[:,0] - start[:,0], end[:,1] - start[:,1]
+    seg_length2 = dx**2 + dy**2
+    seg_length = np.sqrt(seg_length2)
+    cumdist = np.concatenate( ([0.], np.cumsum(seg_length)[:-1]) )
+    total = seg_length.sum()
+    # degenerate segments project onto their start point
+    inv_length2 = np.divide(1., seg_length2, out=np.zeros_like(seg_length2), where=seg_length2 > 0)
+
+    ndist = np.zeros(x.size)
+    step = max( 1, max_distances // max(start.shape[0], 1) )
+    for i in range(0, x.size, step) :
+        px = x[i:i+step, None] - start[None, :, 0]
+        py = y[i:i+step, None] - start[None, :, 1]
+        t = np.clip( (px*dx + py*dy) * inv_length2, 0., 1. )
+        dist2 = (px - t*dx)**2 + (py - t*dy)**2
+        k = np.argmin(dist2, axis=1)
+        tk = t[np.arange(k.size), k]
+        ndist[i:i+step] = cumdist[k] + tk*seg_length[k]
+
+    return( ndist / total if total > 0 else ndist )
+
+
+# ======================================================================================
+def get_pline_cells(pline_geom, grid_layer):
+    """
+    Description
+    ----------
+    Cells of grid_layer crossed by polyline geometry pline_geom, with the
+    length of polyline within each cell. Structured grids are traversed
+    along their edges (traverse_structured), other grids with traverse_cells.
+
+    Returns
+    -------
+    (fids, length) arrays, cells sorted by order of traversal
+
+    Examples
+    --------
+    >>> fids, length = get_pline_cells(pline.geometry(), grid_layer)
+    """
+    parts = polyline_parts(pline_geom)
+
+    if is_rgrid(grid_layer) :
+        descriptor = get_rgrid_descriptor(grid_layer)
+        row, col, length = traverse_structured( StructuredGrid.from_layer(grid_layer), parts )
+        return( descriptor['fids'][ row*descriptor['ncol'] + col ], length )
+
+    return( traverse_cells(grid_layer, parts) )
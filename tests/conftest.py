@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Test configuration.
+
+The tests cover the NumPy helpers of qgridder_utils, which do not need QGIS.
+When QGIS is not available, placeholder qgis and PyQt5 modules are registered
+so that qgridder_utils can be imported. Functions relying on QGIS objects
+are not tested here.
+"""
+
+import glob
+import os
+import re
+import sys
+import types
+
+ROOT = os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) )
+sys.path.insert(0, ROOT)
+
+
+class _Placeholder(type):
+    """ Any attribute of a placeholder class is a placeholder (e.g. QVariant.Double) """
+    def __getattr__(cls, name):
+        if name.startswith('__') :
+            raise AttributeError(name)
+        return _Placeholder(name, (object,), {})
+
+
+def _qt_names():
+    """ Qt and QGIS names used by qgridder_utils, exported by placeholder modules """
+    names = set()
+    for path in glob.glob( os.path.join(ROOT, 'qgridder_utils', '*.py') ) :
+        with open(path) as f :
+            names.update( re.findall(r'\b(Qgs[A-Z]\w*|Q[A-Z][a-z]\w*|Qt|Qgis|NULL)\b', f.read()) )
+    return sorted(names)
+
+
+class _PlaceholderModule(types.ModuleType):
+    """ Module returning a placeholder class for any name """
+
+    def __getattr__(self, name):
+        if name.startswith('__') :
+            raise AttributeError(name)
+        value = _Placeholder(name, (object,), {})
+        setattr(self, name, value)
+        return value
+
+
+def _register_placeholders(module_names):
+    names = _qt_names()
+    for name in module_names :
+        sys.modules[name] = _PlaceholderModule(name)
+        sys.modules[name].__all__ = names
+    for name in module_names :
+        parent, _, child = name.rpartition('.')
+        if parent :
+            setattr(sys.modules[parent], child, sys.modules[name])
+
+
+try :
+    import qgis.core
+except ImportError :
+    _register_placeholders( ['qgis', 'qgis.core', 'qgis.gui', 'qgis.PyQt', 'qgis.PyQt.QtCore',
+        'qgis.PyQt.QtGui', 'qgis.PyQt.QtWidgets'] )
+
+try :
+    import PyQt5.QtCore
+except ImportError :
+    _register_placeholders( ['PyQt5', 'PyQt5.QtCore', 'PyQt5.QtGui', 'PyQt5.QtWidgets'] )
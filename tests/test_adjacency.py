@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the face neighbors of rectangular cells.
+"""
+
+import numpy as np
+
+from qgridder_utils.adjacency import face_pairs
+
+
+def pairs(xmin, ymin, xmax, ymax):
+    src, dst, direction = face_pairs( np.asarray(xmin, dtype=np.float64), np.asarray(ymin, dtype=np.float64),
+            np.asarray(xmax, dtype=np.float64), np.asarray(ymax, dtype=np.float64) )
+    return( set( zip( src.tolist(), dst.tolist(), direction.tolist() ) ) )
+
+
+def test_face_pairs_regular():
+    # 2 x 2 grid : 0 bottom left, 1 bottom right, 2 top left, 3 top right
+    found = pairs( [0, 1, 0, 1], [0, 0, 1, 1], [1, 2, 1, 2], [1, 1, 2, 2] )
+    assert found == { (0, 2, 1), (2, 0, 3), (1, 3, 1), (3, 1, 3),
+            (0, 1, 2), (1, 0, 4), (2, 3, 2), (3, 2, 4) }
+
+
+def test_face_pairs_nested():
+    # cell 0 of size 2 on the left, four cells of size 1 on the right
+    found = pairs( [0, 2, 3, 2, 3], [0, 0, 0, 1, 1], [2, 3, 4, 3, 4], [2, 1, 1, 2, 2] )
+    right_of_0 = sorted( dst for src, dst, direction in found if src == 0 and direction == 2 )
+    assert right_of_0 == [1, 3]
+    assert (1, 0, 4) in found and (3, 0, 4) in found
+    # corner contacts are not faces
+    assert not any( src == 0 and dst in (2, 4) for src, dst, direction in found )
+    assert len(found) == 2 * 6
+
+
+def test_face_pairs_rounding():
+    found = pairs( [0, 1 + 1e-12], [0, 0], [1, 2], [1, 1] )
+    assert found == { (0, 1, 2), (1, 0, 4) }
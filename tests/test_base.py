@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the set of features to split.
+"""
+
+import numpy as np
+
+from qgridder_utils.base import FixSet
+
+
+def test_fixset_keeps_maximum():
+    fix_set = FixSet([12, 13], 2, 2)
+    fix_set.add(12, 4, 1)
+    fix_set.update( np.array( [13, 13, 14] ), np.array( [1, 3, 2] ), 5 )
+    assert len(fix_set) == 3
+    assert fix_set.fix == { 12:(4, 2), 13:(3, 5), 14:(2, 5) }
+    assert 14 in fix_set and 15 not in fix_set
+
+
+def test_fixset_fix_dict_compatibility():
+    fix_set = FixSet([1, 2], [2, 4], [3, 1])
+    assert fix_set['id'] == [1, 2]
+    assert fix_set['n'] == [2, 4]
+    assert fix_set['m'] == [3, 1]
+    fix_set.merge( { 'id':[2, 3], 'n':[1, 2], 'm':[2, 2] } )
+    assert fix_set.fix == { 1:(2, 3), 2:(4, 2), 3:(2, 2) }
+    fix_set.merge( FixSet([1], 8, 1) )
+    assert fix_set.fix[1] == (8, 3)
+
+
+def test_fixset_empty():
+    fix_set = FixSet()
+    assert len(fix_set) == 0
+    assert len( fix_set.update([], 2, 2) ) == 0
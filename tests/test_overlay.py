@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the overlay helpers : polygon areas over cells, point-in-polygon test
+and conservative remapping.
+"""
+
+import numpy as np
+import pytest
+from scipy import sparse
+
+from qgridder_utils.overlay import rect_polygon_areas, points_in_polygon, remap_values
+
+
+def unit_cells(n):
+    """ Bounds of the unit cells of a n x n grid with origin (0, 0) """
+    i, j = np.meshgrid( np.arange(n, dtype=np.float64), np.arange(n, dtype=np.float64) )
+    return( i.ravel(), j.ravel(), i.ravel() + 1., j.ravel() + 1. )
+
+
+def triangle_with_hole(exterior_ccw = True, hole_ccw = False):
+    """ Triangle of area 8 with a square hole of area 1 """
+    exterior = np.array( [ (0., 0.), (4., 0.), (0., 4.), (0., 0.) ] )
+    hole = np.array( [ (0.5, 0.5), (0.5, 1.5), (1.5, 1.5), (1.5, 0.5), (0.5, 0.5) ] )
+    if not exterior_ccw :
+        exterior = exterior[::-1]
+    if hole_ccw :
+        hole = hole[::-1]
+    return( [ [exterior, hole] ] )
+
+
+# ------ rect_polygon_areas
+@pytest.mark.parametrize('exterior_ccw', [True, False])
+@pytest.mark.parametrize('hole_ccw', [True, False])
+def test_areas_triangle_with_hole(exterior_ccw, hole_ccw):
+    areas = rect_polygon_areas( triangle_with_hole(exterior_ccw, hole_ccw), *unit_cells(4) )
+    assert np.isclose(areas.sum(), 7.)
+    # cell (0, 0)-(1, 1) is cut by a quarter of the hole
+    assert np.isclose(areas[0], 0.75)
+    # cells above the hypotenuse are empty, cells along it are half covered
+    assert np.isclose(areas[4*3 + 3], 0.)
+    assert np.isclose(areas[3], 0.5) and np.isclose(areas[4*3], 0.5)
+    assert np.all(areas >= -1e-12)
+
+
+def test_areas_rectangle_out_of_polygon():
+    areas = rect_polygon_areas( triangle_with_hole(), [10.], [10.], [11.], [11.] )
+    assert np.allclose(areas, 0.)
+
+
+def test_areas_cell_larger_than_polygon():
+    areas = rect_polygon_areas( triangle_with_hole(), [-1.], [-1.], [5.], [5.] )
+    assert np.isclose(areas[0], 7.)
+
+
+def test_areas_multipolygon():
+    square = np.array( [ (0., 0.), (1., 0.), (1., 1.), (0., 1.), (0., 0.) ] )
+    polygons = [ [square], [square + 2.] ]
+    areas = rect_polygon_areas( polygons, *unit_cells(4) )
+    assert np.isclose(areas.sum(), 2.)
+    assert np.isclose(areas[0], 1.) and np.isclose(areas[2*4 + 2], 1.)
+
+
+def test_areas_batches():
+    cells = unit_cells(4)
+    polygons = triangle_with_hole()
+    assert np.allclose( rect_polygon_areas(polygons, *cells, max_pairs = 3),
+            rect_polygon_areas(polygons, *cells) )
+
+
+# ------ points_in_polygon
+def test_points_in_polygon_hole():
+    x = np.array( [0.25, 1., 3.5, 2., -1.] )
+    y = np.array( [0.25, 1., 3.5, 1., 0.5] )
+    inside = points_in_polygon(x, y, triangle_with_hole(exterior_ccw = False))
+    assert inside.tolist() == [True, False, False, True, False]
+
+
+def test_points_in_polygon_batches():
+    rng = np.random.default_rng(0)
+    x, y = rng.uniform(-1., 5., 200), rng.uniform(-1., 5., 200)
+    polygons = triangle_with_hole()
+    assert np.array_equal( points_in_polygon(x, y, polygons, max_distances = 7),
+            points_in_polygon(x, y, polygons) )
+
+
+# ------ remap_values
+def overlap_matrix():
+    """
+    Two source cells of area 2 and three destination cells :
+    destination 0 overlaps both sources over 1, destination 1 overlaps
+    source 1 over 1, destination 2 overlaps no source.
+    """
+    return( sparse.csr_matrix( np.array( [ [1., 1.], [0., 1.], [0., 0.] ] ) ) )
+
+
+def test_remap_modes():
+    matrix = overlap_matrix()
+    values = np.array( [1., 4.] )
+    assert np.allclose( remap_values(matrix, values, 'mean')[:2], [2.5, 4.] )
+    assert np.allclose( remap_values(matrix, values, 'harmonic')[:2], [1.6, 4.] )
+    assert np.allclose( remap_values(matrix, values, 'geometric')[:2], [2., 4.] )
+    assert np.allclose( remap_values(matrix, values, 'sum', src_areas = [2., 2.])[:2], [2.5, 2.] )
+
+
+@pytest.mark.parametrize('mode', ['mean', 'harmonic', 'geometric', 'sum'])
+def test_remap_uncovered_is_nan(mode):
+    out = remap_values( overlap_matrix(), [1., 4.], mode, src_areas = [2., 2.] )
+    assert np.isnan(out[2])
+    assert np.all( np.isfinite(out[:2]) )
+
+
+@pytest.mark.parametrize('mode', ['mean', 'harmonic', 'geometric'])
+def test_remap_nan_sources_ignored(mode):
+    out = remap_values( overlap_matrix(), [np.nan, 4.], mode )
+    assert np.allclose(out[:2], 4.)
+    assert np.isnan(out[2])
+    # no valid source value at all
+    out = remap_values( overlap_matrix(), [np.nan, np.nan], mode )
+    assert np.all( np.isnan(out) )
+
+
+@pytest.mark.parametrize('mode', ['harmonic', 'geometric'])
+def test_remap_zero_values(mode):
+    with np.errstate(all = 'raise') :
+        out = remap_values( overlap_matrix(), [0., 4.], mode )
+    assert np.isclose(out[0], 0.)
+    assert np.isclose(out[1], 4.)
+
+
+def test_remap_fields_at_once():
+    values = np.array( [ [1., 10.], [4., np.nan] ] )
+    out = remap_values( overlap_matrix(), values, 'harmonic' )
+    assert out.shape == (3, 2)
+    assert np.allclose( out[:2, 0], [1.6, 4.] )
+    assert np.isclose(out[0, 1], 10.) and np.isnan(out[1, 1])
+
+
+def test_remap_sum_conserves_totals():
+    # destination cells cover the sources entirely
+    matrix = sparse.csr_matrix( np.array( [ [1., 0.5], [1., 1.5] ] ) )
+    values = np.array( [3., 7.] )
+    out = remap_values( matrix, values, 'sum', src_areas = [2., 2.] )
+    assert np.isclose(out.sum(), values.sum())
+
+
+def test_remap_errors():
+    with pytest.raises(ValueError) :
+        remap_values( overlap_matrix(), [1., 4.], 'median' )
+    with pytest.raises(ValueError) :
+        remap_values( overlap_matrix(), [1., 4.], 'sum' )
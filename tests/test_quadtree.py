@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the quadtree refinement of nested grids.
+"""
+
+import numpy as np
+
+from qgridder_utils.quadtree import QuadTree, QUADTREE_DIRECTIONS
+
+
+def regular_qtree(n):
+    """ Quadtree of a n x n grid of unit cells, feature ids from 1 """
+    i, j = np.meshgrid( np.arange(n, dtype=np.float64), np.arange(n, dtype=np.float64) )
+    xmin, ymin = i.ravel(), j.ravel()
+    return( QuadTree.from_bounds(np.arange(1, n*n + 1), xmin, ymin, xmin + 1., ymin + 1.) )
+
+
+def max_level_diff(qtree):
+    diff = 0
+    for level, i, j in qtree.leaves :
+        for di, dj in QUADTREE_DIRECTIONS.values():
+            neighbor = qtree.find_leaf(level, i + di, j + dj)
+            if neighbor is not None :
+                diff = max( diff, level - neighbor[0] )
+    return(diff)
+
+
+def test_from_bounds():
+    qtree = regular_qtree(4)
+    assert len(qtree.leaves) == 16
+    assert qtree.fid_keys[1] == (0, 0, 0)
+    assert qtree.fid_keys[16] == (0, 3, 3)
+
+
+def test_from_bounds_not_nested():
+    assert QuadTree.from_bounds([1, 2], [0., 1.], [0., 0.], [1., 4.], [1., 1.]) is None
+    assert QuadTree.from_bounds([1, 2], [0., 1.25], [0., 0.], [1., 2.25], [1., 1.]) is None
+    assert QuadTree.from_bounds([], [], [], [], []) is None
+
+
+def test_refine_balance():
+    qtree = regular_qtree(4)
+    nsplit = qtree.refine([1], nlevels = 3, max_diff = 1)
+    xmin, ymin, xmax, ymax = qtree.bounds( list(qtree.leaves) )
+    # leaves tile the grid
+    assert np.isclose( np.sum( (xmax - xmin) * (ymax - ymin) ), 16. )
+    assert max_level_diff(qtree) <= 1
+    assert nsplit > 1 + 4 + 16
+    assert 1 in qtree.split_fids and 1 not in qtree.fid_keys
+    # split cells keep the id of their original feature
+    assert set( qtree.leaves.values() ) == set( range(1, 17) )
+
+
+def test_refine_without_balance():
+    qtree = regular_qtree(4)
+    nsplit = qtree.refine([1], nlevels = 2, max_diff = None)
+    assert nsplit == 1 + 4
+    assert len(qtree.leaves) == 15 + 16
+    assert max_level_diff(qtree) == 2
+
+
+def test_refine_unknown_id():
+    qtree = regular_qtree(2)
+    assert qtree.refine([99]) == 0
+    assert len(qtree.leaves) == 4
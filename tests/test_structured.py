@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the implicit structured grid and of its nearest cell search.
+"""
+
+import numpy as np
+import pytest
+
+from qgridder_utils.structured import StructuredGrid
+
+
+def test_edges():
+    sgrid = StructuredGrid(0., 100., [10., 20., 30.], [5., 15.])
+    assert sgrid.shape == (2, 3)
+    assert np.allclose( sgrid.x_edges, [0., 10., 30., 60.] )
+    assert np.allclose( sgrid.y_edges, [100., 95., 80.] )
+
+
+def test_from_bounds():
+    sgrid = StructuredGrid(0., 100., [10., 20., 30.], [5., 15.])
+    row, col = np.meshgrid( np.arange(2), np.arange(3), indexing = 'ij' )
+    xmin, ymin, xmax, ymax = sgrid.cell_bounds(row.ravel(), col.ravel())
+    order = np.random.default_rng(0).permutation(xmin.size)
+    other = StructuredGrid.from_bounds(xmin[order], ymin[order], xmax[order], ymax[order])
+    assert np.allclose(other.delr, sgrid.delr) and np.allclose(other.delc, sgrid.delc)
+    assert (other.xoff, other.yoff) == (sgrid.xoff, sgrid.yoff)
+
+
+def test_cell_bounds_and_centroids():
+    sgrid = StructuredGrid(0., 100., [10., 20., 30.], [5., 15.])
+    xmin, ymin, xmax, ymax = sgrid.cell_bounds(1, 2)
+    assert (xmin, ymin, xmax, ymax) == (30., 80., 60., 95.)
+    xc, yc = sgrid.centroids(row = [0, 1], col = [0, 2])
+    assert np.allclose(xc, [5., 45.]) and np.allclose(yc, [97.5, 87.5])
+    xc, yc = sgrid.centroids()
+    assert xc.shape == (2, 3) and np.isclose(yc[0, 0], 97.5)
+
+
+def test_rowcol():
+    sgrid = StructuredGrid(0., 100., [10., 20., 30.], [5., 15.])
+    row, col = sgrid.rowcol( [5., 59., 60., 10., -1., 5.], [99., 81., 80., 95., 90., 101.] )
+    assert row.tolist() == [0, 1, 1, 1, -1, -1]
+    assert col.tolist() == [0, 2, 2, 1, -1, -1]
+
+
+def test_neighbors():
+    sgrid = StructuredGrid(0., 100., [10., 20., 30.], [5., 15.])
+    neighbors = sgrid.neighbors([0, 1], [0, 2])
+    assert neighbors[1][0].tolist() == [-1, 0]
+    assert neighbors[2][1].tolist() == [1, -1]
+    assert neighbors[3][0].tolist() == [1, -1]
+    assert neighbors[4][1].tolist() == [-1, 1]
+
+
+def brute_force(sgrid, x, y, k):
+    xc, yc = sgrid.centroids(row = np.arange(sgrid.nrow), col = np.arange(sgrid.ncol))
+    row, col = np.meshgrid( np.arange(sgrid.nrow), np.arange(sgrid.ncol), indexing = 'ij' )
+    row, col = row.ravel(), col.ravel()
+    dist = np.hypot( xc[col][None, :] - x[:, None], yc[row][None, :] - y[:, None] )
+    return( np.sort(dist, axis=1)[:, :k] )
+
+
+@pytest.mark.parametrize('k', [1, 3, 10])
+def test_nearest_cells(k):
+    rng = np.random.default_rng(0)
+    sgrid = StructuredGrid( 0., 100., rng.uniform(1., 10., 12), rng.uniform(1., 10., 9) )
+    x_edges, y_edges = sgrid.x_edges, sgrid.y_edges
+    # points within and out of the grid
+    x = rng.uniform(x_edges[0] - 20., x_edges[-1] + 20., 300)
+    y = rng.uniform(y_edges[-1] - 20., y_edges[0] + 20., 300)
+
+    row, col, dist = sgrid.nearest_cells(x, y, k = k)
+    assert row.shape == (300, k)
+    assert np.allclose( dist, brute_force(sgrid, x, y, k) )
+    # returned cells are at the returned distances
+    xc, yc = sgrid.centroids(row = np.arange(sgrid.nrow), col = np.arange(sgrid.ncol))
+    assert np.allclose( np.hypot(xc[col] - x[:, None], yc[row] - y[:, None]), dist )
+
+
+def test_nearest_cells_more_than_cells():
+    sgrid = StructuredGrid(0., 2., [1., 1.], [1., 1.])
+    row, col, dist = sgrid.nearest_cells([0.2], [1.8], k = 10)
+    assert row.shape == (1, 4)
+    assert (row[0, 0], col[0, 0]) == (0, 0)
+    assert len( set( zip( row[0].tolist(), col[0].tolist() ) ) ) == 4
+
+
+def test_nearest_cells_single_row():
+    sgrid = StructuredGrid(0., 1., [1.]*5, [1.])
+    row, col, dist = sgrid.nearest_cells([3.4, -2.], [0.5, 0.5], k = 2)
+    assert np.array_equal( row, np.zeros((2, 2), dtype=int) )
+    assert col[0].tolist() == [3, 2] and col[1].tolist() == [0, 1]
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the polyline helpers : segment clipping and curvilinear abscissa.
+"""
+
+import numpy as np
+
+from qgridder_utils.traversal import clip_segment, pline_ndist
+
+
+def test_clip_segment():
+    xmin, ymin = np.array( [0., 1., 5.] ), np.array( [0., 0., 5.] )
+    t_enter, t_exit = clip_segment(0.5, 0.5, 1.5, 0.5, xmin, ymin, xmin + 1., ymin + 1.)
+    assert np.allclose( t_enter[:2], [0., 0.5] )
+    assert np.allclose( t_exit[:2], [0.5, 1.] )
+    # no crossing of the third rectangle
+    assert t_exit[2] <= t_enter[2]
+
+
+def test_clip_segment_parallel_to_edge():
+    xmin, ymin = np.array( [0., 0.] ), np.array( [0., 2.] )
+    t_enter, t_exit = clip_segment(0.5, 0.5, 0.5, 1., xmin, ymin, xmin + 1., ymin + 1.)
+    assert np.isclose(t_enter[0], 0.) and np.isclose(t_exit[0], 1.)
+    assert t_exit[1] <= t_enter[1]
+
+
+def test_pline_ndist():
+    parts = [ np.array( [ (0., 0.), (10., 0.), (10., 10.) ] ) ]
+    ndist = pline_ndist(parts, [5., 11., -3., 12.], [1., 5., 0., 12.])
+    assert np.allclose( ndist, [0.25, 0.75, 0., 1.] )
+
+
+def test_pline_ndist_multipart():
+    parts = [ np.array( [ (0., 0.), (10., 0.) ] ), np.array( [ (0., 5.), (10., 5.) ] ) ]
+    ndist = pline_ndist(parts, [5., 5.], [-1., 6.])
+    assert np.allclose( ndist, [0.25, 0.75] )
+
+
+def test_pline_ndist_batches():
+    rng = np.random.default_rng(0)
+    parts = [ rng.uniform(0., 10., (20, 2)) ]
+    x, y = rng.uniform(0., 10., 100), rng.uniform(0., 10., 100)
+    assert np.allclose( pline_ndist(parts, x, y, max_distances = 7), pline_ndist(parts, x, y) )
+
+
+def test_pline_ndist_without_segment():
+    assert np.all( np.isnan( pline_ndist([], [1., 2.], [1., 2.]) ) )
+    # parts of a single vertex are ignored
+    parts = [ np.array( [ (0., 0.) ] ), np.array( [ (0., 0.), (4., 0.) ] ) ]
+    assert np.allclose( pline_ndist(parts, [1.], [1.]), [0.25] )
+    assert np.all( np.isnan( pline_ndist( [ np.array( [ (0., 0.) ] ) ], [1.], [1.] ) ) )